@@ -0,0 +1,337 @@
+"""
+Telegram бот: сборка зависимостей, обработчиков и запуск (точка входа — bot.py)
+"""
+import time
+
+# Начало запуска — для метрики длительности запуска
+_STARTED = time.perf_counter()
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import signal
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    TELEGRAM_TOKEN, TELEGRAM_API_URL, DB_PATH,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_REUSE_PORT,
+    WEBHOOK_CLAIM_TTL, STATE_BACKEND,
+    UPDATE_QUEUE_ENABLED, METRICS_ENABLED, METRICS_HOST, METRICS_PORT, WARMUP_ENABLED,
+)
+from database import Database
+from openai_client import OpenAIClient
+from context_builder import ContextBuilder
+from document_pipeline import DocumentPipeline
+from media_cache import MediaCache
+from message_inbox import MessageInbox
+from state_backend import create_state_backend
+from update_queue import UpdateQueue
+from retention import HistoryRetention
+from outbound_sender import OutboundSender
+from warmup import warm_up, warm_up_background
+from metrics import (
+    QUEUE_DEPTH, IN_FLIGHT, DB_FILE_BYTES, STARTUP_SECONDS, handler_middleware, telegram_api_middleware,
+    register_collector, start_metrics_server,
+)
+from handlers import text_router, file_router, voice_router
+from handlers.text_handler import process_text_burst
+from utils.document_utils import shutdown_extraction_pool
+from logging_setup import setup_logging, stop_logging, correlation_middleware
+
+STARTUP_SECONDS.set(time.perf_counter() - _STARTED, phase="imports")
+
+logger = logging.getLogger(__name__)
+
+
+async def start_command(message: Message):
+    """Обработчик команды /start"""
+    user_id = message.from_user.id
+    user_name = message.from_user.first_name or "пользователь"
+    
+    welcome_text = f"""Привет, {user_name}!
+
+Я твой помощник по образу жизни. Я помогу тебе улучшить самочувствие, уменьшить живот и снизить влияние еды на сахар через небольшие, понятные изменения привычек.
+
+Я могу:
+• Принимать текстовые сообщения
+• Анализировать изображения
+• Обрабатывать голосовые сообщения
+• Читать документы (PDF, DOCX, TXT)
+
+Просто напиши мне или отправь файл, и я помогу тебе!"""
+    
+    await message.answer(welcome_text)
+    
+    # Инициализируем данные пользователя, если их еще нет (существующие не меняются)
+    import dependencies
+    await dependencies.db.save_user_data(user_id)
+
+
+async def reset_command(message: Message):
+    """Обработчик команды /reset - сброс истории диалога"""
+    import dependencies
+    user_id = message.from_user.id
+    # Ответ на еще не обработанные сообщения после сброса не нужен
+    await dependencies.message_inbox.discard(user_id)
+    await dependencies.db.clear_conversation_history(user_id)
+    await message.answer("История диалога очищена. Начнем заново!")
+
+
+async def collect_metrics():
+    """Размеры очередей и число выполняемых задач — перед каждым чтением метрик"""
+    import dependencies
+    scheduler = dependencies.openai_client.scheduler.stats()
+    QUEUE_DEPTH.set(scheduler["queued"], queue="openai")
+    IN_FLIGHT.set(scheduler["active"], queue="openai")
+    inbox = dependencies.message_inbox.stats()
+    QUEUE_DEPTH.set(inbox["pending"], queue="message_inbox")
+    IN_FLIGHT.set(inbox["active"], queue="message_inbox")
+    if dependencies.update_queue is not None:
+        QUEUE_DEPTH.set(await dependencies.db.count_queued_updates(), queue="updates")
+        IN_FLIGHT.set(dependencies.update_queue.stats()["running"], queue="updates")
+    QUEUE_DEPTH.set(dependencies.outbound_sender.stats()["pending"], queue="telegram_send")
+    db_stats = await dependencies.db.get_database_stats()
+    DB_FILE_BYTES.set(db_stats["size_bytes"], kind="total")
+    DB_FILE_BYTES.set(db_stats["free_bytes"], kind="free")
+
+
+async def _wait_for_stop_signal():
+    """Ожидание SIGINT/SIGTERM (Railway останавливает контейнер через SIGTERM)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остается KeyboardInterrupt
+            pass
+    await stop.wait()
+
+
+def _derive_webhook_secret(token: str) -> str:
+    """Секрет вебхука из токена бота: одинаковый во всех процессах, но сам токен не раскрывает"""
+    return hmac.new(token.encode(), b"webhook-secret", hashlib.sha256).hexdigest()
+
+
+async def _healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """
+    Прием обновлений через вебхук: Telegram сам присылает обновления на HTTP-сервер.
+    Без задержки опроса, и сервер можно поставить за балансировщик нагрузки.
+    """
+    import dependencies
+    # Без заданного секрета он выводится из токена бота: у всех процессов и реплик один и тот же
+    secret_token = WEBHOOK_SECRET or _derive_webhook_secret(TELEGRAM_TOKEN)
+    app = web.Application()
+    # Запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются.
+    # С очередью обновлений Telegram получает ответ, когда обновление уже сохранено в БД
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret_token,
+        handle_in_background=not UPDATE_QUEUE_ENABLED,
+    ).register(app, path=WEBHOOK_PATH)
+    # Проверка доступности для балансировщика
+    app.router.add_get("/healthz", _healthz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT or None)
+    await site.start()
+    logger.info(f"Вебхук-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        # Вебхук регистрирует один процесс; другие процессы и реплики с теми же
+        # настройками его не трогают (ключ зависит от адреса, секрета и типов обновлений)
+        url = f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}"
+        allowed_updates = dp.resolve_used_update_types()
+        settings = hashlib.sha256(f"{url}|{secret_token}|{','.join(sorted(allowed_updates))}".encode()).hexdigest()
+        if await dependencies.state_backend.claim(f"webhook:{settings[:16]}", WEBHOOK_CLAIM_TTL):
+            # Обновления, накопившиеся, пока бот был недоступен, Telegram доставит после запуска
+            await bot.set_webhook(
+                url,
+                secret_token=secret_token,
+                allowed_updates=allowed_updates,
+                drop_pending_updates=False,
+            )
+            logger.info("Вебхук зарегистрирован: %s", url)
+        await _wait_for_stop_signal()
+    finally:
+        # Вебхук не удаляем: пока бот перезапускается, Telegram придержит обновления
+        await runner.cleanup()
+
+
+def create_dispatcher(storage: BaseStorage) -> Dispatcher:
+    """Диспетчер с командами и роутерами обработчиков"""
+    dp = Dispatcher(storage=storage)
+    # Идентификатор запроса в записях лога (самый внешний middleware обновлений)
+    dp.update.outer_middleware(correlation_middleware)
+    # Длительность обработчиков — для метрик
+    dp.message.middleware(handler_middleware)
+    
+    # Регистрация команд
+    dp.message.register(start_command, Command("start"))
+    dp.message.register(reset_command, Command("reset"))
+    
+    # Регистрация роутеров
+    dp.include_router(text_router)
+    dp.include_router(file_router)
+    dp.include_router(voice_router)
+    return dp
+
+
+def init_services():
+    """Сервисы поверх базы данных и клиента OpenAI (их нужно создать заранее)"""
+    import dependencies
+    # Сборщик контекста диалога в пределах бюджета токенов
+    dependencies.context_builder = ContextBuilder(dependencies.db, dependencies.openai_client)
+    # Обработка документов, в том числе больших — по частям
+    dependencies.document_pipeline = DocumentPipeline(dependencies.db, dependencies.openai_client)
+    # Кэш результатов обработки медиа (повторно присланные файлы не обрабатываются заново)
+    dependencies.media_cache = MediaCache(dependencies.db)
+    # Очередь текстовых сообщений: серия сообщений подряд — один ответ
+    dependencies.message_inbox = MessageInbox(process_text_burst, dependencies.state_backend.user_lock)
+
+
+async def shutdown_dependencies():
+    """Остановка очередей и закрытие соединений"""
+    import dependencies
+    if dependencies.update_queue is not None:
+        await dependencies.update_queue.stop()
+    await dependencies.message_inbox.close()
+    if dependencies.update_queue is not None:
+        # Незавершенные обновления вернутся в очередь и будут обработаны после запуска
+        await dependencies.update_queue.close()
+    if dependencies.retention is not None:
+        await dependencies.retention.stop()
+    await dependencies.context_builder.close()
+    await dependencies.openai_client.close()
+    await dependencies.db.close()
+    await dependencies.state_backend.close()
+    shutdown_extraction_pool()
+
+
+async def main():
+    """Основная функция запуска бота"""
+    # Импортируем модуль зависимостей для установки значений
+    import dependencies
+    
+    # Проверка токена
+    if not TELEGRAM_TOKEN:
+        logger.error("TELEGRAM_TOKEN не установлен в переменных окружения")
+        return
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"Неизвестный BOT_MODE: {BOT_MODE} (ожидается polling или webhook)")
+        return
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("Для BOT_MODE=webhook нужно указать WEBHOOK_URL")
+        return
+    if BOT_MODE == "webhook" and WEBHOOK_REUSE_PORT and STATE_BACKEND != "redis":
+        # Процессы на одном порту делят пользователей — блокировки и кэши должны быть общими
+        logger.error("Для WEBHOOK_REUSE_PORT=true нужно STATE_BACKEND=redis")
+        return
+    
+    # Общее состояние: кэш истории, хранилище FSM, блокировки пользователей
+    # (в памяти процесса или в Redis — для нескольких процессов бота)
+    try:
+        dependencies.state_backend = create_state_backend()
+    except Exception as e:
+        logger.error(f"Ошибка инициализации хранилища состояния: {str(e)}")
+        return
+    storage = dependencies.state_backend.fsm_storage
+    
+    # Инициализация бота и диспетчера
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=TELEGRAM_TOKEN, session=session)
+    # Все отправки сообщений — с учетом лимитов Bot API и повтором после flood wait
+    dependencies.outbound_sender = OutboundSender()
+    bot.session.middleware(dependencies.outbound_sender)
+    # Длительность запросов к Bot API — для метрик (каждой попытки, без ожидания лимитов)
+    bot.session.middleware(telegram_api_middleware)
+    dp = create_dispatcher(storage)
+    
+    # Инициализация базы данных
+    dependencies.db = Database(DB_PATH, history_cache=dependencies.state_backend.history_cache,
+                               profile_cache=dependencies.state_backend.profile_cache)
+    await dependencies.db.init_db()
+    logger.info("База данных инициализирована")
+    
+    # Инициализация OpenAI клиента
+    try:
+        dependencies.openai_client = OpenAIClient()
+        logger.info(f"OpenAI клиент инициализирован с моделью: {dependencies.openai_client.model}")
+    except Exception as e:
+        logger.error(f"Ошибка инициализации OpenAI клиента: {str(e)}")
+        await dependencies.db.close()
+        await dependencies.state_backend.close()
+        await bot.session.close()
+        return
+    
+    init_services()
+    
+    # Прогрев: первый ответ после деплоя не ждет открытия соединений
+    warmup_task = None
+    if WARMUP_ENABLED:
+        warmup_started = time.perf_counter()
+        await warm_up(dependencies.db, dependencies.openai_client, bot)
+        STARTUP_SECONDS.set(time.perf_counter() - warmup_started, phase="warmup")
+        warmup_task = asyncio.create_task(warm_up_background())
+    
+    # Очередь входящих обновлений: прием обновлений не ждет их обработки,
+    # а необработанные обновления переживают перезапуск
+    if UPDATE_QUEUE_ENABLED:
+        dependencies.update_queue = UpdateQueue(dependencies.db, dp, bot)
+        dependencies.update_queue.install()
+        await dependencies.update_queue.start()
+    
+    # Перенос старой истории в архив и возврат освободившегося места
+    dependencies.retention = HistoryRetention(dependencies.db)
+    dependencies.retention.start()
+    
+    metrics_runner = None
+    if METRICS_ENABLED:
+        register_collector(collect_metrics)
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    startup_seconds = time.perf_counter() - _STARTED
+    STARTUP_SECONDS.set(startup_seconds, phase="total")
+    logger.info(f"Бот запущен и готов к работе (запуск занял {startup_seconds:.2f} с)")
+    
+    # Запуск бота
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # Вебхук, оставшийся от запуска в режиме webhook, мешает опросу
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
+    except Exception as e:
+        logger.error(f"Ошибка при работе бота: {str(e)}")
+    finally:
+        if warmup_task is not None and not warmup_task.done():
+            warmup_task.cancel()
+        await shutdown_dependencies()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+
+def run():
+    """Запуск бота до остановки (вызывается из bot.py)"""
+    # Настройка логирования: записи форматирует и выводит фоновый поток
+    setup_logging()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Бот остановлен пользователем")
+    finally:
+        # Вывести записи, оставшиеся в очереди лога
+        stop_logging()
@@ -0,0 +1,4 @@
+"""
+Нагрузочные замеры бота без внешних сервисов: локальные поддельные Bot API
+и OpenAI, синтетические обновления и образцы файлов. Запуск: python -m benchmarks.run
+"""
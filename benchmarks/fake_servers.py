@@ -0,0 +1,259 @@
+"""
+Поддельные Bot API и OpenAI API на одном локальном HTTP-сервере.
+Задержки и доля ошибок настраиваются, чтобы воспроизводить медленные
+ответы модели, 429 с Retry-After и сбои 5xx.
+
+Bot API:    http://host:port/bot<token>/<method>, файлы — /file/bot<token>/<path>
+OpenAI API: http://host:port/v1/chat/completions, /v1/audio/transcriptions, /v1/models/<model>
+
+Отдельный запуск: python -m benchmarks.fake_servers --port 8081 --samples-dir /tmp/samples
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from aiohttp import web
+
+# Ответ модели: столько «токенов» (слов) на ответ
+REPLY_WORD = "ответ"
+# Цена изображения в токенах (высокая детализация)
+IMAGE_TOKENS = 765
+
+
+@dataclass
+class LatencyProfile:
+    # Bot API: задержка запроса и доля ответов 429 (retry after 1 с)
+    telegram_latency: float = 0.02
+    telegram_error_rate: float = 0.0
+    # OpenAI: время до первого токена, задержка между токенами потока, длина ответа
+    openai_latency: float = 0.5
+    openai_token_delay: float = 0.005
+    openai_reply_tokens: int = 60
+    # Whisper: задержка на запрос
+    whisper_latency: float = 0.8
+    # Доля ответов 429 (с Retry-After) и 500
+    openai_rate_limit_rate: float = 0.0
+    openai_server_error_rate: float = 0.0
+
+
+def _jitter(seconds: float) -> float:
+    """Задержка с разбросом ±20%, чтобы запросы не шли строем"""
+    return max(0.0, seconds * random.uniform(0.8, 1.2))
+
+
+def _prompt_tokens(content) -> int:
+    """Токены запроса, как их считает API: изображение — фиксированная цена, а не длина base64"""
+    if isinstance(content, list):
+        return sum(IMAGE_TOKENS if part.get("type") == "image_url" else len(part.get("text", "")) // 4
+                   for part in content if isinstance(part, dict))
+    return len(content or "") // 4
+
+
+class FakeServers:
+    def __init__(self, profile: LatencyProfile, samples_dir: str):
+        self.profile = profile
+        self.samples_dir = samples_dir
+        self._message_id = 0
+        self.requests = 0
+        # Обновления для getUpdates (добавляются через push_update)
+        self.pending_updates: List[dict] = []
+        self._updates_ready = asyncio.Event()
+        # Вызывается на каждый запрос к Bot API: observer(метод в нижнем регистре, параметры)
+        self.observer: Optional[Callable[[str, dict], None]] = None
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.bot_file)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_get("/v1/models/{model}", self.model)
+        return app
+
+    def push_update(self, update: dict):
+        """Обновление, которое получит следующий getUpdates"""
+        self.pending_updates.append(update)
+        self._updates_ready.set()
+
+    # ---- Bot API ----
+
+    async def _bot_params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def bot_api(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        method = request.match_info["method"].lower()
+        params = await self._bot_params(request)
+        if self.observer is not None:
+            self.observer(method, params)
+        await asyncio.sleep(_jitter(self.profile.telegram_latency))
+        if method in ("sendmessage", "editmessagetext") and random.random() < self.profile.telegram_error_rate:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getupdates":
+            # Долгий опрос, но не дольше секунды, чтобы бот быстро останавливался
+            if not self.pending_updates:
+                try:
+                    await asyncio.wait_for(self._updates_ready.wait(),
+                                           min(float(params.get("timeout") or 0), 1.0))
+                except asyncio.TimeoutError:
+                    pass
+            result, self.pending_updates = self.pending_updates, []
+            self._updates_ready.clear()
+        elif method == "getfile":
+            # file_id образцов: "<имя файла>:<что угодно>"
+            name = str(params.get("file_id", "")).split(":", 1)[0]
+            path = os.path.join(self.samples_dir, name)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            result = {"file_id": params.get("file_id"), "file_unique_id": name,
+                      "file_size": size, "file_path": f"samples/{name}"}
+        elif method in ("sendmessage", "editmessagetext"):
+            if method == "sendmessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(params.get("message_id") or 0)
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                "text": params.get("text", ""),
+            }
+        else:
+            # deleteMessage, sendChatAction, setWebhook, deleteWebhook и прочие
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def bot_file(self, request: web.Request) -> web.StreamResponse:
+        name = os.path.basename(request.match_info["path"])
+        path = os.path.join(self.samples_dir, name)
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        await asyncio.sleep(_jitter(self.profile.telegram_latency))
+        return web.FileResponse(path)
+
+    # ---- OpenAI API ----
+
+    def _openai_error(self) -> Optional[web.Response]:
+        roll = random.random()
+        if roll < self.profile.openai_rate_limit_rate:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after-ms": "500"},
+            )
+        if roll < self.profile.openai_rate_limit_rate + self.profile.openai_server_error_rate:
+            return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+        return None
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        error = self._openai_error()
+        if error is not None:
+            await asyncio.sleep(_jitter(0.05))
+            return error
+        prompt_tokens = sum(_prompt_tokens(message.get("content")) for message in body.get("messages", []))
+        tokens = self.profile.openai_reply_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                 "total_tokens": prompt_tokens + tokens}
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model", "")}
+        await asyncio.sleep(_jitter(self.profile.openai_latency))
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.profile.openai_token_delay * tokens)
+            return web.json_response({
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join([REPLY_WORD] * tokens)}}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(payload: dict):
+            await response.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', **payload}, ensure_ascii=False)}\n\n".encode())
+
+        for index in range(tokens):
+            await send({"choices": [{"index": 0, "finish_reason": None,
+                                     "delta": {"content": (" " if index else "") + REPLY_WORD}}]})
+            if self.profile.openai_token_delay:
+                await asyncio.sleep(self.profile.openai_token_delay)
+        await send({"choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({"choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def model(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"id": request.match_info["model"], "object": "model",
+                                  "created": 0, "owned_by": "bench"})
+
+    async def transcriptions(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await request.read()
+        error = self._openai_error()
+        if error is not None:
+            return error
+        await asyncio.sleep(_jitter(self.profile.whisper_latency))
+        return web.json_response({"text": "расшифровка голосового сообщения для замера"})
+
+
+async def start_fake_servers(host: str, port: int, profile: LatencyProfile,
+                             samples_dir: str) -> web.AppRunner:
+    runner = web.AppRunner(FakeServers(profile, samples_dir).build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Параметры LatencyProfile как аргументы командной строки"""
+    defaults = LatencyProfile()
+    for field, value in vars(defaults).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(value), default=value)
+
+
+def profile_from_args(args: argparse.Namespace) -> LatencyProfile:
+    return LatencyProfile(**{field: getattr(args, field) for field in vars(LatencyProfile())})
+
+
+async def _serve(args: argparse.Namespace):
+    runner = await start_fake_servers(args.host, args.port, profile_from_args(args), args.samples_dir)
+    print(f"Поддельные Bot API и OpenAI слушают http://{args.host}:{args.port}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поддельные Bot API и OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--samples-dir", required=True)
+    add_profile_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+Сквозной замер производительности обработчиков без внешних сервисов.
+
+Запускает поддельные Bot API и OpenAI (benchmarks.fake_servers), затем для
+каждого сценария и уровня параллельности — отдельный процесс бота, который
+получает синтетические обновления через настоящие диспетчер, роутеры,
+Database и OpenAIClient. Отдельный процесс нужен, чтобы пиковая память
+(peak RSS) относилась к одному сценарию.
+
+Пример:
+    python -m benchmarks.run --scenarios text,image,pdf --concurrency 1,8,32 --messages 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.fake_servers import add_profile_arguments, profile_from_args
+from benchmarks.samples import SAMPLE_DOCX, SAMPLE_IMAGE, SAMPLE_PDF, SAMPLE_VOICE, write_samples
+
+SCENARIOS = ("text", "image", "pdf", "docx", "voice")
+BENCH_TOKEN = "123456:bench"
+# Сколько ждать ответа на одно сообщение, сек
+MESSAGE_TIMEOUT = 300
+
+
+class _ErrorCounter(logging.Handler):
+    """Число ошибок в логе: обработчики перехватывают исключения и отвечают пользователю текстом"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def _make_update(scenario: str, update_id: int, user_id: int, unique: str, samples_dir: str) -> dict:
+    """Синтетическое обновление Telegram для сценария"""
+    message = {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+    }
+    if scenario == "text":
+        message["text"] = f"Сообщение {update_id}: как мне лучше спать и меньше есть сладкого вечером?"
+    elif scenario == "image":
+        size = os.path.getsize(os.path.join(samples_dir, SAMPLE_IMAGE))
+        message["photo"] = [{"file_id": f"{SAMPLE_IMAGE}:{update_id}", "file_unique_id": f"image-{unique}",
+                             "width": 2048, "height": 1536, "file_size": size}]
+        message["caption"] = "Что скажешь про этот обед?"
+    elif scenario in ("pdf", "docx"):
+        name = SAMPLE_PDF if scenario == "pdf" else SAMPLE_DOCX
+        message["document"] = {"file_id": f"{name}:{update_id}", "file_unique_id": f"{scenario}-{unique}",
+                               "file_name": name,
+                               "file_size": os.path.getsize(os.path.join(samples_dir, name))}
+        message["caption"] = "Посмотри мои записи"
+    elif scenario == "voice":
+        message["voice"] = {"file_id": f"{SAMPLE_VOICE}:{update_id}", "file_unique_id": f"voice-{unique}",
+                            "duration": 10, "mime_type": "audio/ogg",
+                            "file_size": os.path.getsize(os.path.join(samples_dir, SAMPLE_VOICE))}
+    else:
+        raise ValueError(f"Неизвестный сценарий: {scenario}")
+    return {"update_id": update_id, "message": message}
+
+
+async def _run_child(args: argparse.Namespace) -> Dict:
+    """Один сценарий при одном уровне параллельности; выполняется в отдельном процессе"""
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    import dependencies
+    from app import create_dispatcher, init_services, shutdown_dependencies
+    from logging_setup import setup_logging
+    from database import Database
+    from metrics import STAGE_SECONDS, DB_SECONDS, telegram_api_middleware
+    from openai_client import OpenAIClient
+    from outbound_sender import OutboundSender
+    from state_backend import create_state_backend
+    from update_queue import UpdateQueue
+
+    # Для замера информационные записи только мешают
+    setup_logging(level="WARNING")
+    error_counter = _ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+
+    dependencies.state_backend = create_state_backend("memory")
+    bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(args.api_url)))
+    dependencies.outbound_sender = OutboundSender()
+    bot.session.middleware(dependencies.outbound_sender)
+    bot.session.middleware(telegram_api_middleware)
+    dp = create_dispatcher(dependencies.state_backend.fsm_storage)
+    dependencies.db = Database(args.db_path, history_cache=dependencies.state_backend.history_cache,
+                               profile_cache=dependencies.state_backend.profile_cache)
+    await dependencies.db.init_db()
+    dependencies.openai_client = OpenAIClient()
+    init_services()
+    if args.update_queue:
+        dependencies.update_queue = UpdateQueue(dependencies.db, dp, bot)
+        dependencies.update_queue.install()
+        await dependencies.update_queue.start()
+
+    # Ответ на сообщение готов, когда завершился обработчик, а для текста —
+    # обработка серии сообщений (обработчик только ставит сообщение в очередь)
+    waiting: Dict[int, asyncio.Future] = {}
+
+    def complete(user_id: int):
+        future = waiting.pop(user_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def track_handler(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            if getattr(data.get("handler"), "callback", None).__name__ != "handle_text_message":
+                complete(event.from_user.id)
+
+    dp.message.middleware(track_handler)
+    process_burst = dependencies.message_inbox.process
+
+    async def tracked_process(user_id, burst):
+        try:
+            await process_burst(user_id, burst)
+        finally:
+            complete(user_id)
+
+    dependencies.message_inbox.process = tracked_process
+
+    counter = itertools.count(1)
+    latencies: List[float] = []
+    errors = 0
+
+    async def send_one(user_id: int, update_id: int, record: bool):
+        nonlocal errors
+        unique = "shared" if args.media_cache_hits else str(update_id)
+        update = Update.model_validate(
+            _make_update(args.scenario, update_id, user_id, unique, args.samples_dir), context={"bot": bot}
+        )
+        future = asyncio.get_running_loop().create_future()
+        waiting[user_id] = future
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+            await asyncio.wait_for(future, MESSAGE_TIMEOUT)
+        except Exception:
+            errors += record
+            waiting.pop(user_id, None)
+            return
+        if record:
+            latencies.append(time.perf_counter() - started)
+
+    async def virtual_user(user_id: int, total: int, record: bool):
+        # Замкнутый цикл: пользователь отправляет следующее сообщение после ответа
+        while True:
+            update_id = next(counter)
+            if update_id > total:
+                return
+            await send_one(user_id, update_id, record)
+
+    # Прогрев: соединения, пулы, кэш страниц SQLite
+    await asyncio.gather(*(virtual_user(1_000_000 + index, args.warmup, False)
+                           for index in range(min(args.concurrency, max(1, args.warmup)))))
+    counter = itertools.count(1)
+    error_counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(index + 1, args.messages, True) for index in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    errors += error_counter.count
+
+    await shutdown_dependencies()
+    await bot.session.close()
+
+    def means(histogram, label):
+        return {name: round(total / count * 1000, 2)
+                for name, (count, total) in sorted(histogram.totals(label).items()) if count}
+
+    # ru_maxrss в Linux — в КБ, в macOS — в байтах
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "scenario": args.scenario,
+        "concurrency": args.concurrency,
+        "messages": len(latencies),
+        "errors": errors,
+        "telegram_flood_waits": dependencies.outbound_sender.flood_waits,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 2 ** 20, 1),
+        "stage_mean_ms": means(STAGE_SECONDS, "stage"),
+        "db_mean_ms": means(DB_SECONDS, "method"),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Поддельные серверы не запустились на порту {port}")
+
+
+def _print_table(results: List[Dict]):
+    header = f"{'сценарий':<8} {'парал.':>6} {'сообщ.':>6} {'ошибки':>6} {'сообщ/с':>8} " \
+             f"{'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'RSS, МБ':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['scenario']:<8} {result['concurrency']:>6} {result['messages']:>6} "
+              f"{result['errors']:>6} {result['messages_per_sec']:>8} {result['p50_ms']:>9} "
+              f"{result['p95_ms']:>9} {result['p99_ms']:>9} {result['peak_rss_mb']:>8}")
+
+
+def _run_parent(args: argparse.Namespace) -> int:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot-bench-")
+    samples_dir = os.path.join(workdir, "samples")
+    write_samples(samples_dir)
+
+    port = args.port or _free_port()
+    api_url = f"http://127.0.0.1:{port}"
+    profile_args = []
+    for field, value in vars(profile_from_args(args)).items():
+        profile_args += [f"--{field.replace('_', '-')}", str(value)]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_servers", "--port", str(port),
+         "--samples-dir", samples_dir, *profile_args],
+        stdout=subprocess.DEVNULL,
+    )
+    results = []
+    try:
+        _wait_for_port(port)
+        env = dict(
+            os.environ,
+            TELEGRAM_API_URL=api_url,
+            OPENAI_BASE_URL=f"{api_url}/v1",
+            OPENAI_API_KEY="bench",
+            # Серии сообщений не объединяются: каждое сообщение — отдельный ответ
+            MESSAGE_DEBOUNCE_SECONDS="0",
+            MEDIA_CACHE_ENABLED=os.environ.get("MEDIA_CACHE_ENABLED", "true"),
+        )
+        for scenario, concurrency in itertools.product(args.scenarios.split(","), args.concurrency.split(",")):
+            db_path = os.path.join(workdir, f"bench-{scenario}-{concurrency}.sqlite")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+            command = [
+                sys.executable, "-m", "benchmarks.run", "--child",
+                "--scenario", scenario, "--concurrency", concurrency,
+                "--messages", str(args.messages), "--warmup", str(args.warmup),
+                "--api-url", api_url, "--samples-dir", samples_dir, "--db-path", db_path,
+            ]
+            if args.update_queue:
+                command.append("--update-queue")
+            if args.media_cache_hits:
+                command.append("--media-cache-hits")
+            print(f"Сценарий {scenario}, параллельность {concurrency}...", file=sys.stderr, flush=True)
+            completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                print(f"Сценарий {scenario} завершился с ошибкой (код {completed.returncode})", file=sys.stderr)
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    _print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    return 0 if results else 1
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Замер пропускной способности и задержек обработчиков бота")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Сценарии через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Уровни параллельности через запятую")
+    parser.add_argument("--messages", type=int, default=100, help="Сообщений на каждый замер")
+    parser.add_argument("--warmup", type=int, default=5, help="Сообщений прогрева (не учитываются)")
+    parser.add_argument("--update-queue", action="store_true", help="Пропускать обновления через очередь в SQLite")
+    parser.add_argument("--media-cache-hits", action="store_true",
+                        help="Один и тот же файл во всех сообщениях (замер попаданий в кэш медиа)")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    parser.add_argument("--workdir", help="Каталог для образцов и баз (по умолчанию временный)")
+    parser.add_argument("--port", type=int, default=0, help="Порт поддельных серверов (по умолчанию свободный)")
+    add_profile_arguments(parser)
+    # Аргументы дочернего процесса
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    parser.add_argument("--samples-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--db-path", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        args.concurrency = int(args.concurrency)
+        print(json.dumps(asyncio.run(_run_child(args)), ensure_ascii=False))
+        return 0
+    return _run_parent(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Образцы файлов для замеров: PDF, DOCX, изображение и голосовое OGG/Opus.
+Создаются при запуске, чтобы не хранить двоичные файлы в репозитории.
+"""
+import io
+import os
+import struct
+from typing import Dict
+
+from docx import Document
+from PIL import Image
+
+# Абзац текста DOCX
+PARAGRAPH = (
+    "Утром давление 130 на 85, пульс 72. На завтрак овсянка с ягодами и чай без сахара. "
+    "Днем прогулка 40 минут, вечером легкий ужин: рыба и овощи. Сон около семи часов."
+)
+
+SAMPLE_PDF = "document.pdf"
+SAMPLE_DOCX = "document.docx"
+SAMPLE_IMAGE = "photo.jpg"
+SAMPLE_VOICE = "voice.ogg"
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: int = 5, lines_per_page: int = 40) -> bytes:
+    """Простой PDF со стандартным шрифтом (латиница: стандартные шрифты PDF без кириллицы)"""
+    line = "Blood pressure 130/85, pulse 72. Breakfast: oatmeal with berries, tea without sugar."
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b""]
+    kids = []
+    font_id = 3
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for page in range(pages):
+        text = "".join(f"({_pdf_escape(f'{page + 1}.{index + 1} {line}')}) Tj 0 -16 Td "
+                       for index in range(lines_per_page))
+        stream = f"BT /F1 10 Tf 40 800 Td {text}ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font_id, content_id)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)
+    )
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_docx(paragraphs: int = 60) -> bytes:
+    document = Document()
+    document.add_heading("Дневник самочувствия", level=1)
+    for index in range(paragraphs):
+        document.add_paragraph(f"{index + 1}. {PARAGRAPH}")
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def make_image(width: int = 2048, height: int = 1536) -> bytes:
+    """Фото-подобное изображение: градиент с шумом (плохо сжимается, как настоящие фото)"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def _ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def _ogg_page(packets, serial: int, sequence: int, granule: int, header_type: int) -> bytes:
+    segments = []
+    for packet in packets:
+        length = len(packet)
+        segments.extend([255] * (length // 255))
+        segments.append(length % 255)
+    header = struct.pack("<4sBBqIIIB", b"OggS", 0, header_type, granule, serial, sequence, 0, len(segments))
+    page = header + bytes(segments) + b"".join(packets)
+    crc = _ogg_crc(page)
+    return page[:22] + struct.pack("<I", crc) + page[26:]
+
+
+def make_voice(duration: float = 10.0) -> bytes:
+    """
+    Голосовое OGG/Opus, как присылает Telegram: контейнер корректный, звук — тишина
+    (кадры Opus по 20 мс). Поддельному Whisper содержимое не важно, а ffmpeg не нужен
+    """
+    serial = 0x5EED
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 5) + b"bench" + struct.pack("<I", 0)
+    pages = [
+        _ogg_page([head], serial, 0, 0, 0x02),
+        _ogg_page([tags], serial, 1, 0, 0x00),
+    ]
+    silence = b"\xf8\xff\xfe"
+    frames = int(duration * 50)
+    per_page = 50
+    sequence = 2
+    for start in range(0, frames, per_page):
+        count = min(per_page, frames - start)
+        granule = 312 + (start + count) * 960
+        last = start + count >= frames
+        pages.append(_ogg_page([silence] * count, serial, sequence, granule, 0x04 if last else 0x00))
+        sequence += 1
+    return b"".join(pages)
+
+
+def write_samples(directory: str, voice_duration: float = 10.0) -> Dict[str, str]:
+    """Создать образцы в directory; возвращает {имя: путь}"""
+    os.makedirs(directory, exist_ok=True)
+    samples = {
+        SAMPLE_PDF: make_pdf(),
+        SAMPLE_DOCX: make_docx(),
+        SAMPLE_IMAGE: make_image(),
+        SAMPLE_VOICE: make_voice(voice_duration),
+    }
+    paths = {}
+    for name, data in samples.items():
+        path = os.path.join(directory, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        paths[name] = path
+    return paths
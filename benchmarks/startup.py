@@ -0,0 +1,206 @@
+"""
+Замер холодного запуска бота.
+
+Импорт: python -X importtime -c "import app" несколько раз подряд; медиана
+общего времени импорта и пакеты с наибольшим собственным временем импорта
+(сумма по всем их модулям).
+
+Запуск: настоящий процесс bot.py против поддельных Bot API и OpenAI
+(benchmarks.fake_servers) — время до готовности, шаги прогрева и время ответа
+на первое сообщение после запуска. Поддельные серверы работают по HTTP на
+localhost, поэтому выигрыш прогрева от TLS-рукопожатия здесь не виден.
+
+Пример:
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 3 --no-warmup    # запуск без прогрева, для сравнения
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from benchmarks.fake_servers import FakeServers, add_profile_arguments, profile_from_args
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_SCRIPT = os.path.join(ROOT, "bot.py")
+BENCH_TOKEN = "123456:bench"
+BENCH_USER_ID = 4242
+READY_MARKER = "готов к работе"
+# Сколько ждать готовности бота и ответа на первое сообщение, сек
+START_TIMEOUT = 120
+REPLY_TIMEOUT = 60
+
+
+def _import_times(runs: int, top: int) -> Dict:
+    """Время импорта модуля app (сам бот, bot.py его только запускает) по отчету -X importtime"""
+    totals: List[float] = []
+    packages: Dict[str, List[float]] = defaultdict(list)
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app"],
+            cwd=ROOT, capture_output=True, text=True,
+            env=dict(os.environ, TELEGRAM_TOKEN=BENCH_TOKEN, OPENAI_API_KEY="bench"),
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"Импорт app завершился с ошибкой:\n{completed.stderr[-2000:]}")
+        self_times: Dict[str, int] = defaultdict(int)
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            name = name.strip()
+            self_times[name.split(".")[0]] += int(self_us)
+            if name == "app":
+                totals.append(int(cumulative_us) / 1e6)
+        for package, microseconds in self_times.items():
+            packages[package].append(microseconds / 1e6)
+    ranked = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:top]
+    return {
+        "import_s": round(statistics.median(totals), 3),
+        "packages_s": {package: round(statistics.median(values), 3) for package, values in ranked},
+    }
+
+
+def _first_update() -> dict:
+    return {"update_id": 1, "message": {
+        "message_id": 1, "date": int(time.time()),
+        "chat": {"id": BENCH_USER_ID, "type": "private"},
+        "from": {"id": BENCH_USER_ID, "is_bot": False, "first_name": "Bench"},
+        "text": "Привет! Что съесть на завтрак, чтобы сахар не скакал?",
+    }}
+
+
+async def _cold_start(args: argparse.Namespace, warmup: bool) -> Dict:
+    """Один запуск bot.py: до готовности, затем ответ на первое сообщение"""
+    servers = FakeServers(profile_from_args(args), samples_dir=tempfile.gettempdir())
+    replied = asyncio.get_running_loop().create_future()
+
+    def observe(method: str, params: dict):
+        if method == "sendmessage" and str(params.get("chat_id")) == str(BENCH_USER_ID) and not replied.done():
+            replied.set_result(time.perf_counter())
+
+    servers.observer = observe
+    runner = web.AppRunner(servers.build_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    api_url = f"http://127.0.0.1:{port}"
+
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=BENCH_TOKEN,
+        TELEGRAM_API_URL=api_url,
+        OPENAI_BASE_URL=f"{api_url}/v1",
+        OPENAI_API_KEY="bench",
+        METRICS_ENABLED="false",
+        # Один ответ одним сообщением — момент ответа однозначен
+        STREAMING_ENABLED="false",
+        MESSAGE_DEBOUNCE_SECONDS="0",
+        WARMUP_ENABLED="true" if warmup else "false",
+    )
+    result: Dict = {"warmup": warmup}
+    lines: List[str] = []
+    with tempfile.TemporaryDirectory(prefix="bot-startup-") as workdir:
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, cwd=workdir, env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        ready = asyncio.get_running_loop().create_future()
+
+        async def read_log():
+            # Журнал читается до конца, иначе бот заблокируется на переполненном канале
+            async for raw in process.stderr:
+                line = raw.decode(errors="replace").rstrip()
+                lines.append(line)
+                if READY_MARKER in line and not ready.done():
+                    ready.set_result(time.perf_counter())
+
+        reader = asyncio.create_task(read_log())
+        try:
+            ready_at = await asyncio.wait_for(ready, START_TIMEOUT)
+            result["ready_s"] = round(ready_at - started, 3)
+            sent_at = time.perf_counter()
+            servers.push_update(_first_update())
+            result["first_reply_s"] = round(await asyncio.wait_for(replied, REPLY_TIMEOUT) - sent_at, 3)
+            # Ответ учтен при получении запроса — даем боту дочитать ответ Bot API до остановки
+            await asyncio.sleep(1)
+        except asyncio.TimeoutError:
+            result["error"] = "таймаут"
+        finally:
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(process.wait(), 30)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            await reader
+            await runner.cleanup()
+
+    for line in lines:
+        match = re.search(r"запуск занял ([\d.]+) с", line)
+        if match:
+            result["startup_in_process_s"] = float(match.group(1))
+        if " - Прогрев: " in line:
+            result["warmup_steps"] = line.split(" - Прогрев: ", 1)[1]
+    errors = [line for line in lines if " - ERROR - " in line]
+    if errors:
+        result["errors"] = errors[:5]
+    return result
+
+
+def _summary(runs: List[Dict]) -> Dict:
+    summary: Dict = {"runs": len(runs)}
+    for key in ("ready_s", "startup_in_process_s", "first_reply_s"):
+        values = [run[key] for run in runs if key in run]
+        if values:
+            summary[key] = round(statistics.median(values), 3)
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Замер холодного запуска бота")
+    parser.add_argument("--runs", type=int, default=3, help="Сколько раз повторить каждый замер")
+    parser.add_argument("--top", type=int, default=10, help="Сколько самых долгих пакетов показать")
+    parser.add_argument("--no-warmup", action="store_true", help="Запускать бота с WARMUP_ENABLED=false")
+    parser.add_argument("--imports-only", action="store_true", help="Только время импорта")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    results: Dict = {"imports": _import_times(args.runs, args.top)}
+    print(f"Импорт app: {results['imports']['import_s']} с (медиана из {args.runs})")
+    for package, seconds in results["imports"]["packages_s"].items():
+        print(f"  {package:<24} {seconds:.3f} с")
+
+    if not args.imports_only:
+        runs = [asyncio.run(_cold_start(args, warmup=not args.no_warmup)) for _ in range(args.runs)]
+        results["cold_start"] = {"summary": _summary(runs), "runs": runs}
+        for run in runs:
+            print(json.dumps(run, ensure_ascii=False))
+        summary = results["cold_start"]["summary"]
+        print(f"Готовность: {summary.get('ready_s')} с (внутри процесса {summary.get('startup_in_process_s')} с), "
+              f"первый ответ: {summary.get('first_reply_s')} с")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
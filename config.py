@@ -9,6 +9,22 @@ load_dotenv()
 
 # Telegram Bot Token
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Адрес Bot API (по умолчанию — api.telegram.org; свой сервер Bot API или тестовый)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Режим получения обновлений: polling (опрос) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Вебхук: публичный адрес бота (https://...), путь и секрет, которым Telegram подписывает запросы
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адрес и порт HTTP-сервера вебхука (Railway передает порт в PORT)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+# Несколько процессов на одном порту (SO_REUSEPORT): ядро распределяет соединения между ними
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT", "false").lower() in ("1", "true", "yes")
+# Вебхук регистрирует один процесс из всех; повторная регистрация с теми же настройками — не раньше, сек
+WEBHOOK_CLAIM_TTL = int(os.getenv("WEBHOOK_CLAIM_TTL", "3600"))
 
 # OpenAI API Key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -41,6 +57,221 @@ SYSTEM_PROMPT = """Роль:
 
 # Настройки базы данных
 DB_PATH = "bot.db"
+# Число соединений на чтение в пуле (запись идет через одно соединение)
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# Размер кэша страниц SQLite на соединение, КБ
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+# Размер memory-mapped области, байт
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+# Сколько ждать снятия блокировки БД, мс
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Отложенная запись сообщений: сообщения копятся в памяти и пишутся пачками
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+# Сброс очереди при достижении размера пачки или по истечении интервала (сек)
+DB_FLUSH_BATCH_SIZE = int(os.getenv("DB_FLUSH_BATCH_SIZE", "100"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))
+# Режим auto_vacuum = INCREMENTAL: место после удаления возвращается понемногу, без полного VACUUM
+DB_INCREMENTAL_VACUUM = os.getenv("DB_INCREMENTAL_VACUUM", "true").lower() in ("1", "true", "yes")
 
 # Настройки контекста диалога
-MAX_CONTEXT_MESSAGES = 20
+# Сколько последних сообщений рассматривается при сборке контекста
+MAX_CONTEXT_MESSAGES = int(os.getenv("MAX_CONTEXT_MESSAGES", "40"))
+# Бюджет токенов на историю диалога в запросе (без системного промпта)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Сколько выпавших из бюджета сообщений копить перед обновлением краткого содержания
+CONTEXT_SUMMARY_MIN_MESSAGES = int(os.getenv("CONTEXT_SUMMARY_MIN_MESSAGES", "6"))
+# Сколько символов каждого сообщения передавать на сжатие
+SUMMARY_MESSAGE_MAX_CHARS = int(os.getenv("SUMMARY_MESSAGE_MAX_CHARS", "2000"))
+
+# Промпт для сжатия старой части диалога
+SUMMARY_PROMPT = """Ты ведешь краткое содержание разговора помощника по образу жизни с пользователем.
+Дополни текущее краткое содержание новыми сообщениями.
+Сохрани факты о пользователе (рост, вес, питание, активность, сон, самочувствие), договоренности и предложенные изменения привычек.
+Пиши по-русски, сжато, не более 15 пунктов. Верни только обновленное краткое содержание."""
+
+# Хранение истории диалогов
+# Сообщения старше стольких дней переносятся в архивную таблицу (0 — не переносить)
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", "90"))
+# Столько последних сообщений пользователя остаются в истории независимо от возраста
+CONVERSATION_KEEP_MESSAGES = int(os.getenv("CONVERSATION_KEEP_MESSAGES", str(MAX_CONTEXT_MESSAGES)))
+# Сообщения старше стольких дней удаляются из архива (0 — хранить бессрочно)
+CONVERSATION_ARCHIVE_DAYS = int(os.getenv("CONVERSATION_ARCHIVE_DAYS", "365"))
+# Интервал обслуживания (архивирование и incremental vacuum), сек
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Сообщений за одну транзакцию: запись в БД не блокируется надолго
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# Сколько свободных страниц возвращать файловой системе за один проход (0 — все)
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+
+# Настройки HTTP-клиента OpenAI
+# Максимум одновременных запросов к API (остальные ждут в очереди)
+OPENAI_MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", "16"))
+# Размер пула соединений и число keep-alive соединений
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "16"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+# Таймаут запроса в секундах
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+
+# Планировщик запросов к OpenAI
+# Лимиты запросов и токенов в минуту (как в настройках организации; 0 — без ограничения)
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+# Сколько токенов ответа закладывать в оценку запроса
+OPENAI_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("OPENAI_COMPLETION_TOKENS_ESTIMATE", "800"))
+# Повторы при 429, 5xx и сетевых ошибках: число попыток и задержки, сек
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "1"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "30"))
+# Сколько запрос может ждать в очереди, сек: ответ пользователю и фоновые задачи
+OPENAI_QUEUE_MAX_WAIT = float(os.getenv("OPENAI_QUEUE_MAX_WAIT", "30"))
+OPENAI_BACKGROUND_QUEUE_MAX_WAIT = float(os.getenv("OPENAI_BACKGROUND_QUEUE_MAX_WAIT", "300"))
+
+# Прогрев при запуске: соединения с БД, OpenAI и Telegram открываются до приема сообщений
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Дольше этого (сек) прогрев не задерживает запуск
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+# Окна истории скольких недавно писавших пользователей загрузить в кэш
+WARMUP_HISTORY_USERS = int(os.getenv("WARMUP_HISTORY_USERS", "200"))
+# Сколько соединений с OpenAI API открыть заранее
+WARMUP_OPENAI_CONNECTIONS = int(os.getenv("WARMUP_OPENAI_CONNECTIONS", "2"))
+# Запустить процессы разбора документов в фоне сразу после запуска, а не при первом документе
+WARMUP_EXTRACTION_POOL = os.getenv("WARMUP_EXTRACTION_POOL", "true").lower() in ("1", "true", "yes")
+
+# Логирование: уровень, формат (text — строки как раньше, json — одна запись JSON на строку)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Доля запросов (0..1), для которых пишутся информационные записи;
+# предупреждения и ошибки пишутся всегда
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+# Метрики в формате Prometheus: HTTP-сервер с /metrics на отдельном порту
+# (у каждого процесса бота — свой порт)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Очередь входящих обновлений в SQLite: обновление сохраняется сразу при получении,
+# а обрабатывают его воркеры (обновления одного пользователя — строго по порядку)
+UPDATE_QUEUE_ENABLED = os.getenv("UPDATE_QUEUE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Число воркеров (одновременно обрабатываемых обновлений)
+UPDATE_QUEUE_WORKERS = int(os.getenv("UPDATE_QUEUE_WORKERS", "8"))
+# Аренда обновления воркером, сек: продлевается, пока обработка идет; после падения
+# процесса обновление снова берется в работу, когда аренда истечет
+UPDATE_QUEUE_LEASE_SECONDS = float(os.getenv("UPDATE_QUEUE_LEASE_SECONDS", "120"))
+# Обновление, обработка которого столько раз прерывалась падением процесса, отбрасывается
+UPDATE_QUEUE_MAX_ATTEMPTS = int(os.getenv("UPDATE_QUEUE_MAX_ATTEMPTS", "3"))
+# Как часто проверять очередь без новых обновлений (другие процессы, истекшие аренды), сек
+UPDATE_QUEUE_POLL_INTERVAL = float(os.getenv("UPDATE_QUEUE_POLL_INTERVAL", "1"))
+# Сколько при остановке ждать обновлений, которые уже обрабатываются, сек
+UPDATE_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv("UPDATE_QUEUE_SHUTDOWN_TIMEOUT", "30"))
+
+# Объединение серии сообщений: сообщения пользователя, пришедшие с паузой меньше
+# MESSAGE_DEBOUNCE_SECONDS, отправляются в модель одним запросом
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", "1.5"))
+# Дольше этого (сек) от первого сообщения серии ответ не откладывается
+MESSAGE_DEBOUNCE_MAX_DELAY = float(os.getenv("MESSAGE_DEBOUNCE_MAX_DELAY", "6"))
+
+# Кэш истории диалогов в памяти (окно — MAX_CONTEXT_MESSAGES сообщений на пользователя)
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "5000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Кэш профилей пользователей (рост, вес, предпочтения) в памяти
+PROFILE_CACHE_MAX_USERS = int(os.getenv("PROFILE_CACHE_MAX_USERS", "20000"))
+
+# Общее состояние процессов бота: memory — в памяти процесса (один процесс),
+# redis — кэш истории, FSM и блокировки пользователей в Redis (несколько процессов)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Префикс ключей Redis, чтобы несколько ботов могли делить один сервер
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "medbot")
+# Время жизни окна истории в Redis без обращений, сек
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", str(24 * 3600)))
+# Время жизни профиля пользователя в Redis, сек
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", str(24 * 3600)))
+# Максимальное время удержания блокировки пользователя (защита от упавшего процесса), сек
+USER_LOCK_TIMEOUT = float(os.getenv("USER_LOCK_TIMEOUT", "300"))
+
+# Потоковые ответы: сообщение-заглушка редактируется по мере генерации
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Минимальный интервал между редактированиями одного сообщения, сек (лимиты Telegram)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_PLACEHOLDER = "…"
+# Сколько раз пытаться записать окончательный текст ответа, если Telegram просит
+# подождать; после этого текст отправляется новым сообщением
+STREAM_FINAL_EDIT_ATTEMPTS = int(os.getenv("STREAM_FINAL_EDIT_ATTEMPTS", "3"))
+
+# Отправка сообщений в Telegram: лимиты Bot API (0 — без ограничения)
+# Сообщений в секунду на бота
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "30"))
+# Сообщений в секунду в одном личном чате и сколько можно отправить подряд без паузы
+TELEGRAM_CHAT_SEND_RATE = float(os.getenv("TELEGRAM_CHAT_SEND_RATE", "1"))
+TELEGRAM_CHAT_SEND_BURST = int(os.getenv("TELEGRAM_CHAT_SEND_BURST", "3"))
+# Сообщений в минуту в одной группе
+TELEGRAM_GROUP_SEND_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_SEND_RATE_PER_MINUTE", "20"))
+# Сколько раз повторить отправку после ответа 429 (flood wait)
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))
+
+# Предобработка изображений перед отправкой в vision
+# Длинная сторона после уменьшения, пикселей
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1280"))
+# Формат перекодирования: JPEG или WEBP
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# Файлы Telegram до этого размера (байт) скачиваются в память, крупнее — во временный файл
+MEDIA_MEMORY_THRESHOLD = int(os.getenv("MEDIA_MEMORY_THRESHOLD", str(8 * 1024 * 1024)))
+
+# Кэш результатов обработки медиа (текст документов, транскрипции, подготовленные изображения)
+MEDIA_CACHE_ENABLED = os.getenv("MEDIA_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Максимальный суммарный размер записей кэша (байт) и время жизни записи (сек)
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", str(30 * 24 * 3600)))
+# Как часто удалять устаревшие записи, если лимит размера не превышен, сек
+MEDIA_CACHE_EVICT_INTERVAL = float(os.getenv("MEDIA_CACHE_EVICT_INTERVAL", "3600"))
+
+# Извлечение текста из документов
+# Число процессов для разбора PDF/DOCX
+DOC_EXTRACT_WORKERS = int(os.getenv("DOC_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Лимиты на страницы, символы и время обработки одного документа (сек)
+DOC_MAX_PAGES = int(os.getenv("DOC_MAX_PAGES", "200"))
+DOC_MAX_CHARS = int(os.getenv("DOC_MAX_CHARS", "200000"))
+DOC_EXTRACT_TIMEOUT = float(os.getenv("DOC_EXTRACT_TIMEOUT", "30"))
+# Сколько страниц PDF обрабатывает одна задача пула
+DOC_PAGES_PER_TASK = int(os.getenv("DOC_PAGES_PER_TASK", "10"))
+
+# Обработка больших документов по частям (map-reduce)
+# Документы до этого размера (токенов) отправляются в модель целиком
+DOC_SINGLE_PASS_TOKENS = int(os.getenv("DOC_SINGLE_PASS_TOKENS", "12000"))
+# Размер одной части, токенов
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", "6000"))
+# Сколько частей обрабатывается одновременно
+DOC_MAP_CONCURRENCY = int(os.getenv("DOC_MAP_CONCURRENCY", "4"))
+# Сколько токенов текста документа (или сводок частей) сохраняется в истории диалога
+# для следующих вопросов о нем; 0 — только подпись пользователя
+DOC_HISTORY_TOKENS = int(os.getenv("DOC_HISTORY_TOKENS", "1000"))
+
+# Промпт для сводки одной части документа
+DOC_CHUNK_PROMPT = """Ты получаешь часть большого документа пользователя (например, результаты анализов или выписку).
+Кратко перескажи эту часть по-русски: сохрани все числа, показатели, единицы измерения, даты и выводы.
+Не давай советов и не делай выводов, которых нет в тексте."""
+
+# Подготовка аудио для Whisper
+# Форматы (расширения), которые Whisper принимает без перекодирования
+WHISPER_INPUT_FORMATS = [
+    fmt.strip().lower()
+    for fmt in os.getenv("WHISPER_INPUT_FORMATS", "flac,m4a,mp3,mp4,mpeg,mpga,oga,ogg,wav,webm").split(",")
+    if fmt.strip()
+]
+# Таймаут перекодирования через ffmpeg, сек
+AUDIO_TRANSCODE_TIMEOUT = float(os.getenv("AUDIO_TRANSCODE_TIMEOUT", "60"))
+# Длинное аудио режется на части по паузам и транскрибируется параллельно
+# Целевая длина части и перекрытие соседних частей, сек
+AUDIO_SEGMENT_SECONDS = float(os.getenv("AUDIO_SEGMENT_SECONDS", "300"))
+AUDIO_SEGMENT_OVERLAP = float(os.getenv("AUDIO_SEGMENT_OVERLAP", "2"))
+# Файлы больше этого размера (байт) режутся всегда: у Whisper лимит 25 МБ на файл
+AUDIO_SEGMENT_MAX_BYTES = int(os.getenv("AUDIO_SEGMENT_MAX_BYTES", str(24 * 1024 * 1024)))
+# Сколько частей одного файла транскрибируется одновременно
+AUDIO_SEGMENT_CONCURRENCY = int(os.getenv("AUDIO_SEGMENT_CONCURRENCY", "4"))
+# Что считать паузой: уровень шума и минимальная длительность, сек
+AUDIO_SILENCE_NOISE = os.getenv("AUDIO_SILENCE_NOISE", "-30dB")
+AUDIO_SILENCE_MIN_DURATION = float(os.getenv("AUDIO_SILENCE_MIN_DURATION", "0.5"))
@@ -0,0 +1,160 @@
+"""
+Сборка контекста диалога в пределах бюджета токенов.
+Старая часть диалога, не поместившаяся в бюджет, сворачивается
+в краткое содержание, которое хранится в БД и пополняется постепенно.
+Данные пользователя (рост, вес, предпочтения) добавляются в каждый контекст.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARY_MIN_MESSAGES, MAX_CONTEXT_MESSAGES
+from database import Database
+from history_cache import HistoryMessage
+from openai_client import OpenAIClient
+from utils.token_utils import estimate_message_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_HEADER = "Краткое содержание предыдущего разговора:"
+PROFILE_HEADER = "Данные пользователя:"
+
+# Сколько сообщений сворачивать за один запрос на сжатие
+SUMMARY_BATCH_MESSAGES = 40
+
+
+def format_profile(profile: Optional[Dict]) -> str:
+    """Данные пользователя для системного сообщения; пустая строка, если данных нет"""
+    if not profile:
+        return ""
+    lines = []
+    if profile.get("height"):
+        lines.append(f"- Рост: {profile['height']:g} см")
+    if profile.get("weight"):
+        lines.append(f"- Вес: {profile['weight']:g} кг")
+    for key, value in (profile.get("preferences") or {}).items():
+        lines.append(f"- {key}: {value}")
+    if not lines:
+        return ""
+    return "\n".join([PROFILE_HEADER, *lines])
+
+
+class ContextBuilder:
+    def __init__(self, db: Database, openai_client: OpenAIClient,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 max_messages: int = MAX_CONTEXT_MESSAGES,
+                 summary_min_messages: int = CONTEXT_SUMMARY_MIN_MESSAGES):
+        self.db = db
+        self.openai_client = openai_client
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.summary_min_messages = summary_min_messages
+        # Фоновые задачи сжатия истории, не больше одной на пользователя
+        self._summary_tasks: Dict[int, asyncio.Task] = {}
+        # id сообщения, до которого история пользователя уже свернута полностью
+        self._summarized_before: Dict[int, int] = {}
+
+    async def build(self, user_id: int) -> List[Dict]:
+        """
+        Контекст для запроса к модели: данные пользователя и краткое содержание
+        (если есть) и самые свежие сообщения, помещающиеся в бюджет токенов
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            Список сообщений в формате [{"role": ..., "content": ...}]
+        """
+        messages = await self.db.get_recent_messages(user_id, self.max_messages)
+        summary = await self.db.get_conversation_summary(user_id)
+        summary_text = summary["summary"] if summary else ""
+        # Профиль читается из кэша, в БД — только при первом обращении
+        profile_text = format_profile(await self.db.get_user_data(user_id))
+        if summary:
+            summarized_upto = summary["summarized_upto"]
+        else:
+            # Историю старше окна не сворачиваем: начинаем с самого старого сообщения окна
+            oldest_id = messages[0].id if messages and messages[0].id is not None else 1
+            summarized_upto = oldest_id - 1
+
+        # Окно сдвинулось дальше краткого содержания: сообщения между ними не попадают
+        # ни в контекст, ни в сводку, если их не свернуть
+        window_gap = (
+            summary is not None
+            and len(messages) >= self.max_messages
+            and messages[0].id is not None
+            and messages[0].id > summarized_upto + 1
+            and self._summarized_before.get(user_id, 0) < messages[0].id
+        )
+        oldest = messages[0] if messages else None
+
+        # Сообщения, уже свернутые в краткое содержание, не повторяем
+        messages = [m for m in messages if m.id is None or m.id > summarized_upto]
+
+        budget = self.token_budget - estimate_tokens(summary_text) - estimate_tokens(profile_text)
+        kept: List[HistoryMessage] = []
+        used = 0
+        for message in reversed(messages):
+            tokens = estimate_message_tokens({"content": message.content})
+            # Самое свежее сообщение берем всегда, даже если оно больше бюджета
+            if kept and used + tokens > budget:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        if len(messages) - len(kept) >= self.summary_min_messages:
+            self._schedule_summary(user_id, summarized_upto, kept[0])
+        elif window_gap:
+            self._schedule_summary(user_id, summarized_upto, oldest)
+
+        context = [message.to_dict() for message in kept]
+        if summary_text:
+            context.insert(0, {"role": "system", "content": f"{SUMMARY_HEADER}\n{summary_text}"})
+        if profile_text:
+            context.insert(0, {"role": "system", "content": profile_text})
+        return context
+
+    def _schedule_summary(self, user_id: int, summarized_upto: int, before: HistoryMessage):
+        """Запуск фонового сжатия сообщений между summarized_upto и сообщением before"""
+        if before.id is None:
+            # Сообщение еще не записано в БД — свернем в следующий раз
+            return
+        task = self._summary_tasks.get(user_id)
+        if task is not None and not task.done():
+            return
+        self._summary_tasks[user_id] = asyncio.create_task(
+            self._update_summary(user_id, summarized_upto, before.id)
+        )
+
+    async def _update_summary(self, user_id: int, summarized_upto: int, before_id: int):
+        """Свернуть в краткое содержание сообщения, выпавшие из контекста"""
+        try:
+            summary = await self.db.get_conversation_summary(user_id)
+            summary_text = summary["summary"] if summary else ""
+            if summary:
+                summarized_upto = max(summarized_upto, summary["summarized_upto"])
+            while True:
+                dropped = await self.db.get_messages_between(
+                    user_id, summarized_upto, before_id, limit=SUMMARY_BATCH_MESSAGES
+                )
+                if not dropped:
+                    self._summarized_before[user_id] = before_id
+                    return
+                summary_text = await self.openai_client.summarize_conversation(
+                    summary_text, [message.to_dict() for message in dropped]
+                )
+                summarized_upto = dropped[-1].id
+                await self.db.save_conversation_summary(user_id, summary_text, summarized_upto)
+                logger.info(f"Обновлено краткое содержание диалога пользователя {user_id}: "
+                            f"свернуто до сообщения {summarized_upto}")
+        except Exception as e:
+            logger.error(f"Ошибка при сжатии истории пользователя {user_id}: {str(e)}", exc_info=True)
+        finally:
+            self._summary_tasks.pop(user_id, None)
+
+    async def close(self):
+        """Дождаться завершения фоновых задач сжатия"""
+        tasks = [task for task in self._summary_tasks.values() if not task.done()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,20 +1,118 @@
 """
 Работа с базой данных SQLite для хранения истории диалогов и данных пользователя
 """
+import asyncio
 import sqlite3
 import aiosqlite
-from typing import List, Dict, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from datetime import datetime
 import json
+import logging
+from config import (
+    DB_READ_POOL_SIZE, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_BUSY_TIMEOUT_MS,
+    DB_WRITE_BEHIND, DB_FLUSH_BATCH_SIZE, DB_FLUSH_INTERVAL, DB_INCREMENTAL_VACUUM,
+    MAX_CONTEXT_MESSAGES, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES,
+    PROFILE_CACHE_MAX_USERS,
+)
+from history_cache import HistoryCache, HistoryCacheBackend, HistoryMessage
+from profile_cache import ProfileCache, ProfileCacheBackend
+from metrics import observe_db
+
+logger = logging.getLogger(__name__)
 
 
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, read_pool_size: int = DB_READ_POOL_SIZE,
+                 write_behind: bool = DB_WRITE_BEHIND,
+                 history_cache: Optional[HistoryCacheBackend] = None,
+                 profile_cache: Optional[ProfileCacheBackend] = None):
         self.db_path = db_path
+        self.read_pool_size = max(1, read_pool_size)
+        # Одно соединение на запись (SQLite допускает только одного писателя)
+        # и пул соединений на чтение: в режиме WAL читатели не ждут писателя
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._all_readers: List[aiosqlite.Connection] = []
+
+        # Отложенная запись сообщений: (user_id, сообщение) копятся в памяти
+        # и фиксируются пачками фоновой задачей, которая затем проставляет id
+        self.write_behind = write_behind
+        self._pending: List[Tuple[int, HistoryMessage]] = []
+        self._flush_wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Сброшено, пока идет фиксация пачки; счетчик меняется при каждом сбросе,
+        # чтобы читатели могли обнаружить гонку со сбросом и повторить чтение
+        self._flush_idle = asyncio.Event()
+        self._flush_idle.set()
+        self._flush_generation = 0
+        self._flusher_task: Optional[asyncio.Task] = None
+
+        # Окна последних сообщений горячих пользователей, обновляются при записи.
+        # По умолчанию — в памяти процесса; общий для нескольких процессов кэш
+        # передается из state_backend
+        self.history_cache: HistoryCacheBackend = history_cache or HistoryCache(
+            window=MAX_CONTEXT_MESSAGES,
+            max_users=HISTORY_CACHE_MAX_USERS,
+            max_bytes=HISTORY_CACHE_MAX_BYTES,
+        )
+        # Профили пользователей для каждого запроса к модели; запись сквозная
+        self.profile_cache: ProfileCacheBackend = profile_cache or ProfileCache(
+            max_users=PROFILE_CACHE_MAX_USERS,
+        )
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        """Открытие соединения с настроенными PRAGMA"""
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+        if DB_INCREMENTAL_VACUUM and not readonly:
+            # Действует только до создания файла, поэтому раньше journal_mode = WAL
+            # (он записывает заголовок); для существующего файла не меняет ничего
+            await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode = WAL")
+        # В режиме WAL NORMAL безопасен и не делает fsync на каждый commit
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute(f"PRAGMA cache_size = -{int(DB_CACHE_SIZE_KB)}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        await conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Взять соединение на чтение из пула"""
+        if not self._all_readers:
+            # Без init_db (или после close) пул пуст и ожидание не закончилось бы никогда
+            raise RuntimeError("База данных не инициализирована: сначала вызовите init_db()")
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Эксклюзивный доступ к соединению на запись; при ошибке — откат транзакции"""
+        if self._writer is None:
+            raise RuntimeError("База данных не инициализирована: сначала вызовите init_db()")
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
 
     async def init_db(self):
-        """Инициализация базы данных - создание таблиц"""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Инициализация базы данных - открытие пула соединений и создание таблиц"""
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        if DB_INCREMENTAL_VACUUM:
+            await self._check_incremental_vacuum()
+        async with self._write() as db:
             # Таблица для истории диалогов
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS conversations (
@@ -26,6 +124,22 @@ class Database:
                 )
             """)
             
+            # Архив старых сообщений: переносятся из conversations по истечении срока хранения
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS conversations_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_archive_user
+                ON conversations_archive(user_id)
+            """)
+            
             # Таблица для данных пользователя
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS user_data (
@@ -37,103 +151,741 @@ class Database:
                 )
             """)
             
-            # Индекс для быстрого поиска по user_id
+            # Сжатое содержание старой части диалога, которая не помещается в контекст
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_summaries (
+                    user_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    summarized_upto INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Сводки частей больших документов (ключ — хэш текста и параметров разбиения)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS document_chunks (
+                    doc_hash TEXT NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (doc_hash, chunk_index)
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_document_chunks_created
+                ON document_chunks(created_at)
+            """)
+            
+            # Кэш результатов обработки медиа (текст документов, транскрипции, изображения)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    file_unique_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    mime_type TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (file_unique_id, kind)
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_media_cache_content
+                ON media_cache(kind, content_hash)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_media_cache_last_used
+                ON media_cache(last_used_at)
+            """)
+            
+            # Очередь входящих обновлений Telegram: queued — ждет воркера,
+            # running — обрабатывается, handed_off — передано дальше (в серию сообщений)
+            # и еще не завершено. lease_until — до какого времени запись арендована процессом
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS update_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_update_queue_user
+                ON update_queue(user_id, id)
+            """)
+            
+            # История пользователя упорядочена по id (created_at — с точностью до секунды).
+            # Индекс покрывающий: последние сообщения читаются из соседних страниц индекса
+            # без обращения к таблице. Его размер ограничен сроком хранения истории
             await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_conversations_user_id 
-                ON conversations(user_id, created_at)
+                CREATE INDEX IF NOT EXISTS idx_conversations_user_history
+                ON conversations(user_id, id, role, content)
             """)
+            await db.execute("DROP INDEX IF EXISTS idx_conversations_user_id")
             
             await db.commit()
 
+        for _ in range(self.read_pool_size):
+            conn = await self._connect(readonly=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+        if self.write_behind:
+            self._flusher_task = asyncio.create_task(self._flush_loop())
+
+    async def _auto_vacuum_mode(self) -> int:
+        """PRAGMA auto_vacuum: 0 — выключен, 1 — FULL, 2 — INCREMENTAL"""
+        async with self._writer.execute("PRAGMA auto_vacuum") as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def _check_incremental_vacuum(self):
+        """
+        Новый файл создается сразу в режиме auto_vacuum = INCREMENTAL (см. _connect).
+        Существующий файл переводится в него только полным VACUUM, который блокирует
+        базу, — это отдельный шаг обслуживания (python maintenance.py vacuum)
+        """
+        if await self._auto_vacuum_mode() != 2:
+            logger.warning("База данных не в режиме incremental vacuum: место после архивации "
+                           "не возвращается файловой системе. Переведите ее командой "
+                           "python maintenance.py vacuum, когда бот остановлен")
+
+    async def convert_to_incremental_vacuum(self) -> bool:
+        """
+        Перевод существующей базы в режим auto_vacuum = INCREMENTAL полным VACUUM.
+        VACUUM требует монопольного доступа: другие процессы с открытой базой
+        приводят к ошибке. Возвращает True, если база уже в нужном режиме или переведена
+        """
+        if await self._auto_vacuum_mode() == 2:
+            return True
+        try:
+            async with self._write() as db:
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await db.execute("VACUUM")
+        except Exception as e:
+            logger.error("Не удалось перевести базу данных в режим incremental vacuum: %s", e)
+            return False
+        return await self._auto_vacuum_mode() == 2
+
+    async def warm_up(self, max_users: int) -> int:
+        """
+        Подготовка к первым запросам: схема разбирается каждым соединением пула,
+        а окна истории недавно писавших пользователей загружаются в кэш истории
+        (заодно страницы индекса истории попадают в кэш страниц).
+        Возвращает число пользователей, чья история загружена.
+        """
+        for conn in self._all_readers:
+            async with conn.execute("SELECT COUNT(*) FROM sqlite_master") as cursor:
+                await cursor.fetchone()
+        if max_users <= 0:
+            return 0
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT user_id FROM conversations ORDER BY id DESC LIMIT ?
+            """, (max_users * 10,)) as cursor:
+                rows = await cursor.fetchall()
+        user_ids = list(dict.fromkeys(row["user_id"] for row in rows))[:max_users]
+        for user_id in user_ids:
+            await self.get_recent_messages(user_id, self.history_cache.window)
+        return len(user_ids)
+
+    async def _flush_loop(self):
+        """Фоновый сброс очереди сообщений по размеру пачки или по таймеру"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), timeout=DB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # Сообщения остаются в очереди и будут записаны при следующей попытке
+                logger.error(f"Ошибка при сбросе очереди сообщений: {str(e)}", exc_info=True)
+
+    @observe_db
+    async def flush(self):
+        """Запись накопленных сообщений одной транзакцией"""
+        async with self._flush_lock:
+            batch = self._pending[:DB_FLUSH_BATCH_SIZE]
+            if not batch:
+                return
+            self._flush_idle.clear()
+            self._flush_generation += 1
+            try:
+                async with self._write() as db:
+                    await db.executemany("""
+                        INSERT INTO conversations (user_id, role, content)
+                        VALUES (?, ?, ?)
+                    """, [(user_id, message.role, message.content) for user_id, message in batch])
+                    # Единственный писатель в одной транзакции получает подряд идущие id
+                    async with db.execute("SELECT last_insert_rowid()") as cursor:
+                        last_id = (await cursor.fetchone())[0]
+                    await db.commit()
+                by_user: Dict[int, List[HistoryMessage]] = {}
+                for offset, (user_id, message) in enumerate(batch):
+                    message.id = last_id - len(batch) + 1 + offset
+                    by_user.setdefault(user_id, []).append(message)
+                del self._pending[:len(batch)]
+                # Окна в общем кэше (Redis) получили сообщения без id — проставляем
+                for user_id, messages in by_user.items():
+                    try:
+                        await self.history_cache.assign_ids(user_id, messages)
+                    except Exception as e:
+                        logger.warning("Не удалось обновить id сообщений в кэше истории: %s", e)
+            finally:
+                self._flush_generation += 1
+                self._flush_idle.set()
+
+    async def _wait_flush_idle(self):
+        """Дождаться окончания текущего сброса очереди"""
+        while not self._flush_idle.is_set():
+            await self._flush_idle.wait()
+
+    async def close(self):
+        """Сброс очереди сообщений и закрытие всех соединений пула"""
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        while self._pending and self._writer is not None:
+            await self.flush()
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            async with self._write_lock:
+                await self._writer.close()
+            self._writer = None
+
+    @observe_db
     async def save_message(self, user_id: int, role: str, content: str):
         """Сохранение сообщения в историю диалога"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        message = HistoryMessage(None, role, content)
+        if self.write_behind:
+            self._pending.append((user_id, message))
+            await self.history_cache.append(user_id, message)
+            if len(self._pending) >= DB_FLUSH_BATCH_SIZE:
+                self._flush_wakeup.set()
+            return
+        async with self._write() as db:
+            async with db.execute("""
                 INSERT INTO conversations (user_id, role, content)
                 VALUES (?, ?, ?)
-            """, (user_id, role, content))
+            """, (user_id, role, content)) as cursor:
+                message.id = cursor.lastrowid
             await db.commit()
+        await self.history_cache.append(user_id, message)
 
     async def get_conversation_history(self, user_id: int, limit: int = 20) -> List[Dict]:
-        """Получение истории диалога пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Получение истории диалога пользователя (с учетом еще не записанных сообщений)"""
+        return [message.to_dict() for message in await self.get_recent_messages(user_id, limit)]
+
+    @observe_db
+    async def get_recent_messages(self, user_id: int, limit: int = 20) -> List[HistoryMessage]:
+        """Последние сообщения пользователя вместе с их id, старые первыми"""
+        if limit <= 0:
+            return []
+        cached = await self.history_cache.get(user_id, limit)
+        if cached is not None:
+            return cached
+        if limit > self.history_cache.window:
+            return await self._load_history(user_id, limit)
+        # Загружаем окно целиком, чтобы следующие запросы обслуживались из памяти
+        token = await self.history_cache.begin_load(user_id)
+        history: Optional[List[HistoryMessage]] = None
+        try:
+            history = await self._load_history(user_id, self.history_cache.window)
+        finally:
+            await self.history_cache.finish_load(user_id, token, history)
+        return history[-limit:]
+
+    async def _load_history(self, user_id: int, limit: int) -> List[HistoryMessage]:
+        """Чтение истории из БД с добавлением сообщений из очереди отложенной записи"""
+        while True:
+            await self._wait_flush_idle()
+            generation = self._flush_generation
+            rows = await self._select_history(user_id, limit)
+            # Если за время чтения начался сброс очереди, часть сообщений
+            # могла оказаться и в БД, и в очереди — читаем заново
+            if generation == self._flush_generation:
+                break
+        # Возвращаем в обратном порядке (старые сообщения первыми)
+        history = [HistoryMessage(row["id"], row["role"], row["content"]) for row in reversed(rows)]
+        pending = [message for pending_user_id, message in self._pending if pending_user_id == user_id]
+        if pending:
+            history = (history + pending)[-limit:]
+        return history
+
+    async def _select_history(self, user_id: int, limit: int) -> List[aiosqlite.Row]:
+        """Последние сообщения пользователя из БД, новые первыми"""
+        async with self._read() as db:
             async with db.execute("""
-                SELECT role, content 
+                SELECT id, role, content 
                 FROM conversations 
                 WHERE user_id = ? 
-                ORDER BY created_at DESC 
+                ORDER BY id DESC 
                 LIMIT ?
             """, (user_id, limit)) as cursor:
+                return await cursor.fetchall()
+
+    @observe_db
+    async def get_messages_between(self, user_id: int, after_id: int, before_id: int,
+                                   limit: int = 200) -> List[HistoryMessage]:
+        """Записанные сообщения пользователя с after_id < id < before_id, старые первыми"""
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT id, role, content
+                FROM conversations
+                WHERE user_id = ? AND id > ? AND id < ?
+                ORDER BY id
+                LIMIT ?
+            """, (user_id, after_id, before_id, limit)) as cursor:
                 rows = await cursor.fetchall()
-                # Возвращаем в обратном порядке (старые сообщения первыми)
-                return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+        return [HistoryMessage(row["id"], row["role"], row["content"]) for row in rows]
+
+    @observe_db
+    async def get_conversation_summary(self, user_id: int) -> Optional[Dict]:
+        """Сжатое содержание старой части диалога"""
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT summary, summarized_upto
+                FROM conversation_summaries
+                WHERE user_id = ?
+            """, (user_id,)) as cursor:
+                row = await cursor.fetchone()
+        if row:
+            return {"summary": row["summary"], "summarized_upto": row["summarized_upto"]}
+        return None
 
+    @observe_db
+    async def save_conversation_summary(self, user_id: int, summary: str, summarized_upto: int):
+        """Сохранение сжатого содержания диалога до сообщения summarized_upto включительно"""
+        async with self._write() as db:
+            # Если историю успели очистить, сообщения summarized_upto уже нет — не сохраняем
+            await db.execute("""
+                INSERT INTO conversation_summaries (user_id, summary, summarized_upto)
+                SELECT ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ? AND user_id = ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    summarized_upto = excluded.summarized_upto,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (user_id, summary, summarized_upto, summarized_upto, user_id))
+            await db.commit()
+
+    @observe_db
+    async def get_document_chunk_summaries(self, doc_hash: str, min_created_at: float) -> Dict[int, str]:
+        """Сохраненные сводки частей документа не старше min_created_at: {номер части: сводка}"""
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT chunk_index, summary
+                FROM document_chunks
+                WHERE doc_hash = ? AND created_at >= datetime(?, 'unixepoch')
+            """, (doc_hash, min_created_at)) as cursor:
+                rows = await cursor.fetchall()
+        return {row["chunk_index"]: row["summary"] for row in rows}
+
+    @observe_db
+    async def save_document_chunk_summary(self, doc_hash: str, chunk_index: int, summary: str):
+        """Сохранение сводки одной части документа"""
+        async with self._write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO document_chunks (doc_hash, chunk_index, summary)
+                VALUES (?, ?, ?)
+            """, (doc_hash, chunk_index, summary))
+            await db.commit()
+
+    @observe_db
+    async def evict_document_chunks(self, min_created_at: float) -> int:
+        """Удаление сводок частей документов старше min_created_at, возвращает число удаленных"""
+        async with self._write() as db:
+            cursor = await db.execute("""
+                DELETE FROM document_chunks WHERE created_at < datetime(?, 'unixepoch')
+            """, (min_created_at,))
+            removed = cursor.rowcount
+            await cursor.close()
+            await db.commit()
+        return removed
+
+    @observe_db
+    async def get_media_cache_entry(self, kind: str, min_created_at: float,
+                                    file_unique_id: Optional[str] = None,
+                                    content_hash: Optional[str] = None) -> Optional[Dict]:
+        """Запись кэша медиа по file_unique_id или по хэшу содержимого, не старше min_created_at"""
+        if file_unique_id is not None:
+            condition, key = "file_unique_id = ?", file_unique_id
+        else:
+            condition, key = "content_hash = ?", content_hash
+        async with self._read() as db:
+            async with db.execute(f"""
+                SELECT file_unique_id, content_hash, payload, mime_type
+                FROM media_cache
+                WHERE kind = ? AND {condition} AND created_at >= ?
+                LIMIT 1
+            """, (kind, key, min_created_at)) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return {
+            "file_unique_id": row["file_unique_id"],
+            "content_hash": row["content_hash"],
+            "payload": row["payload"],
+            "mime_type": row["mime_type"],
+        }
+
+    @observe_db
+    async def touch_media_cache_entry(self, file_unique_id: str, kind: str, used_at: float):
+        """Отметка использования записи кэша (для вытеснения давно не использованных)"""
+        async with self._write() as db:
+            await db.execute("""
+                UPDATE media_cache SET last_used_at = ?
+                WHERE file_unique_id = ? AND kind = ?
+            """, (used_at, file_unique_id, kind))
+            await db.commit()
+
+    @observe_db
+    async def save_media_cache_entry(self, file_unique_id: str, kind: str, content_hash: str,
+                                     payload: bytes, mime_type: Optional[str], created_at: float):
+        """Сохранение результата обработки медиа"""
+        async with self._write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO media_cache
+                    (file_unique_id, kind, content_hash, payload, mime_type, size, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (file_unique_id, kind, content_hash, payload, mime_type, len(payload),
+                  created_at, created_at))
+            await db.commit()
+
+    @observe_db
+    async def evict_media_cache(self, max_bytes: int, min_created_at: float) -> Tuple[int, int]:
+        """
+        Удаление устаревших записей кэша медиа и самых давно использованных,
+        пока общий размер больше max_bytes. Возвращает число удаленных записей
+        и размер оставшихся, байт.
+        """
+        async with self._write() as db:
+            cursor = await db.execute("""
+                DELETE FROM media_cache WHERE created_at < ?
+            """, (min_created_at,))
+            removed = cursor.rowcount
+            await cursor.close()
+            async with db.execute("SELECT COALESCE(SUM(size), 0) FROM media_cache") as cursor:
+                total = (await cursor.fetchone())[0]
+            if total > max_bytes:
+                # Удаляем самые старые по использованию записи, пока не уложимся в лимит
+                async with db.execute("""
+                    SELECT file_unique_id, kind, size FROM media_cache ORDER BY last_used_at
+                """) as cursor:
+                    victims = []
+                    async for row in cursor:
+                        if total <= max_bytes:
+                            break
+                        victims.append((row["file_unique_id"], row["kind"]))
+                        total -= row["size"]
+                await db.executemany("""
+                    DELETE FROM media_cache WHERE file_unique_id = ? AND kind = ?
+                """, victims)
+                removed += len(victims)
+            await db.commit()
+        return removed, total
+
+    @observe_db
+    async def enqueue_update(self, user_id: int, payload: str, created_at: float) -> int:
+        """Сохранение входящего обновления в очередь, возвращает id записи"""
+        async with self._write() as db:
+            async with db.execute("""
+                INSERT INTO update_queue (user_id, payload, created_at)
+                VALUES (?, ?, ?)
+            """, (user_id, payload, created_at)) as cursor:
+                update_id = cursor.lastrowid
+            await db.commit()
+        return update_id
+
+    @observe_db
+    async def claim_updates(self, limit: int, now: float, lease_until: float,
+                            max_attempts: int) -> Tuple[List[aiosqlite.Row], int]:
+        """
+        Аренда до limit обновлений из очереди. Берется только самое раннее
+        незавершенное обновление каждого пользователя, поэтому обновления одного
+        пользователя обрабатываются по порядку. Обновления, обработка которых
+        max_attempts раз прервалась, удаляются.
+
+        Returns:
+            (арендованные записи по порядку id, число удаленных записей)
+        """
+        async with self._write() as db:
+            cursor = await db.execute("""
+                DELETE FROM update_queue
+                WHERE attempts >= ? AND state != 'queued' AND lease_until < ?
+            """, (max_attempts, now))
+            dropped = cursor.rowcount
+            await cursor.close()
+            # Раньше обновления пропускает только переданное дальше с действующей арендой:
+            # остальные (в том числе брошенные упавшим процессом) обрабатываются первыми
+            async with db.execute("""
+                UPDATE update_queue
+                SET state = 'running', lease_until = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT q.id FROM update_queue q
+                    WHERE (q.state = 'queued' OR q.lease_until < ?)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM update_queue p
+                          WHERE p.user_id = q.user_id AND p.id < q.id
+                            AND (p.state != 'handed_off' OR p.lease_until < ?)
+                      )
+                    ORDER BY q.id
+                    LIMIT ?
+                )
+                RETURNING id, user_id, payload, attempts
+            """, (lease_until, now, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+            await db.commit()
+        return sorted(rows, key=lambda row: row["id"]), dropped
+
+    @observe_db
+    async def hand_off_update(self, update_id: int):
+        """Обновление передано дальше: следующие обновления пользователя можно брать в работу"""
+        async with self._write() as db:
+            await db.execute("""
+                UPDATE update_queue SET state = 'handed_off' WHERE id = ?
+            """, (update_id,))
+            await db.commit()
+
+    @observe_db
+    async def renew_update_leases(self, update_ids: List[int], lease_until: float):
+        """Продление аренды обновлений, которые еще обрабатываются"""
+        async with self._write() as db:
+            await db.executemany("""
+                UPDATE update_queue SET lease_until = ? WHERE id = ?
+            """, [(lease_until, update_id) for update_id in update_ids])
+            await db.commit()
+
+    @observe_db
+    async def finish_updates(self, update_ids: List[int]):
+        """Удаление обработанных обновлений из очереди"""
+        async with self._write() as db:
+            await db.executemany("""
+                DELETE FROM update_queue WHERE id = ?
+            """, [(update_id,) for update_id in update_ids])
+            await db.commit()
+
+    @observe_db
+    async def release_updates(self, update_ids: List[int]):
+        """Возврат необработанных обновлений в очередь (при остановке бота)"""
+        async with self._write() as db:
+            # Прерванная остановкой попытка не считается
+            await db.executemany("""
+                UPDATE update_queue
+                SET state = 'queued', lease_until = NULL, attempts = MAX(attempts - 1, 0)
+                WHERE id = ?
+            """, [(update_id,) for update_id in update_ids])
+            await db.commit()
+
+    @observe_db
+    async def count_queued_updates(self) -> int:
+        """Число обновлений в очереди, включая обрабатываемые"""
+        async with self._read() as db:
+            async with db.execute("SELECT COUNT(*) FROM update_queue") as cursor:
+                return (await cursor.fetchone())[0]
+
+    @observe_db
+    async def archive_conversations(self, retention_days: int, keep_messages: int,
+                                    after_id: int, batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Перенос в архив сообщений старше retention_days дней, начиная после after_id.
+        Последние keep_messages сообщений каждого пользователя остаются, сколько бы им ни было,
+        как и сообщения, еще не вошедшие в сжатое содержание диалога (summarized_upto).
+        id растут вместе с created_at, поэтому просмотр идет по id и заканчивается
+        на первом сообщении, которое еще не устарело.
+
+        Returns:
+            (число перенесенных сообщений, id последнего просмотренного сообщения
+             или None, если устаревших сообщений дальше нет)
+        """
+        async with self._write() as db:
+            # Граница пользователя — его keep_messages-е сообщение с конца: старше нее можно переносить
+            async with db.execute("""
+                SELECT c.id,
+                       c.created_at < datetime('now', ?) AS expired,
+                       c.id < COALESCE((
+                           SELECT k.id FROM conversations k
+                           WHERE k.user_id = c.user_id
+                           ORDER BY k.id DESC
+                           LIMIT 1 OFFSET ?
+                       ), 0)
+                       -- Только то, что уже вошло в сжатое содержание диалога; само сообщение
+                       -- summarized_upto остается: по нему проверяется сохранение сводки
+                       AND c.id < COALESCE((
+                           SELECT s.summarized_upto FROM conversation_summaries s
+                           WHERE s.user_id = c.user_id
+                       ), 0) AS archivable
+                FROM conversations c
+                WHERE c.id > ?
+                ORDER BY c.id
+                LIMIT ?
+            """, (f"-{int(retention_days)} days", max(0, keep_messages - 1), after_id, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+            ids = []
+            # Продолжать, только если вся пачка устарела и за ней есть еще сообщения
+            last_id: Optional[int] = rows[-1]["id"] if len(rows) == batch_size else None
+            for row in rows:
+                if not row["expired"]:
+                    last_id = None
+                    break
+                if row["archivable"]:
+                    ids.append(row["id"])
+            if ids:
+                ids_json = json.dumps(ids)
+                await db.execute("""
+                    INSERT OR IGNORE INTO conversations_archive (id, user_id, role, content, created_at)
+                    SELECT id, user_id, role, content, created_at
+                    FROM conversations
+                    WHERE id IN (SELECT value FROM json_each(?))
+                """, (ids_json,))
+                await db.execute("""
+                    DELETE FROM conversations WHERE id IN (SELECT value FROM json_each(?))
+                """, (ids_json,))
+            await db.commit()
+        return len(ids), last_id
+
+    @observe_db
+    async def purge_conversation_archive(self, archive_days: int, batch_size: int) -> int:
+        """Удаление из архива сообщений старше archive_days дней (не больше batch_size за вызов)"""
+        async with self._write() as db:
+            async with db.execute("""
+                SELECT id, created_at < datetime('now', ?) AS expired
+                FROM conversations_archive
+                ORDER BY id
+                LIMIT ?
+            """, (f"-{int(archive_days)} days", batch_size)) as cursor:
+                rows = await cursor.fetchall()
+            ids = []
+            for row in rows:
+                if not row["expired"]:
+                    break
+                ids.append(row["id"])
+            if ids:
+                await db.execute("""
+                    DELETE FROM conversations_archive WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(ids),))
+            await db.commit()
+        return len(ids)
+
+    @observe_db
+    async def incremental_vacuum(self, pages: int) -> int:
+        """
+        Возврат файловой системе до pages свободных страниц (0 — всех)
+        и усечение журнала WAL. Возвращает число освобожденных страниц.
+        """
+        async with self._write() as db:
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                before = (await cursor.fetchone())[0]
+            if before:
+                # incremental_vacuum освобождает по странице за шаг выполнения, а execute
+                # делает только первый шаг; executescript выполняет инструкцию до конца
+                await db.executescript(f"PRAGMA incremental_vacuum({max(0, int(pages))});")
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                after = (await cursor.fetchone())[0]
+            # Читатели могут помешать усечению — тогда журнал усечется в следующий раз
+            async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+                await cursor.fetchall()
+        return before - after
+
+    @observe_db
+    async def get_database_stats(self) -> Dict[str, int]:
+        """Размер файла базы и свободное место в нем, байт"""
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT (SELECT page_count FROM pragma_page_count()) AS page_count,
+                       (SELECT freelist_count FROM pragma_freelist_count()) AS freelist_count,
+                       (SELECT page_size FROM pragma_page_size()) AS page_size
+            """) as cursor:
+                row = await cursor.fetchone()
+        return {
+            "size_bytes": row["page_count"] * row["page_size"],
+            "free_bytes": row["freelist_count"] * row["page_size"],
+        }
+
+    @observe_db
     async def clear_conversation_history(self, user_id: int):
         """Очистка истории диалога пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        if self.write_behind:
+            # Не даем сбросу записать уже удаленные сообщения после DELETE
+            await self._wait_flush_idle()
+            self._pending = [item for item in self._pending if item[0] != user_id]
+        async with self._write() as db:
             await db.execute("""
                 DELETE FROM conversations WHERE user_id = ?
             """, (user_id,))
+            await db.execute("""
+                DELETE FROM conversations_archive WHERE user_id = ?
+            """, (user_id,))
+            await db.execute("""
+                DELETE FROM conversation_summaries WHERE user_id = ?
+            """, (user_id,))
             await db.commit()
+        await self.history_cache.clear(user_id)
 
+    @observe_db
     async def save_user_data(self, user_id: int, height: Optional[float] = None, 
                            weight: Optional[float] = None, preferences: Optional[Dict] = None):
-        """Сохранение данных пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Проверяем, существует ли запись
+        """
+        Сохранение данных пользователя одним запросом: запись создается, если ее нет,
+        иначе обновляются только переданные поля. preferences дополняют сохраненные
+        (json_patch: ключ со значением None удаляется)
+        """
+        preferences_json = json.dumps(preferences, ensure_ascii=False) if preferences else None
+        async with self._write() as db:
             async with db.execute("""
-                SELECT user_id FROM user_data WHERE user_id = ?
-            """, (user_id,)) as cursor:
-                exists = await cursor.fetchone()
-            
-            preferences_json = json.dumps(preferences) if preferences else None
-            
-            if exists:
-                # Обновляем существующую запись
-                update_fields = []
-                params = []
-                if height is not None:
-                    update_fields.append("height = ?")
-                    params.append(height)
-                if weight is not None:
-                    update_fields.append("weight = ?")
-                    params.append(weight)
-                if preferences_json is not None:
-                    update_fields.append("preferences = ?")
-                    params.append(preferences_json)
-                
-                if update_fields:
-                    update_fields.append("updated_at = CURRENT_TIMESTAMP")
-                    params.append(user_id)
-                    await db.execute(f"""
-                        UPDATE user_data 
-                        SET {', '.join(update_fields)}
-                        WHERE user_id = ?
-                    """, params)
-            else:
-                # Создаем новую запись
-                await db.execute("""
-                    INSERT INTO user_data (user_id, height, weight, preferences)
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, height, weight, preferences_json))
-            
+                INSERT INTO user_data (user_id, height, weight, preferences)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    height = COALESCE(excluded.height, height),
+                    weight = COALESCE(excluded.weight, weight),
+                    preferences = CASE
+                        WHEN excluded.preferences IS NULL THEN preferences
+                        ELSE json_patch(COALESCE(preferences, '{}'), excluded.preferences)
+                    END,
+                    updated_at = CASE
+                        WHEN excluded.height IS NULL AND excluded.weight IS NULL
+                             AND excluded.preferences IS NULL THEN updated_at
+                        ELSE CURRENT_TIMESTAMP
+                    END
+                RETURNING height, weight, preferences
+            """, (user_id, height, weight, preferences_json)) as cursor:
+                row = await cursor.fetchone()
             await db.commit()
+        await self.profile_cache.set(user_id, self._profile_from_row(row))
+
+    @staticmethod
+    def _profile_from_row(row: aiosqlite.Row) -> Dict:
+        return {
+            "height": row["height"],
+            "weight": row["weight"],
+            "preferences": json.loads(row["preferences"]) if row["preferences"] else None
+        }
 
+    @observe_db
     async def get_user_data(self, user_id: int) -> Optional[Dict]:
-        """Получение данных пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Получение данных пользователя (из кэша профилей, при промахе — из БД)"""
+        cached, profile = await self.profile_cache.get(user_id)
+        if cached:
+            return profile
+        async with self._read() as db:
             async with db.execute("""
                 SELECT height, weight, preferences 
                 FROM user_data 
                 WHERE user_id = ?
             """, (user_id,)) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return {
-                        "height": row["height"],
-                        "weight": row["weight"],
-                        "preferences": json.loads(row["preferences"]) if row["preferences"] else None
-                    }
-                return None
+        profile = self._profile_from_row(row) if row else None
+        await self.profile_cache.add(user_id, profile)
+        return profile
@@ -4,7 +4,23 @@
 from typing import Optional
 from database import Database
 from openai_client import OpenAIClient
+from context_builder import ContextBuilder
+from document_pipeline import DocumentPipeline
+from media_cache import MediaCache
+from message_inbox import MessageInbox
+from state_backend import StateBackend
+from update_queue import UpdateQueue
+from retention import HistoryRetention
+from outbound_sender import OutboundSender
 
-# Глобальные переменные для зависимостей (инициализируются в bot.py)
+# Глобальные переменные для зависимостей (инициализируются в app.py)
 db: Optional[Database] = None
 openai_client: Optional[OpenAIClient] = None
+context_builder: Optional[ContextBuilder] = None
+document_pipeline: Optional[DocumentPipeline] = None
+media_cache: Optional[MediaCache] = None
+message_inbox: Optional[MessageInbox] = None
+state_backend: Optional[StateBackend] = None
+update_queue: Optional[UpdateQueue] = None
+retention: Optional[HistoryRetention] = None
+outbound_sender: Optional[OutboundSender] = None
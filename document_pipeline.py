@@ -0,0 +1,109 @@
+"""
+Обработка документов: небольшие отправляются в модель целиком, большие —
+по схеме map-reduce: текст режется на части, части параллельно сжимаются
+в сводки (сводки сохраняются в БД), а ответ строится по сводкам.
+Начало текста документа (или сводок) сохраняется в истории диалога вместе
+с сообщением пользователя, поэтому на следующие вопросы о документе модель
+отвечает без повторной обработки.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional
+
+from config import (
+    DOC_SINGLE_PASS_TOKENS, DOC_CHUNK_TOKENS, DOC_MAP_CONCURRENCY, DOC_HISTORY_TOKENS, MEDIA_CACHE_TTL,
+)
+from database import Database
+from openai_client import OpenAIClient, DOCUMENT_LABEL
+from utils.token_utils import estimate_tokens, split_text_by_tokens
+
+logger = logging.getLogger(__name__)
+
+DIGEST_LABEL = "Краткое содержание документа по частям"
+
+
+class PreparedDocument(NamedTuple):
+    # Текст для финального запроса (документ целиком или сводки частей) и его заголовок
+    text: str
+    label: str
+
+
+class DocumentPipeline:
+    def __init__(self, db: Database, openai_client: OpenAIClient,
+                 single_pass_tokens: int = DOC_SINGLE_PASS_TOKENS,
+                 chunk_tokens: int = DOC_CHUNK_TOKENS,
+                 map_concurrency: int = DOC_MAP_CONCURRENCY,
+                 history_tokens: int = DOC_HISTORY_TOKENS,
+                 chunk_ttl: float = MEDIA_CACHE_TTL):
+        self.db = db
+        self.openai_client = openai_client
+        self.single_pass_tokens = single_pass_tokens
+        self.chunk_tokens = chunk_tokens
+        self.history_tokens = history_tokens
+        # Сводки частей живут столько же, сколько записи кэша медиа
+        self.chunk_ttl = chunk_ttl
+        self._map_semaphore = asyncio.Semaphore(map_concurrency)
+
+    async def prepare(self, document_text: str) -> PreparedDocument:
+        """Текст для финального запроса: большой документ сжимается по частям"""
+        if estimate_tokens(document_text) <= self.single_pass_tokens:
+            return PreparedDocument(document_text, DOCUMENT_LABEL)
+        return PreparedDocument(await self._summarize_chunks(document_text), DIGEST_LABEL)
+
+    def history_entry(self, document: PreparedDocument, user_message: str = "") -> str:
+        """
+        Сообщение пользователя для истории диалога: подпись и начало текста
+        документа (или сводок частей) в пределах history_tokens
+        """
+        entry = f"[Документ]: {user_message}"
+        if self.history_tokens <= 0 or not document.text:
+            return entry
+        parts = split_text_by_tokens(document.text, self.history_tokens)
+        excerpt = parts[0] if parts else ""
+        if len(parts) > 1:
+            excerpt += "\n[...]"
+        return f"{entry}\n\n[{document.label}]:\n{excerpt}"
+
+    async def answer(self, document: PreparedDocument, user_message: str = "",
+                     conversation_history: Optional[List[Dict]] = None) -> str:
+        """Ответ модели на документ (и подпись пользователя к нему)"""
+        return await self.openai_client.process_document(
+            document.text, user_message, conversation_history, document.label
+        )
+
+    async def stream(self, document: PreparedDocument, user_message: str = "",
+                     conversation_history: Optional[List[Dict]] = None) -> AsyncIterator[str]:
+        """Потоковый ответ модели на документ"""
+        async for delta in self.openai_client.stream_document(
+            document.text, user_message, conversation_history, document.label
+        ):
+            yield delta
+
+    async def _summarize_chunks(self, document_text: str) -> str:
+        """Этап map: сводки всех частей документа, уже готовые берутся из БД"""
+        chunks = split_text_by_tokens(document_text, self.chunk_tokens)
+        doc_hash = self._document_hash(document_text)
+        summaries = await self.db.get_document_chunk_summaries(doc_hash, time.time() - self.chunk_ttl)
+        missing = [index for index in range(len(chunks)) if index not in summaries]
+        logger.info(f"Документ {doc_hash[:12]}: {len(chunks)} частей, "
+                    f"из них {len(chunks) - len(missing)} уже обработаны")
+
+        async def summarize(index: int):
+            async with self._map_semaphore:
+                summary = await self.openai_client.summarize_document_chunk(
+                    chunks[index], index + 1, len(chunks)
+                )
+            summaries[index] = summary
+            await self.db.save_document_chunk_summary(doc_hash, index, summary)
+
+        await asyncio.gather(*(summarize(index) for index in missing))
+        return "\n\n".join(f"Часть {index + 1} из {len(chunks)}:\n{summaries[index]}"
+                           for index in range(len(chunks)))
+
+    def _document_hash(self, document_text: str) -> str:
+        """Ключ сводок: текст документа и размер частей"""
+        digest = hashlib.sha256(document_text.encode("utf-8"))
+        digest.update(f":{self.chunk_tokens}".encode())
+        return digest.hexdigest()
@@ -4,10 +4,17 @@
 from aiogram import Router, F
 from aiogram.types import Message
 import dependencies
-from utils.file_utils import is_image_file, is_document_file
+from utils.file_utils import (
+    is_image_file, is_document_file, choose_photo_size, download_to_buffer, buffer_size,
+    preprocess_image_source, PreparedImage,
+)
 from utils.document_utils import extract_text_from_document
+from utils.telegram_utils import answer_streaming, answer_text
+from config import STREAMING_ENABLED
+from request_scheduler import OverloadedError, OVERLOADED_MESSAGE
+from media_cache import KIND_DOCUMENT_TEXT, KIND_IMAGE
+from metrics import stage
 import logging
-import tempfile
 import os
 
 router = Router()
@@ -20,8 +27,12 @@ async def handle_file_message(message: Message):
     user_id = message.from_user.id
     
     db, openai_client = dependencies.db, dependencies.openai_client
+    context_builder = dependencies.context_builder
+    document_pipeline = dependencies.document_pipeline
+    media_cache = dependencies.media_cache
     # Проверяем, что зависимости инициализированы
-    if db is None or openai_client is None:
+    if (db is None or openai_client is None or context_builder is None
+            or document_pipeline is None or media_cache is None):
         logger.error("Зависимости не инициализированы: db или openai_client = None")
         await message.answer("Бот еще не готов. Подождите немного и попробуйте снова.")
         return
@@ -29,11 +40,12 @@ async def handle_file_message(message: Message):
     try:
         # Определяем тип файла и получаем file_id
         if message.photo:
-            # Фото - берем самое большое разрешение
-            file_id = message.photo[-1].file_id
+            # Фото - берем наименьший размер, достаточный для анализа
+            media = choose_photo_size(message.photo)
+            file_name = None
             file_type = "image"
         elif message.document:
-            file_id = message.document.file_id
+            media = message.document
             file_name = message.document.file_name or "file"
             file_type = "document" if is_document_file(file_name) else "other"
             if is_image_file(file_name):
@@ -42,88 +54,121 @@ async def handle_file_message(message: Message):
             await message.answer("Не удалось определить тип файла.")
             return
         
-        # Получаем информацию о файле
-        bot = message.bot
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        
-        # Создаем временный файл для сохранения
-        temp_dir = tempfile.gettempdir()
-        # Используем уникальное имя файла
-        import uuid
-        file_extension = os.path.splitext(file_path)[1] or '.jpg'
-        local_file_path = os.path.join(temp_dir, f"{uuid.uuid4()}{file_extension}")
-        
-        # Скачиваем файл
-        logger.info(f"Скачиваю файл: {file_path} -> {local_file_path}")
-        await bot.download_file(file_path, local_file_path)
-        
-        # Проверяем, что файл скачался
-        if not os.path.exists(local_file_path):
-            raise Exception("Файл не был скачан")
-        
-        file_size = os.path.getsize(local_file_path)
-        logger.info(f"Файл скачан: {local_file_path}, размер: {file_size} байт")
+        if file_type == "other":
+            await message.answer("Этот тип файла пока не поддерживается. Отправьте изображение или документ (PDF, DOCX, TXT).")
+            return
         
-        try:
-            if file_type == "image":
-                # Обработка изображения
-                user_caption = message.caption or "Что на этом изображении?"
-                conversation_history = await db.get_conversation_history(user_id)
-                
-                # Сохраняем сообщение пользователя
-                await db.save_message(user_id, "user", f"[Изображение]: {user_caption}")
+        bot = message.bot
+
+        async def download():
+            # Получаем информацию о файле
+            nonlocal file_name
+            with stage("telegram_download"):
+                file = await bot.get_file(media.file_id)
+                file_path = file.file_path
+                if file_name is None:
+                    file_name = os.path.basename(file_path) or "photo.jpg"
                 
-                logger.info(f"Отправляю изображение в OpenAI API: {local_file_path}")
-                # Отправляем в OpenAI Vision API (gpt-5.2)
+                # Скачиваем файл в память (крупные файлы — во временный файл)
+                logger.info("Скачиваю файл: %s", file_path)
+                file_buffer = await download_to_buffer(bot, file_path, file.file_size)
+            
+            file_size = buffer_size(file_buffer)
+            if file_size == 0:
+                file_buffer.close()
+                raise Exception("Файл не был скачан")
+            logger.info("Файл скачан: %s, размер: %s байт", file_name, file_size)
+            return file_buffer
+
+        async def prepare_image(file_buffer):
+            with stage("image_encode"):
+                prepared = await preprocess_image_source(file_buffer)
+            return prepared.data, prepared.mime_type
+
+        async def extract_text(file_buffer):
+            with stage("document_extract"):
+                document_text = await extract_text_from_document(file_buffer, file_name)
+            if not document_text:
+                return None
+            return document_text.encode("utf-8"), "text/plain"
+        
+        if file_type == "image":
+            # Обработка изображения: уже подготовленное ранее берется из кэша
+            entry = await media_cache.get_or_compute(KIND_IMAGE, media.file_unique_id, download, prepare_image)
+            image = PreparedImage(entry.payload, entry.mime_type)
+            user_caption = message.caption or "Что на этом изображении?"
+            conversation_history = await context_builder.build(user_id)
+            
+            # Сохраняем сообщение пользователя
+            await db.save_message(user_id, "user", f"[Изображение]: {user_caption}")
+            
+            logger.info("Отправляю изображение в OpenAI API: %s байт, %s", len(image.data), image.mime_type)
+            # Отправляем в OpenAI Vision API (gpt-5.2)
+            if STREAMING_ENABLED:
+                response = await answer_streaming(
+                    message,
+                    openai_client.stream_image_message(image, user_caption, conversation_history)
+                )
+                if response:
+                    await db.save_message(user_id, "assistant", response)
+            else:
                 response = await openai_client.send_image_message(
-                    local_file_path, 
+                    image, 
                     user_caption,
                     conversation_history
                 )
                 
                 # Сохраняем ответ
-                await db.save_message(user_id, "assistant", response)
+                if response:
+                    await db.save_message(user_id, "assistant", response)
                 
                 # Отправляем ответ пользователю
-                await message.answer(response)
+                await answer_text(message, response)
+            
+        elif file_type == "document":
+            # Обработка документа
+            user_message = message.caption or ""
+            
+            # Извлекаем текст из документа (или берем из кэша, если файл уже присылали)
+            entry = await media_cache.get_or_compute(KIND_DOCUMENT_TEXT, media.file_unique_id, download, extract_text)
+            document_text = entry.payload.decode("utf-8") if entry is not None else None
+            
+            if document_text:
+                conversation_history = await context_builder.build(user_id)
+                # Большой документ сжимается по частям до ответа
+                document = await document_pipeline.prepare(document_text)
+                # Сохраняем сообщение пользователя вместе с началом документа:
+                # следующие вопросы о нем модель увидит в контексте
+                await db.save_message(user_id, "user", document_pipeline.history_entry(document, user_message))
                 
-            elif file_type == "document":
-                # Обработка документа
-                user_message = message.caption or ""
-                conversation_history = await db.get_conversation_history(user_id)
-                
-                # Извлекаем текст из документа
-                document_text = await extract_text_from_document(local_file_path)
-                
-                if document_text:
-                    # Сохраняем сообщение пользователя
-                    await db.save_message(user_id, "user", f"[Документ]: {user_message}")
-                    
-                    # Отправляем в OpenAI API (gpt-5.2)
-                    response = await openai_client.process_document(
-                        document_text,
+                # Отправляем в OpenAI API (gpt-5.2)
+                if STREAMING_ENABLED:
+                    response = await answer_streaming(
+                        message,
+                        document_pipeline.stream(document, user_message, conversation_history)
+                    )
+                    if response:
+                        await db.save_message(user_id, "assistant", response)
+                else:
+                    response = await document_pipeline.answer(
+                        document,
                         user_message,
                         conversation_history
                     )
                     
                     # Сохраняем ответ
-                    await db.save_message(user_id, "assistant", response)
+                    if response:
+                        await db.save_message(user_id, "assistant", response)
                     
                     # Отправляем ответ пользователю
-                    await message.answer(response)
-                else:
-                    await message.answer("Не удалось извлечь текст из документа. Поддерживаются форматы: PDF, DOCX, TXT.")
-                    
+                    await answer_text(message, response)
             else:
-                await message.answer("Этот тип файла пока не поддерживается. Отправьте изображение или документ (PDF, DOCX, TXT).")
-                
-        finally:
-            # Удаляем временный файл
-            if os.path.exists(local_file_path):
-                os.remove(local_file_path)
+                await message.answer("Не удалось извлечь текст из документа. Поддерживаются форматы: PDF, DOCX, TXT.")
                 
+    except OverloadedError as e:
+        logger.warning("Запрос пользователя %s не принят: %s", user_id, e)
+        await message.answer(OVERLOADED_MESSAGE)
     except Exception as e:
-        logger.error(f"Ошибка при обработке файла: {str(e)}", exc_info=True)
+        logger.error("Ошибка при обработке файла: %s", e, exc_info=True)
         error_message = f"Извините, произошла ошибка при обработке файла: {str(e)}"
         await message.answer(error_message[:500])  # Ограничиваем длину сообщения
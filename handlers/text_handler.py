@@ -1,52 +1,92 @@
 """
 Обработчик текстовых сообщений
 """
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message
 import dependencies
 import logging
+from config import STREAMING_ENABLED
+from request_scheduler import OverloadedError, OVERLOADED_MESSAGE
+from message_inbox import MessageBurst
+from update_queue import UpdateJob
+from utils.telegram_utils import StreamInterruptedError, answer_streaming, answer_text
 
 router = Router()
 logger = logging.getLogger(__name__)
 
 
 @router.message(F.text)
-async def handle_text_message(message: Message):
-    """Обработка текстовых сообщений"""
-    user_id = message.from_user.id
-    user_text = message.text
-    db, openai_client = dependencies.db, dependencies.openai_client
-
+async def handle_text_message(message: Message, update_job: Optional[UpdateJob] = None):
+    """Обработка текстовых сообщений: сообщение попадает в очередь пользователя"""
     # Проверяем, что зависимости инициализированы
-    if db is None or openai_client is None:
+    if (dependencies.db is None or dependencies.openai_client is None
+            or dependencies.context_builder is None or dependencies.message_inbox is None):
         logger.error("Зависимости не инициализированы: db или openai_client = None")
         await message.answer("Бот еще не готов. Подождите немного и попробуйте снова.")
         return
-    
+
+    logger.info("Получено текстовое сообщение от пользователя %s: %.50s", message.from_user.id, message.text)
+    # Ответ дается после паузы в переписке — на всю серию сообщений сразу
+    dependencies.message_inbox.submit(message, update_job)
+
+
+async def _save_turn(user_id: int, user_text: str, response: str = ""):
+    """Сохранение сообщений серии и ответа в историю; пустой ответ модели в историю не попадает"""
+    db = dependencies.db
+    await db.save_message(user_id, "user", user_text)
+    if response:
+        await db.save_message(user_id, "assistant", response)
+
+
+async def process_text_burst(user_id: int, burst: MessageBurst):
+    """Ответ на серию текстовых сообщений пользователя"""
+    openai_client = dependencies.openai_client
+    context_builder = dependencies.context_builder
+    message = burst.last
+    user_text = burst.text
+    saved = False
+
     try:
-        logger.info(f"Получено текстовое сообщение от пользователя {user_id}: {user_text[:50]}")
-        
-        # Сохраняем сообщение пользователя в БД
-        await db.save_message(user_id, "user", user_text)
-        logger.info("Сообщение сохранено в БД")
-        
-        # Загружаем историю диалога
-        conversation_history = await db.get_conversation_history(user_id)
-        logger.info(f"Загружена история диалога: {len(conversation_history)} сообщений")
+        # Загружаем историю диалога. Сообщения серии сохраняются после ответа или ошибки:
+        # если генерацию отменила новая серия (CancelledError), серия войдет в следующую
+        # и сохранится с ней, а в истории не останется вопроса без ответа
+        conversation_history = await context_builder.build(user_id)
+        logger.info("Загружена история диалога: %s сообщений", len(conversation_history))
+        messages = conversation_history + [{"role": "user", "content": user_text}]
         
         # Отправляем в OpenAI API (gpt-5.2)
         logger.info("Отправляю запрос в OpenAI API...")
-        response = await openai_client.send_text_message(conversation_history)
-        logger.info(f"Получен ответ от OpenAI: {response[:100]}")
-        
-        # Сохраняем ответ в БД
-        await db.save_message(user_id, "assistant", response)
-        
-        # Отправляем ответ пользователю
-        await message.answer(response)
+        if STREAMING_ENABLED:
+            # Ответ появляется у пользователя по мере генерации
+            response = await answer_streaming(
+                message, openai_client.stream_text_message(messages)
+            )
+            burst.committed = True
+            logger.info("Получен ответ от OpenAI: %.100s", response)
+            await _save_turn(user_id, user_text, response)
+            saved = True
+        else:
+            response = await openai_client.send_text_message(messages)
+            burst.committed = True
+            logger.info("Получен ответ от OpenAI: %.100s", response)
+            await _save_turn(user_id, user_text, response)
+            saved = True
+            
+            # Отправляем ответ пользователю
+            await answer_text(message, response)
         logger.info("Ответ отправлен пользователю")
         
+    except OverloadedError as e:
+        logger.warning("Запрос пользователя %s не принят: %s", user_id, e)
+        if not saved:
+            await _save_turn(user_id, user_text)
+        await message.answer(OVERLOADED_MESSAGE)
     except Exception as e:
-        logger.error(f"Ошибка при обработке текстового сообщения: {str(e)}", exc_info=True)
+        logger.error("Ошибка при обработке текстового сообщения: %s", e, exc_info=True)
+        if not saved:
+            # Текст пользователя остается в истории; показанная часть оборванного ответа — тоже
+            partial = e.partial if isinstance(e, StreamInterruptedError) else ""
+            await _save_turn(user_id, user_text, partial)
         error_msg = f"Извините, произошла ошибка: {str(e)[:200]}"
         await message.answer(error_msg)
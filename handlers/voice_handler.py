@@ -4,13 +4,17 @@ Telegram присылает OGG/Opus — отправляем в Whisper как
 """
 import logging
 import os
-import tempfile
-import uuid
 
 from aiogram import Router, F
 from aiogram.types import Message
 
 import dependencies
+from config import STREAMING_ENABLED
+from request_scheduler import OverloadedError, OVERLOADED_MESSAGE
+from media_cache import KIND_TRANSCRIPT
+from metrics import stage
+from utils.file_utils import download_to_buffer, buffer_size
+from utils.telegram_utils import answer_streaming, answer_text
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -21,39 +25,62 @@ async def handle_voice_message(message: Message):
     """Обработка голосовых: скачать OGG → Whisper → ответ от gpt-5.2."""
     user_id = message.from_user.id
     db, openai_client = dependencies.db, dependencies.openai_client
-    if db is None or openai_client is None:
+    context_builder = dependencies.context_builder
+    media_cache = dependencies.media_cache
+    if db is None or openai_client is None or context_builder is None or media_cache is None:
         await message.answer("Бот еще не готов. Подождите немного и попробуйте снова.")
         return
 
-    local_file_path = None
     try:
-        file_id = message.voice.file_id if message.voice else message.audio.file_id
+        media = message.voice or message.audio
         bot = message.bot
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
+        # Имя с расширением нужно Whisper для определения формата
+        file_name = "voice.ogg" if message.voice else message.audio.file_name
 
-        safe_id = (file_id or "").replace("/", "_")[:64]
-        temp_dir = tempfile.gettempdir()
-        local_file_path = os.path.join(temp_dir, f"voice_{safe_id}_{uuid.uuid4().hex[:8]}.ogg")
-        await bot.download_file(file_path, local_file_path)
-        if not os.path.exists(local_file_path) or os.path.getsize(local_file_path) == 0:
-            raise RuntimeError("Файл голоса не скачался или пустой")
+        async def download():
+            nonlocal file_name
+            with stage("telegram_download"):
+                file = await bot.get_file(media.file_id)
+                file_path = file.file_path
+                if not file_name:
+                    file_name = os.path.basename(file_path) or "audio.ogg"
+                # Скачиваем в память, без промежуточного файла
+                audio_buffer = await download_to_buffer(bot, file_path, file.file_size)
+            audio_size = buffer_size(audio_buffer)
+            if audio_size == 0:
+                audio_buffer.close()
+                raise RuntimeError("Файл голоса не скачался или пустой")
+            logger.info("Голос скачан %s байт, отправляю в Whisper (OGG как есть)...", audio_size)
+            return audio_buffer
 
-        logger.info("Голос скачан %s байт, отправляю в Whisper (OGG как есть)...", os.path.getsize(local_file_path))
-        conversation_history = await db.get_conversation_history(user_id)
-        response = await openai_client.process_voice_message(local_file_path, conversation_history)
+        async def transcribe(audio_buffer):
+            # Длинные записи транскрибируются по частям параллельно
+            text = await openai_client.transcribe_audio(audio_buffer, file_name, duration=media.duration)
+            return text.encode("utf-8"), "text/plain"
 
-        await db.save_message(user_id, "user", "[Голосовое сообщение]")
-        await db.save_message(user_id, "assistant", response)
-        await message.answer(response)
+        # Транскрипция уже присланного ранее аудио берется из кэша, без скачивания
+        entry = await media_cache.get_or_compute(KIND_TRANSCRIPT, media.file_unique_id, download, transcribe)
+        transcribed_text = entry.payload.decode("utf-8")
 
+        conversation_history = await context_builder.build(user_id)
+        messages = openai_client.build_voice_messages(transcribed_text, conversation_history)
+        if STREAMING_ENABLED:
+            response = await answer_streaming(message, openai_client.stream_text_message(messages))
+            await db.save_message(user_id, "user", "[Голосовое сообщение]")
+            if response:
+                await db.save_message(user_id, "assistant", response)
+        else:
+            response = await openai_client.send_text_message(messages)
+
+            await db.save_message(user_id, "user", "[Голосовое сообщение]")
+            if response:
+                await db.save_message(user_id, "assistant", response)
+            await answer_text(message, response)
+
+    except OverloadedError as e:
+        logger.warning("Запрос пользователя %s не принят: %s", user_id, e)
+        await message.answer(OVERLOADED_MESSAGE)
     except Exception as e:
         err = str(e)
         logger.error("Голос: %s", err, exc_info=True)
         await message.answer(f"Ошибка голоса: {err[:400]}")
-    finally:
-        if local_file_path and os.path.exists(local_file_path):
-            try:
-                os.remove(local_file_path)
-            except OSError:
-                pass
@@ -0,0 +1,166 @@
+"""
+Кэш окон истории диалога: интерфейс и реализация в памяти процесса
+(общая для нескольких процессов реализация — в state_backend)
+"""
+import sys
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+
+class HistoryMessage:
+    """Компактная запись сообщения; id равен None, пока сообщение не записано в БД"""
+    __slots__ = ("id", "role", "content")
+
+    def __init__(self, id: Optional[int], role: str, content: str):
+        self.id = id
+        self.role = role
+        self.content = content
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+def _entry_size(message: HistoryMessage) -> int:
+    """Приблизительный размер сообщения в памяти, байт"""
+    return sys.getsizeof(message) + sys.getsizeof(message.role) + sys.getsizeof(message.content)
+
+
+class HistoryCacheBackend:
+    """
+    Интерфейс кэша окон истории. Запись в кэше означает, что он содержит
+    полный «хвост» истории пользователя длиной не больше window сообщений.
+    """
+    window: int
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[HistoryMessage]]:
+        raise NotImplementedError
+
+    async def begin_load(self, user_id: int) -> Any:
+        raise NotImplementedError
+
+    async def finish_load(self, user_id: int, token: Any, messages: Optional[List[HistoryMessage]]):
+        raise NotImplementedError
+
+    async def append(self, user_id: int, message: HistoryMessage):
+        raise NotImplementedError
+
+    async def assign_ids(self, user_id: int, messages: List[HistoryMessage]):
+        """Проставить в окне id сообщений, записанных в БД позже (messages — в порядке сохранения)"""
+        # Кэш в памяти хранит те же объекты, что и очередь записи, — id в них уже проставлены
+
+    async def clear(self, user_id: int):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class HistoryCache(HistoryCacheBackend):
+    """
+    Хранит для каждого пользователя последние `window` сообщений в виде deque
+    объектов HistoryMessage. Запись в кэше означает, что он содержит полный
+    «хвост» истории: либо `window` последних сообщений, либо всю историю,
+    если она короче.
+    """
+
+    def __init__(self, window: int, max_users: int, max_bytes: int):
+        self.window = window
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Deque[HistoryMessage]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._total_bytes = 0
+        # Загрузки из БД, которые идут прямо сейчас, и те из них, что устарели,
+        # потому что во время загрузки история пользователя изменилась
+        self._loading: Dict[int, int] = {}
+        self._stale: Set[int] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[HistoryMessage]]:
+        """Последние `limit` сообщений или None, если их нужно читать из БД"""
+        entry = self._entries.get(user_id)
+        if entry is None or limit > self.window:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return list(entry)[len(entry) - limit:] if limit < len(entry) else list(entry)
+
+    async def begin_load(self, user_id: int) -> Any:
+        """Отметить начало загрузки истории пользователя из БД; результат передается в finish_load"""
+        self._loading[user_id] = self._loading.get(user_id, 0) + 1
+        return None
+
+    async def finish_load(self, user_id: int, token: Any, messages: Optional[List[HistoryMessage]]):
+        """
+        Положить в кэш загруженное окно, если история не менялась во время загрузки.
+        messages=None означает, что загрузка не удалась.
+        """
+        count = self._loading.get(user_id, 0) - 1
+        if count > 0:
+            self._loading[user_id] = count
+        else:
+            self._loading.pop(user_id, None)
+        stale = user_id in self._stale
+        if stale and count <= 0:
+            self._stale.discard(user_id)
+        if stale or messages is None:
+            return
+        self._store(user_id, deque(messages[-self.window:], maxlen=self.window))
+
+    async def append(self, user_id: int, message: HistoryMessage):
+        """Write-through: добавить новое сообщение в окно пользователя"""
+        if user_id in self._loading:
+            self._stale.add(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        size = self._sizes[user_id]
+        if len(entry) == entry.maxlen:
+            size -= _entry_size(entry[0])
+        entry.append(message)
+        size += _entry_size(message)
+        self._total_bytes += size - self._sizes[user_id]
+        self._sizes[user_id] = size
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    async def clear(self, user_id: int):
+        """Write-through: история пользователя очищена, запоминаем пустое окно"""
+        if user_id in self._loading:
+            self._stale.add(user_id)
+        self._store(user_id, deque(maxlen=self.window))
+
+    def discard(self, user_id: int):
+        """Убрать пользователя из кэша"""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._total_bytes -= self._sizes.pop(user_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики кэша"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "users": len(self._entries),
+            "bytes": self._total_bytes,
+        }
+
+    def _store(self, user_id: int, entry: Deque[HistoryMessage]):
+        self.discard(user_id)
+        size = sum(_entry_size(message) for message in entry)
+        self._entries[user_id] = entry
+        self._sizes[user_id] = size
+        self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """Вытеснение давно не использованных пользователей при превышении лимитов"""
+        while self._entries and (len(self._entries) > self.max_users
+                                 or self._total_bytes > self.max_bytes):
+            user_id, _ = self._entries.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(user_id)
+            self.evictions += 1
@@ -0,0 +1,145 @@
+"""
+Логирование без блокировки event loop: обработчик только кладет записи в очередь,
+а форматирование и запись в поток выполняет фоновый поток (QueueListener).
+Каждое обновление Telegram получает идентификатор запроса (correlation ID), который
+попадает во все записи, сделанные при его обработке. Информационные записи
+запросов можно сэмплировать: для доли LOG_SAMPLE_RATE запросов сохраняются все
+записи, для остальных — только предупреждения и ошибки.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# (идентификатор запроса, ID пользователя) текущего обновления
+_request_context: contextvars.ContextVar[Tuple[Optional[str], Optional[int]]] = contextvars.ContextVar(
+    "log_request_context", default=(None, None)
+)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def set_request_context(request_id: Optional[str], user_id: Optional[int] = None) -> contextvars.Token:
+    """Идентификатор запроса для записей текущей задачи (и задач, созданных из нее)"""
+    return _request_context.set((request_id, user_id))
+
+
+def reset_request_context(token: contextvars.Token):
+    _request_context.reset(token)
+
+
+def _sampled(request_id: str, rate: float) -> bool:
+    """Решение по запросу целиком: записи одного запроса сохраняются или отбрасываются вместе"""
+    return zlib.crc32(request_id.encode()) % 10000 < rate * 10000
+
+
+class _ContextFilter(logging.Filter):
+    """Добавляет к записи идентификатор запроса и отбрасывает несэмплированные записи INFO и ниже"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id, user_id = _request_context.get()
+        if request_id is None and record.name == "aiogram.event" and record.args:
+            # «Update id=... is handled» пишется уже после middleware — id берем из аргументов
+            request_id = f"u{record.args[0]}"
+        record.request_id = request_id
+        record.user_id = user_id
+        if request_id is None or record.levelno >= logging.WARNING or self.sample_rate >= 1:
+            return True
+        return _sampled(request_id, self.sample_rate)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Стандартный QueueHandler форматирует сообщение до постановки в очередь, то есть
+    в event loop. Здесь запись кладется как есть: очередь в том же процессе,
+    а сообщение и traceback форматирует поток QueueListener
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат; идентификатор запроса — перед сообщением"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        if request_id is None:
+            return line
+        prefix = f"{record.levelname} - "
+        head, _, tail = line.partition(prefix)
+        return f"{head}{prefix}[{request_id}] {tail}"
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        user_id = getattr(record, "user_id", None)
+        if user_id is not None:
+            entry["user_id"] = user_id
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT,
+                  sample_rate: float = LOG_SAMPLE_RATE):
+    """Настройка корневого логгера: очередь в event loop, запись в stderr — в фоновом потоке"""
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT))
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Записи, оставшиеся в очереди, выводятся и при выходе без stop_logging
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Вывести оставшиеся записи и остановить фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+async def correlation_middleware(handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                                 event: Any, data: Dict[str, Any]) -> Any:
+    """Middleware обновлений: идентификатор запроса — update_id обновления Telegram"""
+    user = data.get("event_from_user")
+    token = set_request_context(f"u{event.update_id}", user.id if user else None)
+    try:
+        return await handler(event, data)
+    finally:
+        reset_request_context(token)
@@ -0,0 +1,43 @@
+"""
+Разовые операции обслуживания базы данных; выполняются, когда бот остановлен.
+
+Пример:
+    python maintenance.py vacuum    # перевод существующей базы в режим incremental vacuum
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import List, Optional
+
+from config import DB_PATH
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+async def _vacuum(db_path: str) -> int:
+    db = Database(db_path)
+    await db.init_db()
+    try:
+        converted = await db.convert_to_incremental_vacuum()
+    finally:
+        await db.close()
+    if converted:
+        logger.info("База данных %s в режиме incremental vacuum", db_path)
+        return 0
+    return 1
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота")
+    parser.add_argument("command", choices=["vacuum"],
+                        help="vacuum — однократный VACUUM с переводом в режим auto_vacuum = INCREMENTAL")
+    parser.add_argument("--db-path", default=DB_PATH, help="Файл базы данных (по умолчанию DB_PATH)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    return asyncio.run(_vacuum(args.db_path))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
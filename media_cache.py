@@ -0,0 +1,155 @@
+"""
+Кэш результатов обработки медиа: извлеченный текст документов, транскрипции
+голосовых и подготовленные изображения. Ключ — file_unique_id Telegram
+(проверяется до скачивания) и хэш содержимого (одинаковый файл, загруженный заново).
+Вид результата включает хэш настроек обработки: после их изменения старые
+записи не используются и со временем вытесняются.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Awaitable, BinaryIO, Callable, NamedTuple, Optional, Tuple
+
+from config import (
+    MEDIA_CACHE_ENABLED, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_TTL, MEDIA_CACHE_EVICT_INTERVAL,
+    IMAGE_MAX_EDGE, IMAGE_FORMAT, IMAGE_QUALITY, DOC_MAX_PAGES, DOC_MAX_CHARS,
+)
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def _settings_kind(kind: str, *settings) -> str:
+    """Вид результата с коротким хэшем настроек, от которых он зависит"""
+    digest = hashlib.sha256(repr(settings).encode("utf-8")).hexdigest()[:12]
+    return f"{kind}:{digest}"
+
+
+KIND_DOCUMENT_TEXT = _settings_kind("document_text", DOC_MAX_PAGES, DOC_MAX_CHARS)
+KIND_TRANSCRIPT = "transcript"
+KIND_IMAGE = _settings_kind("image", IMAGE_MAX_EDGE, IMAGE_FORMAT, IMAGE_QUALITY)
+
+
+class MediaCacheEntry(NamedTuple):
+    payload: bytes
+    mime_type: Optional[str]
+
+
+def _hash_buffer(buffer: BinaryIO) -> str:
+    """SHA-256 содержимого буфера, буфер перематывается в начало"""
+    digest = hashlib.sha256()
+    buffer.seek(0)
+    for block in iter(lambda: buffer.read(1024 * 1024), b""):
+        digest.update(block)
+    buffer.seek(0)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    def __init__(self, db: Database, enabled: bool = MEDIA_CACHE_ENABLED,
+                 max_bytes: int = MEDIA_CACHE_MAX_BYTES, ttl: float = MEDIA_CACHE_TTL,
+                 evict_interval: float = MEDIA_CACHE_EVICT_INTERVAL):
+        self.db = db
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        # Оценка суммарного размера записей: известна после первого вытеснения,
+        # растет с каждой записью (замена записи учитывается с запасом)
+        self._total_bytes: Optional[int] = None
+        self._last_evicted = 0.0
+        self._evict_lock = asyncio.Lock()
+
+    async def get_or_compute(
+        self,
+        kind: str,
+        file_unique_id: str,
+        download: Callable[[], Awaitable[BinaryIO]],
+        compute: Callable[[BinaryIO], Awaitable[Optional[Tuple[bytes, Optional[str]]]]],
+    ) -> Optional[MediaCacheEntry]:
+        """
+        Результат обработки файла из кэша или, при промахе, скачивание и обработка
+
+        Args:
+            kind: Вид результата (KIND_DOCUMENT_TEXT, KIND_TRANSCRIPT, KIND_IMAGE)
+            file_unique_id: file_unique_id файла Telegram
+            download: Скачивание файла в буфер (буфер закрывается здесь)
+            compute: Обработка буфера -> (payload, mime_type) или None, если результата нет
+
+        Returns:
+            Запись кэша или None, если compute ничего не вернул
+        """
+        if self.enabled:
+            cached = await self.db.get_media_cache_entry(
+                kind, self._min_created_at(), file_unique_id=file_unique_id
+            )
+            if cached is not None:
+                self.hits += 1
+                await self.db.touch_media_cache_entry(file_unique_id, kind, time.time())
+                logger.info(f"Кэш медиа: попадание по file_unique_id ({kind})")
+                return MediaCacheEntry(cached["payload"], cached["mime_type"])
+
+        buffer = await download()
+        try:
+            content_hash = None
+            if self.enabled:
+                loop = asyncio.get_running_loop()
+                content_hash = await loop.run_in_executor(None, _hash_buffer, buffer)
+                cached = await self.db.get_media_cache_entry(
+                    kind, self._min_created_at(), content_hash=content_hash
+                )
+                if cached is not None:
+                    self.hits += 1
+                    # Тот же файл под другим file_unique_id — запоминаем и этот ключ
+                    await self.db.save_media_cache_entry(
+                        file_unique_id, kind, content_hash, cached["payload"], cached["mime_type"], time.time()
+                    )
+                    logger.info(f"Кэш медиа: попадание по хэшу содержимого ({kind})")
+                    return MediaCacheEntry(cached["payload"], cached["mime_type"])
+                self.misses += 1
+
+            result = await compute(buffer)
+        finally:
+            buffer.close()
+
+        if result is None:
+            return None
+        payload, mime_type = result
+        if self.enabled:
+            await self.db.save_media_cache_entry(
+                file_unique_id, kind, content_hash, payload, mime_type, time.time()
+            )
+            if self._total_bytes is not None:
+                self._total_bytes += len(payload)
+            await self._maybe_evict()
+        return MediaCacheEntry(payload, mime_type)
+
+    async def _maybe_evict(self):
+        """
+        Вытеснение только при превышении лимита размера или раз в evict_interval
+        секунд (устаревшие записи и записи других процессов): подсчет размера
+        кэша в БД не выполняется при каждой записи
+        """
+        if not self._eviction_due():
+            return
+        async with self._evict_lock:
+            # Пока ждали блокировку, вытеснение мог выполнить другой запрос
+            if not self._eviction_due():
+                return
+            removed, self._total_bytes = await self.db.evict_media_cache(
+                self.max_bytes, self._min_created_at()
+            )
+            self._last_evicted = time.monotonic()
+        if removed:
+            logger.info("Кэш медиа: удалено записей: %s", removed)
+
+    def _eviction_due(self) -> bool:
+        if self._total_bytes is None or self._total_bytes > self.max_bytes:
+            return True
+        return time.monotonic() - self._last_evicted >= self.evict_interval
+
+    def _min_created_at(self) -> float:
+        return time.time() - self.ttl
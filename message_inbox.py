@@ -0,0 +1,175 @@
+"""
+Очередь входящих сообщений пользователя. Сообщения, пришедшие подряд с короткими
+паузами, объединяются в один запрос к модели. Новая серия отменяет устаревшую
+генерацию ответа этому пользователю, а ответы одному пользователю идут по порядку.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncContextManager, Awaitable, Callable, Dict, List, Optional
+
+from aiogram.types import Message
+
+from config import MESSAGE_DEBOUNCE_SECONDS, MESSAGE_DEBOUNCE_MAX_DELAY
+from update_queue import UpdateJob
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBurst:
+    """Серия сообщений пользователя, на которую дается один ответ"""
+    __slots__ = ("messages", "jobs", "committed")
+
+    def __init__(self, messages: List[Message], jobs: List[UpdateJob]):
+        self.messages = messages
+        # Обновления из очереди, которые завершаются вместе с серией
+        self.jobs = jobs
+        # Ответ уже показан пользователю — отменять и повторять серию нельзя
+        self.committed = False
+
+    @property
+    def text(self) -> str:
+        return "\n".join(message.text or "" for message in self.messages)
+
+    @property
+    def last(self) -> Message:
+        return self.messages[-1]
+
+
+class _UserInbox:
+    __slots__ = ("pending", "pending_jobs", "first_at", "timer", "current", "current_burst")
+
+    def __init__(self):
+        self.pending: List[Message] = []
+        self.pending_jobs: List[UpdateJob] = []
+        self.first_at = 0.0
+        self.timer: Optional[asyncio.Task] = None
+        self.current: Optional[asyncio.Task] = None
+        self.current_burst: Optional[MessageBurst] = None
+
+
+class MessageInbox:
+    def __init__(self, process: Callable[[int, MessageBurst], Awaitable[None]],
+                 user_lock: Optional[Callable[[int], AsyncContextManager]] = None,
+                 debounce: float = MESSAGE_DEBOUNCE_SECONDS,
+                 max_delay: float = MESSAGE_DEBOUNCE_MAX_DELAY):
+        self.process = process
+        # Блокировка пользователя, общая для процессов бота (см. state_backend):
+        # серии одного пользователя из разных процессов обрабатываются по очереди
+        self.user_lock = user_lock
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._inboxes: Dict[int, _UserInbox] = {}
+
+    def submit(self, message: Message, job: Optional[UpdateJob] = None):
+        """
+        Принять сообщение; ответ будет дан после паузы в переписке.
+        Обновление job из очереди остается в ней, пока на серию не дан ответ
+        """
+        user_id = message.from_user.id
+        inbox = self._inboxes.get(user_id)
+        if inbox is None:
+            inbox = self._inboxes[user_id] = _UserInbox()
+        if not inbox.pending:
+            inbox.first_at = time.monotonic()
+        inbox.pending.append(message)
+        if job is not None:
+            job.hand_off()
+            inbox.pending_jobs.append(job)
+
+        current = inbox.current
+        if current is not None and not current.done() and not inbox.current_burst.committed:
+            # Ответ на предыдущую серию устарел: ее сообщения вернутся в очередь
+            logger.info(f"Пользователь {user_id}: новая серия сообщений, отменяю текущую генерацию")
+            current.cancel()
+
+        if inbox.timer is not None:
+            inbox.timer.cancel()
+        inbox.timer = asyncio.create_task(self._wait_and_start(user_id, inbox))
+
+    async def _wait_and_start(self, user_id: int, inbox: _UserInbox):
+        """Пауза в переписке, затем запуск обработки накопленной серии"""
+        delay = min(self.debounce, inbox.first_at + self.max_delay - time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Ответы одному пользователю не перемешиваются: ждем предыдущий
+        if inbox.current is not None:
+            await asyncio.wait([inbox.current])
+        inbox.timer = None
+        if not inbox.pending:
+            return
+        burst = MessageBurst(inbox.pending, inbox.pending_jobs)
+        inbox.pending = []
+        inbox.pending_jobs = []
+        inbox.current_burst = burst
+        inbox.current = asyncio.create_task(self._run(user_id, inbox, burst))
+
+    async def _run(self, user_id: int, inbox: _UserInbox, burst: MessageBurst):
+        requeued = False
+        try:
+            if len(burst.messages) > 1:
+                logger.info(f"Пользователь {user_id}: объединено сообщений: {len(burst.messages)}")
+            if self.user_lock is None:
+                await self.process(user_id, burst)
+            else:
+                async with self.user_lock(user_id):
+                    await self.process(user_id, burst)
+        except asyncio.CancelledError:
+            if not burst.committed:
+                # Серия войдет в следующую вместе с новыми сообщениями
+                inbox.pending[:0] = burst.messages
+                inbox.pending_jobs[:0] = burst.jobs
+                requeued = True
+        except Exception as e:
+            logger.error(f"Ошибка при обработке сообщений пользователя {user_id}: {str(e)}", exc_info=True)
+        finally:
+            if not requeued:
+                await _finish_jobs(burst.jobs)
+            inbox.current = None
+            inbox.current_burst = None
+            if inbox.timer is None and not inbox.pending and self._inboxes.get(user_id) is inbox:
+                del self._inboxes[user_id]
+
+    async def discard(self, user_id: int):
+        """Отменить ожидающие и текущую обработку сообщений пользователя (например, при /reset)"""
+        inbox = self._inboxes.pop(user_id, None)
+        if inbox is None:
+            return
+        jobs = inbox.pending_jobs
+        inbox.pending = []
+        inbox.pending_jobs = []
+        if inbox.timer is not None:
+            inbox.timer.cancel()
+        if inbox.current is not None:
+            jobs = jobs + inbox.current_burst.jobs
+            inbox.current.cancel()
+        await _finish_jobs(jobs)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": sum(len(inbox.pending) for inbox in self._inboxes.values()),
+            "active": sum(1 for inbox in self._inboxes.values() if inbox.current is not None),
+        }
+
+    async def close(self):
+        """Остановить ожидание новых серий и дождаться текущих ответов"""
+        timers = [inbox.timer for inbox in self._inboxes.values() if inbox.timer is not None]
+        for timer in timers:
+            timer.cancel()
+        tasks = [inbox.current for inbox in self._inboxes.values() if inbox.current is not None]
+        if timers or tasks:
+            await asyncio.gather(*timers, *tasks, return_exceptions=True)
+        dropped = sum(len(inbox.pending) for inbox in self._inboxes.values())
+        if dropped:
+            # Сообщения из очереди обновлений будут обработаны после запуска
+            logger.warning(f"При остановке не обработано сообщений: {dropped}")
+        self._inboxes.clear()
+
+
+async def _finish_jobs(jobs: List[UpdateJob]):
+    """Завершить обновления серии в очереди обновлений"""
+    for job in jobs:
+        try:
+            await job.finish()
+        except Exception as e:
+            logger.error(f"Ошибка при завершении обновления {job.id}: {str(e)}")
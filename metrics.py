@@ -0,0 +1,305 @@
+"""
+Метрики бота в формате Prometheus: длительность этапов обработки (скачивание,
+извлечение текста, подготовка изображений, Whisper, chat completion, запросы
+к БД и к Bot API), счетчики обновлений и текущие размеры очередей.
+Метки обработчика и типа содержимого берутся из контекста обновления,
+поэтому этапы не нужно подписывать вручную.
+"""
+import contextvars
+import functools
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, сек: от запросов к БД до долгих ответов модели
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Обработчик и тип содержимого текущего обновления
+_handler_label: contextvars.ContextVar[Tuple[str, str]] = contextvars.ContextVar(
+    "metrics_handler", default=("none", "none")
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счетчики корзин (не накопительные), сумма, число
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts = entry[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def totals(self, label: str) -> Dict[str, Tuple[int, float]]:
+        """Число наблюдений и их сумма по значениям одной метки"""
+        index = self.labelnames.index(label)
+        result: Dict[str, Tuple[int, float]] = {}
+        for key, (_, total, count) in self._values.items():
+            previous_count, previous_total = result.get(key[index], (0, 0.0))
+            result[key[index]] = (previous_count + count, previous_total + total)
+        return result
+
+
+REGISTRY: List[_Metric] = []
+# Функции, обновляющие показатели перед каждым чтением метрик (размеры очередей и т.п.)
+_collectors: List[Callable[[], Awaitable[None]]] = []
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_duration_seconds", "Длительность этапа обработки",
+    ("stage", "handler", "content_type"),
+)
+STAGE_ERRORS = Counter(
+    "bot_stage_errors_total", "Этапы обработки, завершившиеся ошибкой",
+    ("stage", "handler", "content_type"),
+)
+DB_SECONDS = Histogram(
+    "bot_db_query_duration_seconds", "Длительность вызова методов Database",
+    ("method", "handler"),
+)
+TELEGRAM_API_SECONDS = Histogram(
+    "bot_telegram_api_duration_seconds", "Длительность запросов к Bot API",
+    ("method", "handler"),
+)
+TELEGRAM_FLOOD_WAITS = Counter(
+    "bot_telegram_flood_waits_total", "Ответы Bot API 429 (flood wait) на отправку сообщений", ("method",),
+)
+UPDATES_TOTAL = Counter(
+    "bot_updates_total", "Обработанные сообщения по обработчику и типу содержимого",
+    ("handler", "content_type"),
+)
+HANDLER_SECONDS = Histogram(
+    "bot_handler_duration_seconds", "Длительность обработчика сообщения",
+    ("handler", "content_type"),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Необработанные исключения в обработчиках",
+    ("handler", "content_type"),
+)
+HANDLERS_IN_FLIGHT = Gauge(
+    "bot_handlers_in_flight", "Сообщения, обрабатываемые сейчас", ("handler",),
+)
+QUEUE_DEPTH = Gauge(
+    "bot_queue_depth", "Размер очереди", ("queue",),
+)
+IN_FLIGHT = Gauge(
+    "bot_in_flight", "Задачи, выполняемые сейчас", ("queue",),
+)
+STARTUP_SECONDS = Gauge(
+    "bot_startup_seconds", "Длительность этапов запуска: imports, warmup, total", ("phase",),
+)
+DB_FILE_BYTES = Gauge(
+    "bot_db_file_bytes", "Размер файла базы данных: весь файл (total) и свободные страницы (free)",
+    ("kind",),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Замер длительности этапа с метками текущего обновления"""
+    handler, content_type = _handler_label.get()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name, handler=handler, content_type=content_type)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started,
+                              stage=name, handler=handler, content_type=content_type)
+
+
+def observe_stage(name: str, seconds: float):
+    """Длительность этапа, измеренная вручную (например, до первого фрагмента потока)"""
+    handler, content_type = _handler_label.get()
+    STAGE_SECONDS.observe(seconds, stage=name, handler=handler, content_type=content_type)
+
+
+def observe_db(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Декоратор методов Database: длительность каждого вызова"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started,
+                               method=func.__name__, handler=_handler_label.get()[0])
+    return wrapper
+
+
+async def handler_middleware(handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                             event: Any, data: Dict[str, Any]) -> Any:
+    """Middleware сообщений: метки обработчика для этапов, счетчики и длительность"""
+    handler_object = data.get("handler")
+    name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+    content_type = getattr(event, "content_type", "unknown")
+    content_type = str(getattr(content_type, "value", content_type))
+    token = _handler_label.set((name, content_type))
+    HANDLERS_IN_FLIGHT.inc(handler=name)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(handler=name, content_type=content_type)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name, content_type=content_type)
+        UPDATES_TOTAL.inc(handler=name, content_type=content_type)
+        HANDLERS_IN_FLIGHT.dec(handler=name)
+        _handler_label.reset(token)
+
+
+async def telegram_api_middleware(make_request: Callable[..., Awaitable[Any]], bot: Any, method: Any) -> Any:
+    """Middleware сессии бота: длительность каждого запроса к Bot API"""
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        TELEGRAM_API_SECONDS.observe(time.perf_counter() - started,
+                                     method=type(method).__name__, handler=_handler_label.get()[0])
+
+
+def register_collector(collector: Callable[[], Awaitable[None]]):
+    """Функция, которая обновляет показатели перед каждым чтением метрик"""
+    _collectors.append(collector)
+
+
+async def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.error(f"Ошибка при сборе метрик: {str(e)}")
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=await render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """HTTP-сервер с /metrics; None, если порт занять не удалось"""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {str(e)}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на {host}:{port}/metrics")
+    return runner
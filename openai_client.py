@@ -3,29 +3,125 @@
 ВАЖНО: Использовать модель gpt-5.2 во всех запросах
 """
 import os
+import asyncio
 import base64
-from typing import List, Dict, Optional
-from openai import OpenAI
-from config import OPENAI_API_KEY, OPENAI_MODEL, SYSTEM_PROMPT
-from utils.file_utils import image_to_base64, get_image_mime_type
+import logging
+import time
+from typing import AsyncIterator, List, Dict, Optional, Union
+from httpx2 import Limits, Timeout
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from config import (
+    OPENAI_API_KEY, OPENAI_MODEL, SYSTEM_PROMPT,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_KEEPALIVE_EXPIRY, OPENAI_TIMEOUT,
+    SUMMARY_PROMPT, SUMMARY_MESSAGE_MAX_CHARS, DOC_CHUNK_PROMPT, AUDIO_SEGMENT_CONCURRENCY,
+    OPENAI_COMPLETION_TOKENS_ESTIMATE,
+)
+from request_scheduler import (
+    RequestScheduler, OverloadedError, PRIORITY_INTERACTIVE, PRIORITY_DOCUMENT, PRIORITY_BACKGROUND,
+)
+from utils.file_utils import (
+    MediaSource, PreparedImage, prepare_image_for_vision, read_media,
+)
+from utils.token_utils import estimate_messages_tokens
+from metrics import stage, observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Заголовок перед текстом документа в сообщении пользователя
+DOCUMENT_LABEL = "Содержимое документа"
 
 
 class OpenAIClient:
     def __init__(self):
-        """Инициализация клиента OpenAI"""
+        """Инициализация асинхронного клиента OpenAI с общим пулом соединений"""
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY не установлен в переменных окружения")
         
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        # Один пул keep-alive соединений на весь процесс: TLS-рукопожатие
+        # делается один раз, а не на каждый запрос
+        # Limits и Timeout — из httpx2, на котором построен SDK начиная с openai 3.0
+        self._http_client = DefaultAsyncHttpxClient(
+            limits=Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=Timeout(OPENAI_TIMEOUT, connect=10.0),
+        )
+        # Повторы выполняет планировщик, встроенные повторы SDK отключены
+        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=self._http_client, max_retries=0)
         self.model = OPENAI_MODEL  # gpt-5.2
         self.system_prompt = SYSTEM_PROMPT
+        # Очередь запросов: лимиты, приоритеты и повторы при временных ошибках
+        self.scheduler = RequestScheduler()
+
+    async def close(self):
+        """Закрытие пула HTTP-соединений"""
+        await self.client.close()
 
-    async def send_text_message(self, messages: List[Dict[str, str]]) -> str:
+    async def warm_up(self, connections: int = 1):
+        """
+        Открытие соединений пула заранее (DNS, TCP, TLS) бесплатным запросом
+        описания модели; заодно проверяются ключ API и имя модели
+        """
+        await asyncio.gather(*(self.client.models.retrieve(self.model) for _ in range(max(1, connections))))
+
+    async def _create_completion(self, messages: List[Dict], priority: int = PRIORITY_INTERACTIVE) -> str:
+        """Запрос chat completion через очередь планировщика"""
+        estimated = estimate_messages_tokens(messages) + OPENAI_COMPLETION_TOKENS_ESTIMATE
+        with stage("chat_completion"):
+            response = await self.scheduler.run(
+                lambda: self.client.chat.completions.create(
+                    model=self.model,  # gpt-5.2
+                    messages=messages,
+                    temperature=0.7
+                ),
+                priority, estimated,
+            )
+        if response.usage:
+            self.scheduler.report_usage(estimated, response.usage.total_tokens)
+        return response.choices[0].message.content
+
+    async def _stream_completion(self, messages: List[Dict],
+                                 priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        """Потоковый chat completion: отдает фрагменты ответа по мере генерации"""
+        estimated = estimate_messages_tokens(messages) + OPENAI_COMPLETION_TOKENS_ESTIMATE
+        started = time.perf_counter()
+        first_token = True
+        with stage("chat_completion"):
+            # Повтор возможен только до начала потока; слот занят, пока поток читается
+            async with self.scheduler.hold(
+                lambda: self.client.chat.completions.create(
+                    model=self.model,  # gpt-5.2
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                ),
+                priority, estimated,
+            ) as stream:
+                try:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            self.scheduler.report_usage(estimated, chunk.usage.total_tokens)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first_token:
+                                # Время до первого фрагмента — именно его ждет пользователь
+                                observe_stage("chat_first_token", time.perf_counter() - started)
+                                first_token = False
+                            yield chunk.choices[0].delta.content
+                finally:
+                    await stream.close()
+
+    async def send_text_message(self, messages: List[Dict[str, str]],
+                                priority: int = PRIORITY_INTERACTIVE) -> str:
         """
         Отправка текстового сообщения в gpt-5.2
         
         Args:
             messages: Список сообщений в формате [{"role": "user", "content": "текст"}]
+            priority: Приоритет в очереди запросов
         
         Returns:
             Ответ от модели
@@ -34,31 +130,86 @@ class OpenAIClient:
         full_messages = [{"role": "system", "content": self.system_prompt}] + messages
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,  # gpt-5.2
-                messages=full_messages,
-                temperature=0.7
-            )
-            return response.choices[0].message.content
+            return await self._create_completion(full_messages, priority)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            raise Exception(f"Ошибка при обращении к OpenAI API: {str(e)}")
+
+    async def stream_text_message(self, messages: List[Dict[str, str]],
+                                  priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        """
+        Потоковая отправка текстового сообщения в gpt-5.2
+        
+        Args:
+            messages: Список сообщений в формате [{"role": "user", "content": "текст"}]
+            priority: Приоритет в очереди запросов
+        
+        Yields:
+            Фрагменты ответа модели
+        """
+        full_messages = [{"role": "system", "content": self.system_prompt}] + messages
+        
+        try:
+            async for delta in self._stream_completion(full_messages, priority):
+                yield delta
+        except OverloadedError:
+            raise
         except Exception as e:
             raise Exception(f"Ошибка при обращении к OpenAI API: {str(e)}")
 
-    async def send_image_message(self, image_path: str, user_message: str, 
+    async def send_image_message(self, image: Union[MediaSource, PreparedImage], user_message: str, 
                                 conversation_history: Optional[List[Dict]] = None) -> str:
         """
         Отправка изображения с текстом в gpt-5.2 (vision)
         
         Args:
-            image_path: Путь к изображению
+            image: Путь к изображению, его байты, буфер или уже подготовленное изображение
             user_message: Текстовое сообщение пользователя
             conversation_history: История диалога (опционально)
         
         Returns:
             Ответ от модели
         """
-        # Конвертируем изображение в base64
-        base64_image = await image_to_base64(image_path)
-        mime_type = get_image_mime_type(image_path)
+        messages = await self._build_image_messages(image, user_message, conversation_history)
+        
+        try:
+            return await self._create_completion(messages)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            logger.error("Ошибка при обращении к OpenAI Vision API: %s", e, exc_info=True)
+            raise Exception(f"Ошибка при обращении к OpenAI Vision API: {str(e)}")
+
+    async def stream_image_message(self, image: Union[MediaSource, PreparedImage], user_message: str,
+                                   conversation_history: Optional[List[Dict]] = None) -> AsyncIterator[str]:
+        """
+        Потоковая отправка изображения с текстом в gpt-5.2 (vision)
+        
+        Args:
+            image: Путь к изображению, его байты, буфер или уже подготовленное изображение
+            user_message: Текстовое сообщение пользователя
+            conversation_history: История диалога (опционально)
+        
+        Yields:
+            Фрагменты ответа модели
+        """
+        messages = await self._build_image_messages(image, user_message, conversation_history)
+        
+        try:
+            async for delta in self._stream_completion(messages):
+                yield delta
+        except OverloadedError:
+            raise
+        except Exception as e:
+            logger.error("Ошибка при обращении к OpenAI Vision API: %s", e, exc_info=True)
+            raise Exception(f"Ошибка при обращении к OpenAI Vision API: {str(e)}")
+
+    async def _build_image_messages(self, image: Union[MediaSource, PreparedImage], user_message: str,
+                                    conversation_history: Optional[List[Dict]]) -> List[Dict]:
+        """Системный промпт, история и сообщение с изображением"""
+        # Уменьшаем, перекодируем без метаданных и конвертируем в base64
+        base64_image, mime_type = await prepare_image_for_vision(image)
         
         # Формируем сообщение с изображением
         image_message = {
@@ -82,97 +233,122 @@ class OpenAIClient:
         if conversation_history:
             messages.extend(conversation_history)
         messages.append(image_message)
-        
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,  # gpt-5.2
-                messages=messages,
-                temperature=0.7
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            logger.error(f"Ошибка при обращении к OpenAI Vision API: {str(e)}\n{error_details}")
-            raise Exception(f"Ошибка при обращении к OpenAI Vision API: {str(e)}")
+        return messages
 
-    def _transcribe_file_sync(self, audio_path: str) -> str:
-        """Синхронный вызов Whisper API по пути к файлу."""
-        with open(audio_path, "rb") as audio_file:
-            transcript = self.client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
+    async def _transcribe_file(self, audio: MediaSource, file_name: str) -> str:
+        """Асинхронный вызов Whisper API; имя файла нужно API для определения формата."""
+        audio_data = await read_media(audio)
+        # Whisper тарифицируется не по токенам — в очереди учитывается только как запрос
+        with stage("whisper"):
+            transcript = await self.scheduler.run(
+                lambda: self.client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(file_name, audio_data),
+                ),
+                PRIORITY_INTERACTIVE, 0,
             )
         return transcript.text or ""
 
-    async def transcribe_audio(self, audio_path: str) -> str:
+    async def transcribe_audio(self, audio: MediaSource, file_name: Optional[str] = None,
+                               duration: Optional[float] = None,
+                               segmented: Optional[bool] = None) -> str:
         """
         Транскрипция через Whisper API.
-        Сначала пробуем OGG (Telegram). При ошибке формата — конвертируем в MP3 через ffmpeg и повторяем.
+        Формат определяется до отправки: то, что Whisper не примет, заранее
+        перекладывается или перекодируется через ffmpeg — файл загружается один раз.
+        Длинные записи режутся на части по паузам и транскрибируются параллельно.
+        
+        Args:
+            audio: Путь к аудио файлу, его байты или буфер
+            file_name: Имя файла (по умолчанию — имя из пути или voice.ogg)
+            duration: Длительность записи в секундах, если известна (из Telegram)
+            segmented: Резать ли на части; None — решить по размеру и длительности
         """
-        import logging
-        import asyncio
-        from utils.audio_utils import convert_ogg_to_mp3_ffmpeg
+        from utils.audio_utils import prepare_audio_for_whisper, should_segment_audio
 
-        log = logging.getLogger(__name__)
-        if not os.path.exists(audio_path):
-            raise Exception(f"Файл не найден: {audio_path}")
-        size = os.path.getsize(audio_path)
-        log.info("Whisper: отправляю %s (%s байт)", audio_path, size)
+        if isinstance(audio, str):
+            if not os.path.exists(audio):
+                raise Exception(f"Файл не найден: {audio}")
+            file_name = file_name or os.path.basename(audio)
+        else:
+            file_name = file_name or "voice.ogg"
 
-        loop = asyncio.get_event_loop()
         try:
-            text = await loop.run_in_executor(None, self._transcribe_file_sync, audio_path)
-            log.info("Whisper вернул: %s", (text[:80] + "...") if len(text) > 80 else text)
+            audio_data = await read_media(audio)
+            if segmented is None:
+                segmented = should_segment_audio(len(audio_data), duration)
+            if segmented:
+                return await self._transcribe_segmented(audio_data)
+
+            with stage("audio_transcode"):
+                audio_data, file_name = await prepare_audio_for_whisper(audio_data, file_name)
+            logger.info("Whisper: отправляю %s (%s байт)", file_name, len(audio_data))
+            text = await self._transcribe_file(audio_data, file_name)
+            logger.info("Whisper вернул: %s", (text[:80] + "...") if len(text) > 80 else text)
             return text
+        except OverloadedError:
+            raise
         except Exception as e:
-            err = str(e).lower()
-            # Формат не подходит — конвертируем OGG → MP3 и повторяем
-            if "format" in err or "ogg" in err or "unsupported" in err or "file type" in err:
-                log.info("Whisper не принял OGG, конвертирую в MP3 через ffmpeg...")
-                try:
-                    mp3_path = await convert_ogg_to_mp3_ffmpeg(audio_path)
-                    try:
-                        text = await loop.run_in_executor(None, self._transcribe_file_sync, mp3_path)
-                        log.info("Whisper (после MP3) вернул: %s", (text[:80] + "...") if len(text) > 80 else text)
-                        return text
-                    finally:
-                        if mp3_path != audio_path and os.path.exists(mp3_path):
-                            try:
-                                os.remove(mp3_path)
-                            except OSError:
-                                pass
-                except Exception as conv_e:
-                    log.exception("Конвертация или повторная транскрипция: %s", conv_e)
-                    raise Exception(f"Транскрипция не удалась: {conv_e}")
-            log.exception("Whisper API ошибка")
+            logger.exception("Whisper API ошибка")
             raise Exception(f"Ошибка при транскрипции аудио: {str(e)}")
 
-    async def process_voice_message(self, audio_path: str, 
-                                    conversation_history: Optional[List[Dict]] = None) -> str:
+    async def _transcribe_segmented(self, audio_data: bytes) -> str:
+        """Транскрипция длинной записи по частям: части идут в Whisper параллельно, текст склеивается по порядку"""
+        from utils.audio_utils import (
+            compact_audio_with_silences, plan_audio_segments, cut_audio_segment, merge_transcripts,
+        )
+
+        with stage("audio_transcode"):
+            compact, silences, duration = await compact_audio_with_silences(audio_data)
+        segments = plan_audio_segments(duration, silences)
+        logger.info("Whisper: запись %.0f с, пауз %s, частей %s", duration, len(silences), len(segments))
+        if len(segments) == 1:
+            return await self._transcribe_file(compact, "audio.mp3")
+
+        semaphore = asyncio.Semaphore(AUDIO_SEGMENT_CONCURRENCY)
+
+        async def transcribe_segment(index: int, segment) -> str:
+            async with semaphore:
+                chunk = await cut_audio_segment(compact, segment)
+                return await self._transcribe_file(chunk, f"segment_{index}.mp3")
+
+        texts = await asyncio.gather(*(transcribe_segment(index, segment)
+                                       for index, segment in enumerate(segments)))
+        return merge_transcripts(texts)
+
+    async def process_voice_message(self, audio: MediaSource, 
+                                    conversation_history: Optional[List[Dict]] = None,
+                                    file_name: Optional[str] = None) -> str:
         """
         Обработка голосового сообщения: транскрипция + отправка в gpt-5.2
         
         Args:
-            audio_path: Путь к аудио файлу
+            audio: Путь к аудио файлу, его байты или буфер
             conversation_history: История диалога (опционально)
+            file_name: Имя файла для определения формата (опционально)
         
         Returns:
             Ответ от модели
         """
         # Сначала транскрибируем аудио
-        transcribed_text = await self.transcribe_audio(audio_path)
+        transcribed_text = await self.transcribe_audio(audio, file_name)
         
         # Затем отправляем транскрипцию в gpt-5.2
+        return await self.send_text_message(self.build_voice_messages(transcribed_text, conversation_history))
+
+    @staticmethod
+    def build_voice_messages(transcribed_text: str,
+                             conversation_history: Optional[List[Dict]] = None) -> List[Dict]:
+        """История и сообщение с транскрипцией голосового"""
         messages = []
         if conversation_history:
             messages.extend(conversation_history)
         messages.append({"role": "user", "content": f"[Голосовое сообщение]: {transcribed_text}"})
-        
-        return await self.send_text_message(messages)
+        return messages
 
     async def process_document(self, document_text: str, user_message: str = "",
-                             conversation_history: Optional[List[Dict]] = None) -> str:
+                             conversation_history: Optional[List[Dict]] = None,
+                             label: str = DOCUMENT_LABEL) -> str:
         """
         Обработка документа: извлеченный текст отправляется в gpt-5.2
         
@@ -180,16 +356,100 @@ class OpenAIClient:
             document_text: Текст из документа
             user_message: Дополнительное сообщение пользователя
             conversation_history: История диалога (опционально)
+            label: Заголовок перед текстом документа
         
         Returns:
             Ответ от модели
         """
+        return await self.send_text_message(
+            self.build_document_messages(document_text, user_message, conversation_history, label),
+            PRIORITY_DOCUMENT,
+        )
+
+    async def stream_document(self, document_text: str, user_message: str = "",
+                              conversation_history: Optional[List[Dict]] = None,
+                              label: str = DOCUMENT_LABEL) -> AsyncIterator[str]:
+        """
+        Потоковая обработка документа: извлеченный текст отправляется в gpt-5.2
+        
+        Args:
+            document_text: Текст из документа
+            user_message: Дополнительное сообщение пользователя
+            conversation_history: История диалога (опционально)
+            label: Заголовок перед текстом документа
+        
+        Yields:
+            Фрагменты ответа модели
+        """
+        messages = self.build_document_messages(document_text, user_message, conversation_history, label)
+        async for delta in self.stream_text_message(messages, PRIORITY_DOCUMENT):
+            yield delta
+
+    @staticmethod
+    def build_document_messages(document_text: str, user_message: str = "",
+                                conversation_history: Optional[List[Dict]] = None,
+                                label: str = DOCUMENT_LABEL) -> List[Dict]:
+        """История и сообщение с текстом документа"""
         # Формируем сообщение с текстом документа
-        content = f"{user_message}\n\n[Содержимое документа]:\n{document_text}" if user_message else f"[Содержимое документа]:\n{document_text}"
+        content = f"{user_message}\n\n[{label}]:\n{document_text}" if user_message else f"[{label}]:\n{document_text}"
         
         messages = []
         if conversation_history:
             messages.extend(conversation_history)
         messages.append({"role": "user", "content": content})
+        return messages
+
+    async def summarize_conversation(self, previous_summary: str,
+                                     messages: List[Dict[str, str]]) -> str:
+        """
+        Пополнение краткого содержания диалога новыми сообщениями
+        
+        Args:
+            previous_summary: Текущее краткое содержание (может быть пустым)
+            messages: Сообщения, которые нужно добавить в содержание
+        
+        Returns:
+            Обновленное краткое содержание
+        """
+        dialog = "\n".join(
+            f"{'Пользователь' if m['role'] == 'user' else 'Помощник'}: {m['content'][:SUMMARY_MESSAGE_MAX_CHARS]}"
+            for m in messages
+        )
+        prompt = (
+            f"Текущее краткое содержание:\n{previous_summary or '(пусто)'}\n\n"
+            f"Новые сообщения:\n{dialog}"
+        )
+        summary_messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+        try:
+            return await self._create_completion(summary_messages, PRIORITY_BACKGROUND)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            raise Exception(f"Ошибка при сжатии истории диалога: {str(e)}")
+
+    async def summarize_document_chunk(self, chunk: str, index: int, total: int) -> str:
+        """
+        Сводка одной части большого документа (этап map).
+        Не зависит от вопроса пользователя, поэтому ее можно переиспользовать.
+        
+        Args:
+            chunk: Текст части
+            index: Номер части (с 1)
+            total: Общее число частей
         
-        return await self.send_text_message(messages)
+        Returns:
+            Сводка части
+        """
+        messages = [
+            {"role": "system", "content": DOC_CHUNK_PROMPT},
+            {"role": "user", "content": f"Часть {index} из {total}:\n{chunk}"},
+        ]
+        try:
+            return await self._create_completion(messages, PRIORITY_BACKGROUND)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            raise Exception(f"Ошибка при обработке части документа: {str(e)}")
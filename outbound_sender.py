@@ -0,0 +1,158 @@
+"""
+Отправка сообщений в Telegram с соблюдением лимитов Bot API: не больше
+TELEGRAM_SEND_RATE сообщений в секунду на бота и около одного сообщения в секунду
+в личном чате (в группах — TELEGRAM_GROUP_SEND_RATE_PER_MINUTE в минуту), с
+небольшим запасом на серию сообщений подряд; редактирования учитываются только
+в общем лимите. Работает как middleware сессии бота, поэтому через него проходят
+все отправки и редактирования сообщений. Сообщения одного чата уходят строго
+по очереди; после ответа 429 (flood wait) отправка повторяется через паузу,
+которую назвал Telegram, — под нагрузкой ответы приходят чуть позже, а не теряются.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (
+    TELEGRAM_SEND_RATE, TELEGRAM_CHAT_SEND_RATE, TELEGRAM_CHAT_SEND_BURST,
+    TELEGRAM_GROUP_SEND_RATE_PER_MINUTE, TELEGRAM_SEND_MAX_RETRIES,
+)
+from metrics import TELEGRAM_FLOOD_WAITS, observe_stage
+from request_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Методы Bot API, которые отправляют или меняют сообщения, — на них действуют лимиты
+_LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+_UNLIMITED_METHODS = {"SendChatAction"}
+# Редактирования не расходуют лимит чата (его задает интервал обновления потокового
+# ответа), но идут в общей очереди чата и учитывают паузу после flood wait
+_EDIT_PREFIX = "Edit"
+# Когда чатов больше, простаивающие удаляются из памяти
+_MAX_IDLE_CHATS = 10000
+
+ChatId = Union[int, str]
+
+
+class _ChatState:
+    __slots__ = ("bucket", "lock", "paused_until", "users")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # Блокировка держится до ответа Bot API: сообщения чата не обгоняют друг друга
+        self.lock = asyncio.Lock()
+        # После flood wait отправка в чат возобновится не раньше этого момента
+        self.paused_until = 0.0
+        # Отправки, которые ждут или выполняются
+        self.users = 0
+
+
+async def _take(bucket: Optional[TokenBucket], paused_until: float = 0.0):
+    """Дождаться единицы в ведре (и конца паузы после flood wait) и занять ее"""
+    while True:
+        now = time.monotonic()
+        delay = paused_until - now
+        if bucket is not None:
+            delay = max(delay, bucket.wait_time(1, now))
+        if delay <= 0:
+            if bucket is not None:
+                bucket.consume(1, now)
+            return
+        await asyncio.sleep(delay)
+
+
+class OutboundSender:
+    def __init__(self, rate: float = TELEGRAM_SEND_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_SEND_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_SEND_BURST,
+                 group_rate_per_minute: float = TELEGRAM_GROUP_SEND_RATE_PER_MINUTE,
+                 max_retries: int = TELEGRAM_SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = max(1, chat_burst)
+        self.group_rate_per_minute = group_rate_per_minute
+        self.max_retries = max_retries
+        # Общий лимит бота: запас — одна секунда
+        self._global = TokenBucket(rate * 60, burst=max(1.0, rate))
+        # Очередь к общему лимиту — в порядке поступления
+        self._global_lock = asyncio.Lock()
+        self._chats: Dict[ChatId, _ChatState] = {}
+        self.pending = 0
+        self.sent = 0
+        self.flood_waits = 0
+
+    def _chat(self, chat_id: ChatId) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            if len(self._chats) >= _MAX_IDLE_CHATS:
+                self._prune()
+            # Отрицательный ID или @username — группа или канал
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate_per_minute, burst=1)
+            else:
+                bucket = TokenBucket(self.chat_rate * 60, burst=self.chat_burst)
+            state = self._chats[chat_id] = _ChatState(bucket)
+        return state
+
+    def _prune(self):
+        """Удалить чаты без отправок, у которых ведро уже полное"""
+        now = time.monotonic()
+        for chat_id, state in list(self._chats.items()):
+            if (state.users == 0 and state.paused_until <= now
+                    and state.bucket.wait_time(state.bucket.capacity, now) == 0):
+                del self._chats[chat_id]
+
+    async def __call__(self, make_request: Callable[..., Awaitable[Any]], bot: Any, method: Any) -> Any:
+        """Middleware сессии бота"""
+        name = type(method).__name__
+        if not name.startswith(_LIMITED_PREFIXES) or name in _UNLIMITED_METHODS:
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        # Редактирование inline-сообщения — без чата, только общий лимит
+        state = self._chat(chat_id) if chat_id is not None else None
+        self.pending += 1
+        if state is not None:
+            state.users += 1
+        try:
+            if state is None:
+                return await self._send(make_request, bot, method, None)
+            async with state.lock:
+                return await self._send(make_request, bot, method, state)
+        finally:
+            self.pending -= 1
+            if state is not None:
+                state.users -= 1
+
+    async def _send(self, make_request: Callable[..., Awaitable[Any]], bot: Any, method: Any,
+                    state: Optional[_ChatState]) -> Any:
+        queued = time.monotonic()
+        edit = type(method).__name__.startswith(_EDIT_PREFIX)
+        attempt = 0
+        while True:
+            if state is not None:
+                await _take(None if edit else state.bucket, state.paused_until)
+            async with self._global_lock:
+                await _take(self._global)
+            if attempt == 0:
+                observe_stage("telegram_send_wait", time.monotonic() - queued)
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                TELEGRAM_FLOOD_WAITS.inc(method=type(method).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning("Telegram просит подождать %s с перед %s (повтор %s из %s)",
+                               e.retry_after, type(method).__name__, attempt, self.max_retries)
+                if state is not None:
+                    state.paused_until = time.monotonic() + e.retry_after
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": self.pending, "sent": self.sent,
+                "flood_waits": self.flood_waits, "chats": len(self._chats)}
@@ -0,0 +1,60 @@
+"""
+Кэш профилей пользователей (рост, вес, предпочтения): интерфейс и реализация
+в памяти процесса (общая для нескольких процессов реализация — в state_backend).
+Запись сквозная: Database обновляет кэш сразу после сохранения профиля.
+Отсутствие профиля тоже кэшируется, чтобы не ходить в БД на каждом сообщении.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class ProfileCacheBackend:
+    async def get(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        """(есть ли запись в кэше, профиль или None, если профиля нет)"""
+        raise NotImplementedError
+
+    async def set(self, user_id: int, profile: Optional[Dict]):
+        """Профиль после записи в БД — заменяет запись кэша"""
+        raise NotImplementedError
+
+    async def add(self, user_id: int, profile: Optional[Dict]):
+        """
+        Профиль, прочитанный из БД, — только если записи в кэше еще нет:
+        чтение, начатое до сохранения профиля, не затрет новые данные
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class ProfileCache(ProfileCacheBackend):
+    """LRU-кэш профилей не больше чем для max_users пользователей"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max(1, max_users)
+        self._entries: "OrderedDict[int, Optional[Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        if user_id not in self._entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        profile = self._entries[user_id]
+        return True, dict(profile) if profile is not None else None
+
+    async def set(self, user_id: int, profile: Optional[Dict]):
+        self._entries[user_id] = profile
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    async def add(self, user_id: int, profile: Optional[Dict]):
+        if user_id not in self._entries:
+            await self.set(user_id, profile)
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,305 @@
+"""
+Планировщик запросов к OpenAI: лимиты запросов и токенов в минуту (token bucket),
+очередь с приоритетами, повторы с экспоненциальной задержкой и случайным
+разбросом, с учетом Retry-After. Если ожидание в очереди заведомо превысит
+допустимое, запрос сразу отклоняется, а пользователь получает понятный ответ.
+"""
+import asyncio
+import email.utils
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from openai import APIConnectionError, APIStatusError, RateLimitError
+
+from config import (
+    OPENAI_MAX_CONCURRENT_REQUESTS, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT,
+    OPENAI_MAX_RETRIES, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY,
+    OPENAI_QUEUE_MAX_WAIT, OPENAI_BACKGROUND_QUEUE_MAX_WAIT,
+)
+from metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Приоритеты: меньше — раньше
+PRIORITY_INTERACTIVE = 0  # ответы на сообщения, изображения и голосовые
+PRIORITY_DOCUMENT = 1     # ответы на документы
+PRIORITY_BACKGROUND = 2   # сжатие истории диалога, сводки частей документов
+
+OVERLOADED_MESSAGE = "Сейчас слишком много запросов. Пожалуйста, повторите через минуту."
+
+
+class OverloadedError(Exception):
+    """Запрос не принят: очередь к API слишком длинная или исчерпан лимит"""
+
+
+class TokenBucket:
+    """
+    Ведро токенов, пополняемое равномерно: per_minute единиц в минуту (0 — без ограничения).
+    Вмещает burst единиц (по умолчанию — минутный запас)
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.capacity = burst if burst is not None and per_minute else per_minute
+        self.rate = per_minute / 60
+        self.level = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Через сколько секунд в ведре будет amount единиц"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float, now: float):
+        if self.capacity:
+            self._refill(now)
+            self.level -= amount
+
+    def adjust(self, delta: float):
+        """Поправка после запроса: вернуть неизрасходованное или списать перерасход"""
+        if self.capacity:
+            self.level = min(self.capacity, self.level + delta)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "future")
+
+    def __init__(self, priority: int, seq: int, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Пауза из заголовков Retry-After / retry-after-ms ответа API, сек"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_quota_error(error: Exception) -> bool:
+    # 429 из-за исчерпанной квоты аккаунта повторять бесполезно
+    return isinstance(error, RateLimitError) and getattr(error, "code", None) == "insufficient_quota"
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrent: int = OPENAI_MAX_CONCURRENT_REQUESTS,
+                 rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT,
+                 max_retries: int = OPENAI_MAX_RETRIES,
+                 base_delay: float = OPENAI_RETRY_BASE_DELAY,
+                 max_delay: float = OPENAI_RETRY_MAX_DELAY,
+                 max_wait: float = OPENAI_QUEUE_MAX_WAIT,
+                 background_max_wait: float = OPENAI_BACKGROUND_QUEUE_MAX_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.background_max_wait = background_max_wait
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._active = 0
+        # После 429 новые запросы не отправляются до этого момента
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.rejected = 0
+        self.retries = 0
+
+    def _max_wait(self, priority: int) -> float:
+        return self.max_wait if priority == PRIORITY_INTERACTIVE else self.background_max_wait
+
+    def _estimate_wait(self, priority: int, tokens: int, now: float) -> float:
+        """Оценка ожидания в очереди: запросы не ниже по приоритету и лимиты в минуту"""
+        ahead = [waiter for waiter in self._queue
+                 if not waiter.future.done() and waiter.priority <= priority]
+        return max(
+            self._paused_until - now,
+            self._requests.wait_time(len(ahead) + 1, now),
+            self._tokens.wait_time(sum(waiter.tokens for waiter in ahead) + tokens, now),
+        )
+
+    async def acquire(self, priority: int, tokens: int):
+        """
+        Занять слот для запроса к API
+
+        Args:
+            priority: Приоритет (PRIORITY_*)
+            tokens: Оценка токенов запроса вместе с ответом
+
+        Raises:
+            OverloadedError: Ожидание превысило бы допустимое для этого приоритета
+        """
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        max_wait = self._max_wait(priority)
+        estimate = self._estimate_wait(priority, tokens, now)
+        if estimate > max_wait:
+            self.rejected += 1
+            raise OverloadedError(f"ожидание в очереди к API около {estimate:.0f} с")
+
+        waiter = _Waiter(priority, next(self._seq), tokens, loop.create_future())
+        heapq.heappush(self._queue, waiter)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(waiter.future, max_wait)
+            observe_stage("openai_queue_wait", time.monotonic() - now)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдан одновременно с истечением ожидания
+                return
+            self.rejected += 1
+            self._dispatch()
+            raise OverloadedError(f"запрос ждал в очереди к API дольше {max_wait:.0f} с")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдан в момент отмены — возвращаем его
+                self.release()
+            else:
+                self._dispatch()
+            raise
+
+    def release(self):
+        """Освободить слот после завершения запроса"""
+        self._active -= 1
+        self._dispatch()
+
+    def report_usage(self, estimated: int, used: int):
+        """Поправить бюджет токенов по фактическому расходу из ответа API"""
+        self._tokens.adjust(estimated - used)
+
+    def _dispatch(self):
+        """Выдать слоты ожидающим по порядку приоритета, пока позволяют лимиты"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while self._queue:
+            head = self._queue[0]
+            if head.future.done():
+                # Ожидание отменено или истекло
+                heapq.heappop(self._queue)
+                continue
+            if self._active >= self.max_concurrent:
+                return
+            # Запрос больше всего ведра ждет полного ведра, иначе он не прошел бы никогда
+            tokens = min(head.tokens, self._tokens.capacity) if self._tokens.capacity else head.tokens
+            wait = max(
+                self._paused_until - now,
+                self._requests.wait_time(1, now),
+                self._tokens.wait_time(tokens, now),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self._active += 1
+            self._requests.consume(1, now)
+            self._tokens.consume(head.tokens, now)
+            head.future.set_result(None)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Пауза перед повтором или None, если ошибку повторять не нужно"""
+        if attempt >= self.max_retries or _is_quota_error(error):
+            return None
+        if isinstance(error, APIStatusError):
+            if error.status_code not in (408, 409, 429) and error.status_code < 500:
+                return None
+        elif not isinstance(error, APIConnectionError):
+            return None
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        # Экспоненциальная задержка с полным случайным разбросом
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _call(self, call: Callable[[], Awaitable[T]], priority: int, tokens: int) -> T:
+        """Выполнение запроса с повторами; при успехе слот остается занятым"""
+        attempt = 0
+        while True:
+            await self.acquire(priority, tokens)
+            try:
+                return await call()
+            except Exception as e:
+                self.release()
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    if isinstance(e, RateLimitError) and not _is_quota_error(e):
+                        raise OverloadedError(f"превышен лимит запросов к API: {str(e)}") from e
+                    raise
+                if isinstance(e, RateLimitError):
+                    # Лимит общий на всех: притормаживаем всю очередь
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.retries += 1
+                attempt += 1
+                logger.warning(f"Запрос к OpenAI не удался ({type(e).__name__}), "
+                               f"повтор {attempt}/{self.max_retries} через {delay:.1f} с")
+            except BaseException:
+                self.release()
+                raise
+            await asyncio.sleep(delay)
+
+    async def run(self, call: Callable[[], Awaitable[T]], priority: int, tokens: int) -> T:
+        """
+        Выполнить запрос к API через очередь, с повторами при временных ошибках
+
+        Args:
+            call: Функция, выполняющая запрос
+            priority: Приоритет (PRIORITY_*)
+            tokens: Оценка токенов запроса вместе с ответом
+        """
+        result = await self._call(call, priority, tokens)
+        self.release()
+        return result
+
+    @asynccontextmanager
+    async def hold(self, call: Callable[[], Awaitable[T]], priority: int, tokens: int) -> AsyncIterator[T]:
+        """Как run, но слот держится до выхода из блока with — для потоковых ответов"""
+        result = await self._call(call, priority, tokens)
+        try:
+            yield result
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": sum(1 for waiter in self._queue if not waiter.future.done()),
+            "active": self._active,
+            "rejected": self.rejected,
+            "retries": self.retries,
+        }
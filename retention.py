@@ -0,0 +1,112 @@
+"""
+Обслуживание истории диалогов: старые сообщения переносятся в архивную таблицу,
+устаревшие записи архива удаляются, а освободившееся место возвращается файловой
+системе через incremental vacuum. Рабочая таблица остается небольшой, поэтому
+чтение истории не замедляется с ростом общего числа сообщений. Заодно удаляются
+сводки частей документов старше срока жизни кэша медиа.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from config import (
+    CONVERSATION_RETENTION_DAYS, CONVERSATION_KEEP_MESSAGES, CONVERSATION_ARCHIVE_DAYS,
+    MAX_CONTEXT_MESSAGES, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, RETENTION_VACUUM_PAGES,
+    DB_INCREMENTAL_VACUUM, MEDIA_CACHE_TTL,
+)
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryRetention:
+    def __init__(self, db: Database,
+                 retention_days: int = CONVERSATION_RETENTION_DAYS,
+                 keep_messages: int = CONVERSATION_KEEP_MESSAGES,
+                 archive_days: int = CONVERSATION_ARCHIVE_DAYS,
+                 interval: float = RETENTION_INTERVAL,
+                 batch_size: int = RETENTION_BATCH_SIZE,
+                 vacuum_pages: int = RETENTION_VACUUM_PAGES,
+                 vacuum: bool = DB_INCREMENTAL_VACUUM,
+                 document_chunks_ttl: float = MEDIA_CACHE_TTL):
+        self.db = db
+        self.retention_days = retention_days
+        # Окно контекста всегда остается в рабочей таблице
+        self.keep_messages = max(keep_messages, MAX_CONTEXT_MESSAGES)
+        self.archive_days = archive_days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.vacuum_pages = vacuum_pages
+        self.vacuum = vacuum
+        self.document_chunks_ttl = document_chunks_ttl
+        self._task: Optional[asyncio.Task] = None
+        self.archived = 0
+        self.purged = 0
+        self.expired_chunks = 0
+        self.vacuumed_pages = 0
+
+    def start(self):
+        """Запуск периодического обслуживания (первый проход — сразу)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка при обслуживании истории диалогов: {str(e)}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Dict[str, int]:
+        """
+        Один проход: архивирование, очистка архива и сводок частей документов,
+        возврат места. Возвращает счетчики прохода
+        """
+        archived = purged = expired = 0
+        if self.retention_days > 0:
+            after_id: Optional[int] = 0
+            while after_id is not None:
+                count, after_id = await self.db.archive_conversations(
+                    self.retention_days, self.keep_messages, after_id, self.batch_size
+                )
+                archived += count
+                # Между пачками даем выполниться другим записям в БД
+                await asyncio.sleep(0)
+        if self.archive_days > 0:
+            while True:
+                count = await self.db.purge_conversation_archive(self.archive_days, self.batch_size)
+                purged += count
+                if count < self.batch_size:
+                    break
+                await asyncio.sleep(0)
+        if self.document_chunks_ttl > 0:
+            expired = await self.db.evict_document_chunks(time.time() - self.document_chunks_ttl)
+        vacuumed = 0
+        if self.vacuum:
+            vacuumed = await self.db.incremental_vacuum(self.vacuum_pages)
+
+        self.archived += archived
+        self.purged += purged
+        self.expired_chunks += expired
+        self.vacuumed_pages += vacuumed
+        if archived or purged or expired or vacuumed:
+            logger.info(f"Обслуживание истории: в архив {archived}, удалено из архива {purged}, "
+                        f"удалено сводок документов {expired}, освобождено страниц {vacuumed}")
+        return {"archived": archived, "purged": purged, "expired_chunks": expired,
+                "vacuumed_pages": vacuumed}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "archived": self.archived,
+            "purged": self.purged,
+            "expired_chunks": self.expired_chunks,
+            "vacuumed_pages": self.vacuumed_pages,
+        }
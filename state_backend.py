@@ -0,0 +1,282 @@
+"""
+Общее состояние бота: кэш окон истории, кэш профилей, хранилище FSM и блокировки пользователей.
+memory — все в памяти процесса (один процесс бота).
+redis — состояние в Redis, чтобы несколько процессов бота обслуживали
+одних и тех же пользователей. Сама история хранится в SQLite: файл в режиме WAL
+безопасно используется несколькими процессами на одной машине.
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import (
+    STATE_BACKEND, REDIS_URL, REDIS_KEY_PREFIX, HISTORY_CACHE_TTL, USER_LOCK_TIMEOUT,
+    MAX_CONTEXT_MESSAGES, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES,
+    PROFILE_CACHE_MAX_USERS, PROFILE_CACHE_TTL,
+)
+from history_cache import HistoryCache, HistoryCacheBackend, HistoryMessage
+from profile_cache import ProfileCache, ProfileCacheBackend
+
+logger = logging.getLogger(__name__)
+
+# Скрипты Lua выполняются в Redis атомарно, без гонок между процессами.
+# KEYS: окно (список), признак загруженного окна, версия истории пользователя
+
+# Новое сообщение: версия растет всегда (идущие загрузки устаревают),
+# окно дополняется, только если оно уже загружено
+_APPEND_SCRIPT = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+"""
+
+# Загруженное из БД окно сохраняется, только если версия не изменилась с начала загрузки
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 2 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('SET', KEYS[2], '1', 'EX', ARGV[2])
+return 1
+"""
+
+# nil — окно не загружено; иначе последние ARGV[1] сообщений (возможно, ни одного)
+_GET_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return false
+end
+return redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+"""
+
+# id сообщений после отложенной записи в БД. ARGV — пары (запись без id, запись с id)
+# в порядке сохранения; записи окна идут в том же порядке, начало пачки могло
+# уже выйти из окна
+_ASSIGN_IDS_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+local pairs_count = #ARGV / 2
+local next_pair = 1
+for index, item in ipairs(items) do
+    if next_pair > pairs_count then
+        break
+    end
+    for pair = next_pair, pairs_count do
+        if item == ARGV[2 * pair - 1] then
+            redis.call('LSET', KEYS[1], index - 1, ARGV[2 * pair])
+            next_pair = pair + 1
+            break
+        end
+    end
+end
+"""
+
+# Очистка истории: запоминаем пустое окно
+_CLEAR_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('SET', KEYS[2], '1', 'EX', ARGV[1])
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+"""
+
+
+def _dump_message(message: HistoryMessage) -> str:
+    return json.dumps([message.id, message.role, message.content], ensure_ascii=False)
+
+
+def _load_message(raw: Any) -> HistoryMessage:
+    message_id, role, content = json.loads(raw)
+    return HistoryMessage(message_id, role, content)
+
+
+class RedisHistoryCache(HistoryCacheBackend):
+    """Окна истории в Redis, общие для всех процессов бота"""
+
+    def __init__(self, redis, window: int = MAX_CONTEXT_MESSAGES, ttl: int = HISTORY_CACHE_TTL,
+                 prefix: str = REDIS_KEY_PREFIX):
+        self.redis = redis
+        self.window = window
+        self.ttl = ttl
+        self.prefix = prefix
+        self._append = redis.register_script(_APPEND_SCRIPT)
+        self._store = redis.register_script(_STORE_SCRIPT)
+        self._get = redis.register_script(_GET_SCRIPT)
+        self._clear = redis.register_script(_CLEAR_SCRIPT)
+        self._assign_ids = redis.register_script(_ASSIGN_IDS_SCRIPT)
+        self.hits = 0
+        self.misses = 0
+
+    def _keys(self, user_id: int) -> List[str]:
+        base = f"{self.prefix}:history:{user_id}"
+        return [base, f"{base}:loaded", f"{base}:version"]
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[HistoryMessage]]:
+        if limit > self.window:
+            self.misses += 1
+            return None
+        raw = await self._get(keys=self._keys(user_id), args=[limit])
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [_load_message(item) for item in raw]
+
+    async def begin_load(self, user_id: int) -> Any:
+        version = await self.redis.get(self._keys(user_id)[2])
+        return version.decode() if isinstance(version, bytes) else (version or "0")
+
+    async def finish_load(self, user_id: int, token: Any, messages: Optional[List[HistoryMessage]]):
+        if messages is None:
+            return
+        items = [_dump_message(message) for message in messages[-self.window:]]
+        await self._store(keys=self._keys(user_id), args=[token, self.ttl, *items])
+
+    async def append(self, user_id: int, message: HistoryMessage):
+        await self._append(keys=self._keys(user_id), args=[_dump_message(message), self.window, self.ttl])
+
+    async def assign_ids(self, user_id: int, messages: List[HistoryMessage]):
+        args = []
+        for message in messages:
+            args.append(_dump_message(HistoryMessage(None, message.role, message.content)))
+            args.append(_dump_message(message))
+        if args:
+            await self._assign_ids(keys=self._keys(user_id)[:1], args=args)
+
+    async def clear(self, user_id: int):
+        await self._clear(keys=self._keys(user_id), args=[self.ttl])
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class RedisProfileCache(ProfileCacheBackend):
+    """Профили пользователей в Redis (JSON; "null" — профиля нет), общие для всех процессов"""
+
+    def __init__(self, redis, ttl: int = PROFILE_CACHE_TTL, prefix: str = REDIS_KEY_PREFIX):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}:profile:{user_id}"
+
+    async def get(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        raw = await self.redis.get(self._key(user_id))
+        if raw is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, json.loads(raw)
+
+    async def set(self, user_id: int, profile: Optional[Dict]):
+        await self.redis.set(self._key(user_id), json.dumps(profile, ensure_ascii=False), ex=self.ttl)
+
+    async def add(self, user_id: int, profile: Optional[Dict]):
+        await self.redis.set(self._key(user_id), json.dumps(profile, ensure_ascii=False), ex=self.ttl, nx=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class StateBackend:
+    """Общее состояние: кэш истории и профилей, хранилище FSM и блокировки пользователей"""
+    history_cache: HistoryCacheBackend
+    profile_cache: ProfileCacheBackend
+    fsm_storage: BaseStorage
+
+    def user_lock(self, user_id: int):
+        """Асинхронный контекстный менеджер: ответы одному пользователю идут по одному"""
+        raise NotImplementedError
+
+    async def claim(self, name: str, ttl: int) -> bool:
+        """Разовое действие для всех процессов: True — только у первого вызвавшего за ttl секунд"""
+        raise NotImplementedError
+
+    async def close(self):
+        await self.fsm_storage.close()
+
+
+class MemoryStateBackend(StateBackend):
+    def __init__(self):
+        self.history_cache = HistoryCache(
+            window=MAX_CONTEXT_MESSAGES,
+            max_users=HISTORY_CACHE_MAX_USERS,
+            max_bytes=HISTORY_CACHE_MAX_BYTES,
+        )
+        self.profile_cache = ProfileCache(max_users=PROFILE_CACHE_MAX_USERS)
+        self.fsm_storage = MemoryStorage()
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._lock_users: Dict[int, int] = {}
+        self._claims: Dict[str, float] = {}
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: int) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._lock_users[user_id] = self._lock_users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            # Блокировка больше никому не нужна — не храним ее
+            self._lock_users[user_id] -= 1
+            if not self._lock_users[user_id]:
+                del self._lock_users[user_id]
+                del self._locks[user_id]
+
+    async def claim(self, name: str, ttl: int) -> bool:
+        now = time.monotonic()
+        if self._claims.get(name, 0.0) > now:
+            return False
+        self._claims[name] = now + ttl
+        return True
+
+
+class RedisStateBackend(StateBackend):
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_KEY_PREFIX):
+        # redis нужен только для этого режима
+        from redis.asyncio import Redis
+        from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+
+        self.redis = Redis.from_url(url)
+        self.prefix = prefix
+        self.history_cache = RedisHistoryCache(self.redis, prefix=prefix)
+        self.profile_cache = RedisProfileCache(self.redis, prefix=prefix)
+        self.fsm_storage = RedisStorage(self.redis, key_builder=DefaultKeyBuilder(prefix=f"{prefix}:fsm"))
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: int) -> AsyncIterator[None]:
+        # timeout — чтобы блокировка упавшего процесса не держалась вечно
+        async with self.redis.lock(f"{self.prefix}:lock:user:{user_id}", timeout=USER_LOCK_TIMEOUT):
+            yield
+
+    async def claim(self, name: str, ttl: int) -> bool:
+        return bool(await self.redis.set(f"{self.prefix}:claim:{name}", "1", ex=ttl, nx=True))
+
+    async def close(self):
+        # RedisStorage.close закрывает и общее соединение
+        await self.fsm_storage.close()
+
+
+def create_state_backend(kind: str = STATE_BACKEND) -> StateBackend:
+    """Бэкенд состояния по настройке STATE_BACKEND"""
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "redis":
+        logger.info(f"Общее состояние хранится в Redis: {REDIS_URL.rsplit('@', 1)[-1]}")
+        return RedisStateBackend()
+    raise ValueError(f"Неизвестный STATE_BACKEND: {kind} (ожидается memory или redis)")
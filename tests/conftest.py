@@ -0,0 +1,91 @@
+"""
+Общие настройки тестов: корень репозитория в sys.path и окружение, без которого
+не импортируется config. Асинхронные тесты запускают свой цикл через asyncio.run.
+Поддельный Bot API — сессия aiogram, которая записывает запросы и отвечает сама.
+"""
+import os
+import sys
+import time
+from typing import Any, Callable, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+
+import pytest  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import EditMessageText, SendMessage  # noqa: E402
+from aiogram.types import Message  # noqa: E402
+
+
+class FakeBotSession(BaseSession):
+    """
+    Сессия без сети: запросы проходят через middleware сессии, как настоящие,
+    и записываются в requests. fail(request) может бросить исключение
+    (например, TelegramRetryAfter) вместо ответа
+    """
+
+    def __init__(self, fail: Optional[Callable[[Any], None]] = None):
+        super().__init__()
+        self.fail = fail
+        self.requests: List[Any] = []
+        self._message_id = 0
+
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        self.requests.append(method)
+        if self.fail is not None:
+            self.fail(method)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            if isinstance(method, SendMessage):
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = method.message_id
+            return Message.model_validate({
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": method.chat_id, "type": "private"}, "text": method.text,
+            }, context={"bot": bot})
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def sent(self, method_type: type = SendMessage) -> List[Any]:
+        return [method for method in self.requests if isinstance(method, method_type)]
+
+
+def make_bot(session: FakeBotSession) -> Bot:
+    return Bot("123456:test", session=session)
+
+
+def user_message(bot: Bot, chat_id: int = 42, text: str = "вопрос") -> Message:
+    """Входящее сообщение пользователя, привязанное к боту (для message.answer)"""
+    return Message.model_validate({
+        "message_id": 1, "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"}, "text": text,
+    }, context={"bot": bot})
+
+
+@pytest.fixture
+def redis_state_backends(monkeypatch):
+    """
+    Фабрика RedisStateBackend поверх fakeredis: все созданные бэкенды, как процессы
+    одного развертывания, работают с одним и тем же «сервером» Redis
+    """
+    import fakeredis
+    from fakeredis import aioredis
+    from redis.asyncio import Redis
+
+    from state_backend import RedisStateBackend
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(Redis, "from_url", classmethod(lambda cls, url, **kwargs: aioredis.FakeRedis(server=server)))
+    return lambda: RedisStateBackend(url="redis://fake", prefix="test")
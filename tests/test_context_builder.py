@@ -0,0 +1,50 @@
+"""Сборка контекста: сообщения, выпавшие из окна за кратким содержанием, тоже сворачиваются"""
+import asyncio
+
+from context_builder import ContextBuilder
+from database import Database
+
+
+class _FakeOpenAI:
+    def __init__(self):
+        self.batches = []
+
+    async def summarize_conversation(self, summary, messages):
+        self.batches.append([message["content"] for message in messages])
+        return summary + "+" + ",".join(message["content"] for message in messages)
+
+
+def test_messages_between_summary_and_window_are_summarized(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "bot.db"), write_behind=False)
+        await db.init_db()
+        openai_client = _FakeOpenAI()
+        # Бюджет не ограничивает: сообщения выпадают только из окна в 4 сообщения
+        builder = ContextBuilder(db, openai_client, token_budget=100000, max_messages=4,
+                                 summary_min_messages=2)
+        try:
+            for index in range(1, 4):
+                await db.save_message(1, "user", f"m{index}")
+                # Сообщения других пользователей между ними: id идут с пропусками
+                await db.save_message(2, "user", "чужое")
+            await db.save_conversation_summary(1, "сводка", 1)
+            for index in range(4, 8):
+                await db.save_message(1, "user", f"m{index}")
+
+            context = await builder.build(1)
+            await builder.close()
+
+            # В контексте окно m4..m7, а m2 и m3 свернуты в краткое содержание
+            assert [message["content"] for message in context[1:]] == ["m4", "m5", "m6", "m7"]
+            assert openai_client.batches == [["m2", "m3"]]
+            summary = await db.get_conversation_summary(1)
+            assert summary["summary"] == "сводка+m2,m3"
+
+            # Дальше сворачивать нечего: пропуски в id — сообщения других пользователей
+            await builder.build(1)
+            await builder.close()
+            assert openai_client.batches == [["m2", "m3"]]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+"""Отложенная запись истории с окнами в Redis (вместо Redis — fakeredis)"""
+import asyncio
+
+from fakeredis import aioredis
+
+from database import Database
+from state_backend import RedisHistoryCache
+
+
+def test_flush_writes_ids_back_to_redis_window(tmp_path):
+    async def scenario():
+        redis = aioredis.FakeRedis()
+        db = Database(str(tmp_path / "bot.db"), write_behind=True,
+                      history_cache=RedisHistoryCache(redis, window=4, prefix="test"))
+        await db.init_db()
+        try:
+            # Окно загружено (пустым) — дальше сообщения дописываются в Redis
+            assert await db.get_recent_messages(1, 4) == []
+            for index in range(6):
+                await db.save_message(1, "user" if index % 2 == 0 else "assistant", f"сообщение {index}")
+            await db.save_message(2, "user", "другой пользователь")
+            assert [m.id for m in await db.history_cache.get(1, 4)] == [None] * 4
+
+            await db.flush()
+
+            # Другой процесс видит в окне настоящие id — по ним работает сжатие истории
+            window = await RedisHistoryCache(redis, window=4, prefix="test").get(1, 4)
+            assert [m.content for m in window] == [f"сообщение {index}" for index in range(2, 6)]
+            assert [m.id for m in window] == [3, 4, 5, 6]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_assign_ids_keeps_order_of_repeated_messages():
+    async def scenario():
+        from history_cache import HistoryMessage
+        redis = aioredis.FakeRedis()
+        cache = RedisHistoryCache(redis, window=10, prefix="test")
+        await cache.finish_load(1, await cache.begin_load(1), [HistoryMessage(1, "user", "старое")])
+        pending = [HistoryMessage(None, "user", "да") for _ in range(3)]
+        for message in pending:
+            await cache.append(1, message)
+        for message_id, message in zip((7, 8, 9), pending):
+            message.id = message_id
+        await cache.assign_ids(1, pending[:2])
+        assert [m.id for m in await cache.get(1, 10)] == [1, 7, 8, None]
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+"""Отправка ответов: flood wait (429) и деление длинных ответов на сообщения"""
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+from conftest import FakeBotSession, make_bot, user_message
+from outbound_sender import OutboundSender
+from utils.telegram_utils import TELEGRAM_MESSAGE_LIMIT, answer_text, split_message
+
+
+def _flood_wait_once(retry_after: int):
+    """Первый sendMessage получает 429 с retry_after, остальные проходят"""
+    state = {"failed": False}
+
+    def fail(method):
+        if type(method).__name__ == "SendMessage" and not state["failed"]:
+            state["failed"] = True
+            raise TelegramRetryAfter(method, f"Too Many Requests: retry after {retry_after}", retry_after)
+
+    return fail
+
+
+def test_retry_after_pauses_chat_and_resends():
+    async def scenario():
+        session = FakeBotSession(fail=_flood_wait_once(1))
+        sender = OutboundSender(rate=100, chat_rate=100, chat_burst=10, max_retries=3)
+        session.middleware(sender)
+        bot = make_bot(session)
+        message = user_message(bot)
+
+        async def send(text):
+            return await message.answer(text)
+
+        started = time.monotonic()
+        first, second = await asyncio.gather(send("первое"), send("второе"))
+        elapsed = time.monotonic() - started
+
+        # Первое сообщение повторено после паузы, второе ждало ее и не обогнало первое
+        assert elapsed >= 1.0
+        assert [method.text for method in session.sent()] == ["первое", "первое", "второе"]
+        assert (first.text, second.text) == ("первое", "второе")
+        assert sender.stats()["flood_waits"] == 1
+        assert sender.stats()["sent"] == 2
+        assert sender.stats()["pending"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_is_raised_when_retries_run_out():
+    async def scenario():
+        session = FakeBotSession(fail=_flood_wait_once(30))
+        sender = OutboundSender(rate=100, chat_rate=100, chat_burst=10, max_retries=0)
+        session.middleware(sender)
+        message = user_message(make_bot(session))
+
+        started = time.monotonic()
+        with pytest.raises(TelegramRetryAfter) as error:
+            await message.answer("текст")
+        assert error.value.retry_after == 30
+        # Повторов нет — и ожидания тоже
+        assert time.monotonic() - started < 1.0
+        assert len(session.sent()) == 1
+
+    asyncio.run(scenario())
+
+
+def _long_reply() -> str:
+    paragraphs = [f"Абзац {index}. " + "текст " * 150 for index in range(12)]
+    return "\n\n".join(paragraph.strip() for paragraph in paragraphs)
+
+
+def test_split_message_cuts_on_paragraph_boundaries():
+    text = _long_reply()
+    assert len(text) > TELEGRAM_MESSAGE_LIMIT
+
+    chunks = split_message(text)
+
+    assert len(chunks) > 1
+    assert all(len(chunk) <= TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
+    # Каждое сообщение начинается с нового абзаца, и вместе они дают исходный текст
+    assert all(chunk.startswith("Абзац ") for chunk in chunks)
+    assert "\n\n".join(chunks) == text
+
+
+def test_answer_text_sends_long_reply_as_several_messages():
+    async def scenario():
+        session = FakeBotSession()
+        session.middleware(OutboundSender(rate=100, chat_rate=100, chat_burst=10))
+        message = user_message(make_bot(session))
+        text = _long_reply()
+
+        await answer_text(message, text)
+
+        sent = [method.text for method in session.sent()]
+        assert sent == split_message(text)
+        assert len(sent) > 1
+
+    asyncio.run(scenario())
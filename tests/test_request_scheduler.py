@@ -0,0 +1,88 @@
+"""Планировщик запросов к OpenAI: приоритеты, отказ при перегрузке, повтор после 429"""
+import asyncio
+
+import httpx2
+import pytest
+from openai import RateLimitError
+
+from request_scheduler import (
+    RequestScheduler, OverloadedError, PRIORITY_INTERACTIVE, PRIORITY_DOCUMENT, PRIORITY_BACKGROUND,
+)
+
+
+def test_queued_requests_run_in_priority_order():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, rpm=0, tpm=0, max_wait=5, background_max_wait=5)
+        order = []
+        busy = asyncio.Event()
+        release = asyncio.Event()
+
+        async def blocker():
+            busy.set()
+            await release.wait()
+
+        def request(name):
+            async def call():
+                order.append(name)
+            return call
+
+        first = asyncio.create_task(scheduler.run(blocker, PRIORITY_INTERACTIVE, 10))
+        await busy.wait()
+        # Пока слот занят, запросы встают в очередь в порядке, обратном приоритету
+        waiting = []
+        for name, priority in (("background", PRIORITY_BACKGROUND), ("document", PRIORITY_DOCUMENT),
+                               ("interactive", PRIORITY_INTERACTIVE)):
+            waiting.append(asyncio.create_task(scheduler.run(request(name), priority, 10)))
+            await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 3
+
+        release.set()
+        await asyncio.gather(first, *waiting)
+        assert order == ["interactive", "document", "background"]
+        assert scheduler.stats() == {"queued": 0, "active": 0, "rejected": 0, "retries": 0}
+
+    asyncio.run(scenario())
+
+
+def test_request_is_rejected_when_wait_exceeds_limit():
+    async def scenario():
+        # Один запрос в минуту: второй ждал бы около минуты при допустимых 5 секундах
+        scheduler = RequestScheduler(max_concurrent=4, rpm=1, tpm=0, max_wait=5, background_max_wait=5)
+        calls = []
+
+        async def call():
+            calls.append(1)
+            return "ok"
+
+        assert await scheduler.run(call, PRIORITY_INTERACTIVE, 10) == "ok"
+        with pytest.raises(OverloadedError):
+            await scheduler.run(call, PRIORITY_INTERACTIVE, 10)
+        # Отклонен сразу, не дойдя до API
+        assert len(calls) == 1
+        assert scheduler.stats()["rejected"] == 1
+        assert scheduler.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_error_is_retried_after_retry_after():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, rpm=0, tpm=0, max_retries=2,
+                                     base_delay=10, max_wait=5, background_max_wait=5)
+        attempts = []
+
+        async def call():
+            attempts.append(asyncio.get_running_loop().time())
+            if len(attempts) == 1:
+                request = httpx2.Request("POST", "https://api.openai.com/v1/chat/completions")
+                response = httpx2.Response(429, headers={"retry-after-ms": "200"}, request=request)
+                raise RateLimitError("Rate limit reached", response=response, body=None)
+            return "ok"
+
+        assert await scheduler.run(call, PRIORITY_INTERACTIVE, 10) == "ok"
+        # Пауза взята из retry-after-ms, а не из экспоненциальной задержки (base_delay = 10 с)
+        assert len(attempts) == 2
+        assert 0.2 <= attempts[1] - attempts[0] < 2
+        assert scheduler.stats()["retries"] == 1
+
+    asyncio.run(scenario())
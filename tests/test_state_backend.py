@@ -0,0 +1,67 @@
+"""Общее состояние в Redis (вместо Redis — fakeredis): блокировки пользователей между процессами"""
+import asyncio
+
+import state_backend
+
+
+def test_user_lock_serializes_processes(redis_state_backends):
+    async def scenario():
+        first, second = redis_state_backends(), redis_state_backends()
+        events = []
+
+        async def reply(backend, name):
+            async with backend.user_lock(1):
+                events.append(f"{name}:начало")
+                await asyncio.sleep(0.1)
+                events.append(f"{name}:конец")
+
+        try:
+            await asyncio.gather(reply(first, "первый"), reply(second, "второй"))
+        finally:
+            await first.close()
+            await second.close()
+        # Ответы одному пользователю не перемежаются, даже из разных процессов
+        assert events in (["первый:начало", "первый:конец", "второй:начало", "второй:конец"],
+                          ["второй:начало", "второй:конец", "первый:начало", "первый:конец"])
+
+    asyncio.run(scenario())
+
+
+def test_lock_of_crashed_process_expires(monkeypatch, redis_state_backends):
+    monkeypatch.setattr(state_backend, "USER_LOCK_TIMEOUT", 1)
+
+    async def scenario():
+        crashed, alive = redis_state_backends(), redis_state_backends()
+        try:
+            # Процесс взял блокировку пользователя (как user_lock) и упал, не освободив ее
+            stale = crashed.redis.lock(f"{crashed.prefix}:lock:user:1", timeout=state_backend.USER_LOCK_TIMEOUT)
+            assert await stale.acquire()
+
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            async with alive.user_lock(1):
+                waited = loop.time() - started
+            # Другой процесс получил блокировку, когда истек срок аренды, а не никогда
+            assert 0.5 <= waited < 3
+            # Блокировки другого пользователя это не касается
+            started = loop.time()
+            async with alive.user_lock(2):
+                assert loop.time() - started < 0.5
+        finally:
+            await crashed.close()
+            await alive.close()
+
+    asyncio.run(scenario())
+
+
+def test_claim_is_granted_once_per_ttl():
+    async def scenario():
+        backend = state_backend.MemoryStateBackend()
+        assert await backend.claim("job", 0.2)
+        assert not await backend.claim("job", 0.2)
+        assert await backend.claim("other", 0.2)
+        await asyncio.sleep(0.25)
+        assert await backend.claim("job", 0.2)
+        await backend.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+"""Потоковый ответ: окончательный текст доходит до пользователя и при flood wait"""
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, SendMessage
+
+from conftest import FakeBotSession, make_bot, user_message
+from utils.telegram_utils import (
+    EMPTY_RESPONSE_MESSAGE, STREAM_CURSOR, STREAM_INTERRUPTED_MARK, StreamInterruptedError, answer_streaming,
+)
+
+
+async def _deltas():
+    for delta in ("Добрый ", "день"):
+        yield delta
+
+
+def _fail_edits(times: int):
+    state = {"left": times}
+
+    def fail(method):
+        if isinstance(method, EditMessageText) and state["left"] > 0:
+            state["left"] -= 1
+            raise TelegramRetryAfter(method, "Too Many Requests: retry after 0", 0)
+
+    return fail
+
+
+def test_final_edit_is_retried_after_flood_wait():
+    async def scenario():
+        session = FakeBotSession(fail=_fail_edits(2))
+        response = await answer_streaming(user_message(make_bot(session)), _deltas(), edit_interval=0)
+
+        assert response == "Добрый день"
+        edits = session.sent(EditMessageText)
+        assert edits[-1].text == "Добрый день"
+        assert len(edits) >= 3
+        # Новых сообщений, кроме заглушки, нет: текст записан в нее
+        assert len(session.sent(SendMessage)) == 1
+
+    asyncio.run(scenario())
+
+
+def test_final_text_is_sent_as_new_message_when_edits_keep_failing():
+    async def scenario():
+        session = FakeBotSession(fail=_fail_edits(100))
+        response = await answer_streaming(user_message(make_bot(session)), _deltas(), edit_interval=0)
+
+        assert response == "Добрый день"
+        sent = session.sent(SendMessage)
+        assert [method.text for method in sent][-1] == "Добрый день"
+        # Недописанное сообщение удалено
+        deleted = session.sent(DeleteMessage)
+        assert [method.message_id for method in deleted] == [1]
+
+    asyncio.run(scenario())
+
+
+def test_interrupted_stream_keeps_shown_part_without_cursor():
+    async def failing_deltas():
+        yield "Начало ответа"
+        await asyncio.sleep(0.05)
+        raise RuntimeError("обрыв соединения")
+
+    async def scenario():
+        session = FakeBotSession()
+        with pytest.raises(StreamInterruptedError) as error:
+            await answer_streaming(user_message(make_bot(session)), failing_deltas(), edit_interval=0)
+
+        assert error.value.partial == "Начало ответа" + STREAM_INTERRUPTED_MARK
+        assert "обрыв соединения" in str(error.value)
+        final = session.sent(EditMessageText)[-1].text
+        assert final == error.value.partial
+        assert STREAM_CURSOR not in final
+        assert session.sent(DeleteMessage) == []
+
+    asyncio.run(scenario())
+
+
+def test_empty_response_is_not_returned_as_text():
+    async def no_deltas():
+        return
+        yield
+
+    async def scenario():
+        session = FakeBotSession()
+        response = await answer_streaming(user_message(make_bot(session)), no_deltas(), edit_interval=0)
+
+        # Пользователь видит сообщение о пустом ответе, а обработчик получает пустую строку
+        assert response == ""
+        assert session.sent(EditMessageText)[-1].text == EMPTY_RESPONSE_MESSAGE
+
+    asyncio.run(scenario())
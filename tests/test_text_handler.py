@@ -0,0 +1,70 @@
+"""Ответ на серию сообщений: что попадает в историю при ошибке и при отмене"""
+import asyncio
+
+import dependencies
+from handlers import text_handler
+from message_inbox import MessageBurst
+
+from conftest import FakeBotSession, make_bot, user_message
+
+
+class _FakeDb:
+    def __init__(self):
+        self.saved = []
+
+    async def save_message(self, user_id, role, content):
+        self.saved.append((role, content))
+
+
+class _FakeContextBuilder:
+    async def build(self, user_id):
+        return []
+
+
+class _FakeOpenAI:
+    def __init__(self, call):
+        self.call = call
+
+    async def send_text_message(self, messages):
+        return await self.call()
+
+
+def _setup(monkeypatch, call):
+    db = _FakeDb()
+    monkeypatch.setattr(text_handler, "STREAMING_ENABLED", False)
+    monkeypatch.setattr(dependencies, "db", db)
+    monkeypatch.setattr(dependencies, "openai_client", _FakeOpenAI(call))
+    monkeypatch.setattr(dependencies, "context_builder", _FakeContextBuilder())
+    session = FakeBotSession()
+    burst = MessageBurst([user_message(make_bot(session), text="вопрос")], [])
+    return db, session, burst
+
+
+def test_user_turn_is_saved_when_request_fails(monkeypatch):
+    async def fail():
+        raise RuntimeError("сбой API")
+
+    db, session, burst = _setup(monkeypatch, fail)
+    asyncio.run(text_handler.process_text_burst(42, burst))
+
+    # Вопрос остается в истории, ответа нет; пользователь видит сообщение об ошибке
+    assert db.saved == [("user", "вопрос")]
+    assert "сбой API" in session.sent()[-1].text
+
+
+def test_superseded_burst_is_not_saved(monkeypatch):
+    async def hang():
+        await asyncio.sleep(10)
+
+    db, session, burst = _setup(monkeypatch, hang)
+
+    async def scenario():
+        task = asyncio.create_task(text_handler.process_text_burst(42, burst))
+        await asyncio.sleep(0.05)
+        # Новая серия отменяет генерацию: ее сообщения сохранятся вместе со следующей
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert db.saved == []
+    assert session.sent() == []
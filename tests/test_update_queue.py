@@ -0,0 +1,84 @@
+"""Очередь входящих обновлений в БД: аренда, ее истечение и повторный захват"""
+import asyncio
+
+from database import Database
+
+
+def _claim(db: Database, now: float, lease: float = 30, max_attempts: int = 3):
+    return db.claim_updates(10, now, now + lease, max_attempts)
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "bot.db"))
+        await db.init_db()
+        try:
+            first = await db.enqueue_update(1, "a", 0)
+            second = await db.enqueue_update(1, "b", 0)
+            other = await db.enqueue_update(2, "c", 0)
+
+            rows, dropped = await _claim(db, now=100)
+            # Обновления одного пользователя — по одному, по порядку
+            assert [row["id"] for row in rows] == [first, other]
+            assert dropped == 0
+            # Пока аренда действует, другой процесс эти обновления не получит
+            rows, _ = await _claim(db, now=120)
+            assert rows == []
+
+            # Процесс упал, аренда истекла — обновления забирает следующий захват
+            rows, _ = await _claim(db, now=131)
+            assert [(row["id"], row["attempts"]) for row in rows] == [(first, 2), (other, 2)]
+
+            await db.finish_updates([first, other])
+            rows, _ = await _claim(db, now=140)
+            assert [row["id"] for row in rows] == [second]
+            assert await db.count_queued_updates() == 1
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_update_is_dropped_after_max_attempts(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "bot.db"))
+        await db.init_db()
+        try:
+            await db.enqueue_update(1, "падает при обработке", 0)
+            now = 100
+            for _ in range(2):
+                rows, dropped = await _claim(db, now=now, max_attempts=2)
+                assert len(rows) == 1 and dropped == 0
+                now += 31
+            rows, dropped = await _claim(db, now=now, max_attempts=2)
+            assert rows == [] and dropped == 1
+            assert await db.count_queued_updates() == 0
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_handed_off_update_lets_next_one_run(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "bot.db"))
+        await db.init_db()
+        try:
+            first = await db.enqueue_update(1, "a", 0)
+            second = await db.enqueue_update(1, "b", 0)
+            rows, _ = await _claim(db, now=100)
+            assert [row["id"] for row in rows] == [first]
+
+            # Первое обновление передано в серию сообщений — второе можно брать в работу
+            await db.hand_off_update(first)
+            rows, _ = await _claim(db, now=101)
+            assert [row["id"] for row in rows] == [second]
+
+            # Возврат при остановке: попытка не засчитывается
+            await db.release_updates([second])
+            rows, _ = await _claim(db, now=102)
+            assert [(row["id"], row["attempts"]) for row in rows] == [(second, 1)]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
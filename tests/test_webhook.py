@@ -0,0 +1,57 @@
+"""Режим вебхука: вебхук регистрирует один процесс, секрет у всех процессов общий"""
+import asyncio
+
+import app as app_module
+import dependencies
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SetWebhook
+
+from conftest import FakeBotSession, make_bot
+
+
+def test_webhook_secret_is_shared_and_hides_token():
+    first = app_module._derive_webhook_secret("123456:secret")
+    assert first == app_module._derive_webhook_secret("123456:secret")
+    assert first != app_module._derive_webhook_secret("123456:other")
+    assert "secret" not in first
+
+
+def test_only_one_process_registers_webhook_until_claim_expires(monkeypatch, redis_state_backends):
+    async def no_stop_signal():
+        return None
+
+    monkeypatch.setattr(app_module, "_wait_for_stop_signal", no_stop_signal)
+    monkeypatch.setattr(app_module, "WEBHOOK_URL", "https://bot.example.com")
+    monkeypatch.setattr(app_module, "WEBHOOK_SECRET", "")
+    monkeypatch.setattr(app_module, "WEBHOOK_HOST", "127.0.0.1")
+    monkeypatch.setattr(app_module, "WEBHOOK_PORT", 0)
+    monkeypatch.setattr(app_module, "WEBHOOK_CLAIM_TTL", 1)
+    monkeypatch.setattr(dependencies, "state_backend", None)
+
+    # Роутеры обработчиков подключаются к диспетчеру один раз — он общий для всех «процессов»
+    dp = app_module.create_dispatcher(MemoryStorage())
+
+    async def start_process(session: FakeBotSession):
+        """Запуск вебхука в отдельном «процессе»: свой бэкенд состояния, общий Redis"""
+        backend = redis_state_backends()
+        dependencies.state_backend = backend
+        try:
+            await app_module.run_webhook(dp, make_bot(session))
+        finally:
+            await backend.close()
+
+    async def scenario():
+        session = FakeBotSession()
+        await start_process(session)
+        await start_process(session)
+        registered = session.sent(SetWebhook)
+        assert len(registered) == 1
+        assert registered[0].url == "https://bot.example.com/webhook"
+        assert registered[0].secret_token == app_module._derive_webhook_secret(app_module.TELEGRAM_TOKEN)
+
+        # Срок захвата истек — следующий запуск (например, после деплоя) регистрирует вебхук снова
+        await asyncio.sleep(1.1)
+        await start_process(session)
+        assert len(session.sent(SetWebhook)) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,211 @@
+"""
+Очередь входящих обновлений Telegram в SQLite. Обновление сохраняется в БД
+сразу при получении, а обрабатывают его воркеры: медленная обработка документа
+не задерживает прием обновлений, всплески нагрузки сглаживаются, а после
+перезапуска бота необработанные обновления обрабатываются заново.
+Обновления одного пользователя обрабатываются строго по порядку.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import TelegramObject, Update
+
+from config import (
+    UPDATE_QUEUE_WORKERS, UPDATE_QUEUE_LEASE_SECONDS, UPDATE_QUEUE_MAX_ATTEMPTS,
+    UPDATE_QUEUE_POLL_INTERVAL, UPDATE_QUEUE_SHUTDOWN_TIMEOUT,
+)
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateJob:
+    """Обновление из очереди; передается обработчикам в аргументе update_job"""
+    __slots__ = ("queue", "id", "user_id", "handed_off")
+
+    def __init__(self, queue: "UpdateQueue", update_id: int, user_id: int):
+        self.queue = queue
+        self.id = update_id
+        self.user_id = user_id
+        self.handed_off = False
+
+    def hand_off(self):
+        """
+        Обработка продолжится вне воркера (например, в серии сообщений): воркер
+        освобождается, следующие обновления пользователя берутся в работу, а
+        обновление остается в очереди до вызова finish
+        """
+        self.handed_off = True
+
+    async def finish(self):
+        """Обновление обработано — удалить его из очереди"""
+        await self.queue._finish([self])
+
+
+class UpdateQueue:
+    def __init__(self, db: Database, dispatcher: Dispatcher, bot: Bot,
+                 workers: int = UPDATE_QUEUE_WORKERS,
+                 lease: float = UPDATE_QUEUE_LEASE_SECONDS,
+                 max_attempts: int = UPDATE_QUEUE_MAX_ATTEMPTS,
+                 poll_interval: float = UPDATE_QUEUE_POLL_INTERVAL):
+        self.db = db
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        # Арендованные этим процессом обновления: обрабатываемые и переданные дальше
+        self._jobs: Dict[int, UpdateJob] = {}
+        self._running: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher_task: Optional[asyncio.Task] = None
+        self._renew_task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def install(self):
+        """Перехват обновлений диспетчера: вместо обработки они попадают в очередь"""
+        self.dispatcher.update.outer_middleware(self._intercept)
+
+    async def _intercept(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                         event: Update, data: Dict[str, Any]) -> Any:
+        if "update_job" in data:
+            # Обновление пришло из очереди — обрабатываем
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        user_id = user.id if user is not None else (chat.id if chat is not None else 0)
+        try:
+            await self.db.enqueue_update(user_id, event.model_dump_json(exclude_unset=True), time.time())
+        except Exception as e:
+            # Без очереди обновление не теряем — обрабатываем сразу
+            logger.error(f"Ошибка при сохранении обновления в очередь: {str(e)}")
+            return await handler(event, data)
+        self.enqueued += 1
+        self._wakeup.set()
+
+    async def start(self):
+        """Запуск воркеров; обновления, оставшиеся с прошлого запуска, обрабатываются первыми"""
+        queued = await self.db.count_queued_updates()
+        if queued:
+            logger.info(f"В очереди обновлений с прошлого запуска: {queued}")
+        self._dispatcher_task = asyncio.create_task(self._dispatch_loop())
+        self._renew_task = asyncio.create_task(self._renew_loop())
+
+    async def _dispatch_loop(self):
+        """Аренда обновлений из очереди, пока есть свободные воркеры"""
+        while True:
+            self._wakeup.clear()
+            claimed = 0
+            free = self.workers - len(self._running)
+            if free > 0:
+                try:
+                    claimed = await self._claim(free)
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении очереди обновлений: {str(e)}", exc_info=True)
+            if claimed and claimed == free:
+                # Возможно, в очереди есть еще — не ждем
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self, limit: int) -> int:
+        now = time.time()
+        rows, dropped = await self.db.claim_updates(limit, now, now + self.lease, self.max_attempts)
+        if dropped:
+            self.dropped += dropped
+            logger.warning(f"Удалены обновления, обработка которых прерывалась "
+                           f"{self.max_attempts} раз: {dropped}")
+        for row in rows:
+            job = UpdateJob(self, row["id"], row["user_id"])
+            if row["attempts"] > 1:
+                logger.info(f"Повторная обработка обновления {row['id']} пользователя {row['user_id']} "
+                            f"(попытка {row['attempts']})")
+            self._jobs[job.id] = job
+            task = asyncio.create_task(self._process(job, row["payload"]))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        return len(rows)
+
+    async def _process(self, job: UpdateJob, payload: str):
+        """Обработка одного обновления воркером"""
+        try:
+            update = Update.model_validate_json(payload, context={"bot": self.bot})
+            await self.dispatcher.feed_update(self.bot, update, update_job=job)
+        except asyncio.CancelledError:
+            # Остановка бота: обновление вернется в очередь при close
+            raise
+        except Exception as e:
+            # Обработчики сами сообщают пользователю об ошибках; повтор дал бы дубли ответов
+            logger.error(f"Ошибка при обработке обновления {job.id} "
+                         f"пользователя {job.user_id}: {str(e)}", exc_info=True)
+        try:
+            if job.handed_off and job.id in self._jobs:
+                await self.db.hand_off_update(job.id)
+            elif not job.handed_off:
+                await self._finish([job])
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении очереди обновлений: {str(e)}")
+        # Воркер свободен, а у пользователя могут быть следующие обновления
+        self._wakeup.set()
+
+    async def _finish(self, jobs: List[UpdateJob]):
+        ids = [job.id for job in jobs if self._jobs.pop(job.id, None) is not None]
+        if not ids:
+            return
+        self.processed += len(ids)
+        await self.db.finish_updates(ids)
+        self._wakeup.set()
+
+    async def _renew_loop(self):
+        """Продление аренды обновлений, пока процесс их обрабатывает"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not self._jobs:
+                continue
+            try:
+                await self.db.renew_update_leases(list(self._jobs), time.time() + self.lease)
+            except Exception as e:
+                logger.error(f"Ошибка при продлении аренды обновлений: {str(e)}")
+
+    async def stop(self, timeout: float = UPDATE_QUEUE_SHUTDOWN_TIMEOUT):
+        """Прекратить брать обновления и дождаться обрабатываемых (не дольше timeout)"""
+        if self._dispatcher_task is not None:
+            self._dispatcher_task.cancel()
+            await asyncio.gather(self._dispatcher_task, return_exceptions=True)
+            self._dispatcher_task = None
+        if self._running:
+            done, pending = await asyncio.wait(set(self._running), timeout=timeout)
+            if pending:
+                logger.warning(f"Прервана обработка обновлений при остановке: {len(pending)}")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def close(self):
+        """Вернуть в очередь незавершенные обновления — они будут обработаны после запуска"""
+        await self.stop()
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            await asyncio.gather(self._renew_task, return_exceptions=True)
+            self._renew_task = None
+        if self._jobs:
+            logger.info(f"Возвращено в очередь обновлений: {len(self._jobs)}")
+            await self.db.release_updates(list(self._jobs))
+            self._jobs.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": len(self._running),
+            "handed_off": sum(1 for job in self._jobs.values() if job.handed_off),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
@@ -1,68 +1,295 @@
 """
-Утилиты для работы с аудио файлами.
-Голосовые в Telegram приходят в OGG; Whisper API принимает mp3, wav, m4a и др., но не OGG.
-Конвертация через ffmpeg (нужно установить: brew install ffmpeg).
+Утилиты для подготовки аудио к Whisper.
+Формат определяется по содержимому до отправки. Если Whisper его принимает, файл
+уходит как есть. Иначе аудио прогоняется через ffmpeg по каналам stdin/stdout,
+без временных файлов. По возможности дорожка перекладывается в другой контейнер
+без перекодирования, а перекодирование остается крайним случаем.
+Длинные записи режутся на перекрывающиеся части по паузам.
+Нужен ffmpeg: brew install ffmpeg (Mac) или apt install ffmpeg (Linux).
 """
-import os
 import asyncio
+import logging
+import os
+import re
 import shutil
-import tempfile
-from typing import Optional
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from config import (
+    WHISPER_INPUT_FORMATS, AUDIO_TRANSCODE_TIMEOUT,
+    AUDIO_SEGMENT_SECONDS, AUDIO_SEGMENT_OVERLAP, AUDIO_SEGMENT_MAX_BYTES,
+    AUDIO_SILENCE_NOISE, AUDIO_SILENCE_MIN_DURATION,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AudioSegment(NamedTuple):
+    start: float  # сек от начала записи
+    end: float
+
+
+class AudioFormat(NamedTuple):
+    container: str        # ogg, webm, matroska, mp3, mp4, wav, flac, aac, amr
+    codec: Optional[str]  # opus, vorbis, flac, mp3, aac; None — не удалось определить
+
+
+# Расширение файла для Whisper по контейнеру
+_CONTAINER_EXTENSIONS = {
+    "ogg": "ogg", "webm": "webm", "mp3": "mp3", "mp4": "m4a", "wav": "wav", "flac": "flac",
+}
+
+# Контейнеры, в которые дорожку можно переложить без перекодирования:
+# (расширение для Whisper, формат ffmpeg, дополнительные параметры)
+_REMUX_TARGETS = {
+    "opus": [("ogg", "ogg", []), ("webm", "webm", [])],
+    "vorbis": [("ogg", "ogg", []), ("webm", "webm", [])],
+    "flac": [("flac", "flac", []), ("ogg", "ogg", [])],
+    "mp3": [("mp3", "mp3", [])],
+    # MP4 в канал пишется фрагментированным: у канала нет перемотки для moov в конце
+    "aac": [("m4a", "mp4", ["-movflags", "frag_keyframe+empty_moov"])],
+}
+
+# Перекодирование, если переложить не получилось: речь, моно 16 кГц — этого Whisper достаточно
+_ENCODE_TARGETS = [
+    ("mp3", "mp3", ["-c:a", "libmp3lame", "-q:a", "4"]),
+    ("wav", "wav", ["-c:a", "pcm_s16le"]),
+]
 
 
 def _ffmpeg_available() -> bool:
     return shutil.which("ffmpeg") is not None
 
 
-async def convert_ogg_to_mp3_ffmpeg(ogg_path: str, output_path: Optional[str] = None) -> str:
+def detect_audio_format(data: bytes) -> Optional[AudioFormat]:
+    """Формат аудио по сигнатуре в начале файла; None, если формат не распознан"""
+    head = data[:512]
+    if head.startswith(b"OggS"):
+        if b"OpusHead" in head:
+            return AudioFormat("ogg", "opus")
+        if b"\x01vorbis" in head:
+            return AudioFormat("ogg", "vorbis")
+        if b"\x7fFLAC" in head:
+            return AudioFormat("ogg", "flac")
+        return AudioFormat("ogg", None)
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        container = "webm" if b"webm" in head[:64] else "matroska"
+        if b"A_OPUS" in head:
+            return AudioFormat(container, "opus")
+        if b"A_VORBIS" in head:
+            return AudioFormat(container, "vorbis")
+        return AudioFormat(container, None)
+    if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return AudioFormat("wav", None)
+    if head.startswith(b"fLaC"):
+        return AudioFormat("flac", "flac")
+    if head[4:8] == b"ftyp":
+        return AudioFormat("mp4", None)
+    if head.startswith(b"#!AMR"):
+        return AudioFormat("amr", None)
+    if head.startswith(b"ID3"):
+        return AudioFormat("mp3", "mp3")
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Кадр MPEG: у ADTS (AAC) поле layer нулевое, у MP3 — нет
+        if head[1] & 0x06 == 0:
+            return AudioFormat("aac", "aac")
+        return AudioFormat("mp3", "mp3")
+    return None
+
+
+def _with_extension(file_name: str, extension: str) -> str:
+    return f"{os.path.splitext(file_name)[0] or 'audio'}.{extension}"
+
+
+async def _run_ffmpeg(data: bytes, args: Sequence[str], timeout: float) -> Tuple[bytes, str]:
+    """Запуск ffmpeg с data на stdin; возвращает stdout и текст stderr"""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-hide_banner", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        # communicate пишет в stdin и читает stdout одновременно — каналы не переполняются
+        stdout, stderr = await asyncio.wait_for(proc.communicate(data), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"Ошибка конвертации аудио (ffmpeg): превышено время обработки ({timeout} с)")
+    err = stderr.decode("utf-8", errors="replace") if stderr else ""
+    if proc.returncode != 0 or not stdout:
+        raise RuntimeError(f"Ошибка конвертации аудио (ffmpeg): {(err or 'unknown')[-300:]}")
+    return stdout, err
+
+
+async def transcode_audio(data: bytes, output_format: str, codec_args: List[str],
+                          timeout: float = AUDIO_TRANSCODE_TIMEOUT,
+                          input_args: Sequence[str] = ()) -> bytes:
     """
-    Конвертация OGG в MP3 через ffmpeg (без pydub).
-    Требует установленный ffmpeg: brew install ffmpeg
+    Прогон аудио через ffmpeg: вход — stdin, результат — stdout
+
+    Args:
+        data: Исходное аудио
+        output_format: Формат ffmpeg на выходе (-f)
+        codec_args: Параметры кодека, например ["-c:a", "copy"]
+        timeout: Максимальное время работы ffmpeg, сек
+        input_args: Параметры входа, например ["-ss", "10", "-t", "30"]
+
+    Returns:
+        Аудио в новом формате
     """
+    stdout, _ = await _run_ffmpeg(
+        data,
+        ["-loglevel", "error", *input_args, "-i", "pipe:0", "-vn", *codec_args, "-f", output_format, "pipe:1"],
+        timeout,
+    )
+    return stdout
+
+
+async def prepare_audio_for_whisper(data: bytes, file_name: str,
+                                    accepted_formats: List[str] = WHISPER_INPUT_FORMATS) -> Tuple[bytes, str]:
+    """
+    Аудио в формате, который примет Whisper, — чтобы файл загружался один раз
+
+    Args:
+        data: Исходное аудио
+        file_name: Исходное имя файла
+        accepted_formats: Расширения, которые принимает Whisper
+
+    Returns:
+        (аудио, имя файла с расширением, соответствующим содержимому)
+    """
+    audio_format = detect_audio_format(data)
+    if audio_format is None:
+        extension = os.path.splitext(file_name)[1].lstrip(".").lower()
+        if extension in accepted_formats or not _ffmpeg_available():
+            # Формат не распознан — доверяем расширению, ошибку при необходимости вернет Whisper
+            return data, file_name
+    else:
+        extension = _CONTAINER_EXTENSIONS.get(audio_format.container)
+        if extension in accepted_formats:
+            # Whisper определяет формат по расширению — оно должно соответствовать содержимому
+            return data, _with_extension(file_name, extension)
+
     if not _ffmpeg_available():
         raise RuntimeError(
-            "Для голосовых сообщений нужен ffmpeg. "
+            "Для этого формата аудио нужен ffmpeg. "
             "Установите: brew install ffmpeg (Mac) или apt install ffmpeg (Linux)."
         )
-    if output_path is None:
-        f = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        output_path = f.name
-        f.close()
-    proc = await asyncio.create_subprocess_exec(
-        "ffmpeg", "-y", "-i", ogg_path, "-acodec", "libmp3lame", "-q:a", "2", output_path,
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.PIPE,
+
+    codec = audio_format.codec if audio_format else None
+    for extension, output_format, extra_args in _REMUX_TARGETS.get(codec, []):
+        if extension not in accepted_formats:
+            continue
+        try:
+            remuxed = await transcode_audio(data, output_format, ["-c:a", "copy", *extra_args])
+            logger.info(f"Аудио переложено в {extension} без перекодирования: {len(data)} -> {len(remuxed)} байт")
+            return remuxed, _with_extension(file_name, extension)
+        except RuntimeError as e:
+            logger.warning(f"Не удалось переложить аудио в {extension}: {str(e)}")
+
+    for extension, output_format, codec_args in _ENCODE_TARGETS:
+        if extension not in accepted_formats:
+            continue
+        encoded = await transcode_audio(data, output_format, [*codec_args, "-ac", "1", "-ar", "16000"])
+        logger.info(f"Аудио перекодировано в {extension}: {len(data)} -> {len(encoded)} байт")
+        return encoded, _with_extension(file_name, extension)
+
+    raise RuntimeError("Не удалось подготовить аудио: нет подходящего формата для Whisper")
+
+
+def should_segment_audio(size: int, duration: Optional[float] = None,
+                         segment_seconds: float = AUDIO_SEGMENT_SECONDS,
+                         max_bytes: int = AUDIO_SEGMENT_MAX_BYTES) -> bool:
+    """Резать ли запись на части: слишком большой файл или заметно длиннее одной части"""
+    if not _ffmpeg_available():
+        return False
+    return size > max_bytes or (duration or 0) > segment_seconds * 1.5
+
+
+def _parse_time(value: str) -> float:
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+async def compact_audio_with_silences(
+    data: bytes,
+    noise: str = AUDIO_SILENCE_NOISE,
+    min_silence: float = AUDIO_SILENCE_MIN_DURATION,
+    timeout: float = AUDIO_TRANSCODE_TIMEOUT * 5,
+) -> Tuple[bytes, List[Tuple[float, float]], float]:
+    """
+    Один проход ffmpeg: перекодирование в компактный MP3 (моно, 16 кГц)
+    и поиск пауз фильтром silencedetect
+
+    Returns:
+        (MP3, паузы [(начало, конец)], длительность записи в секундах)
+    """
+    compact, log = await _run_ffmpeg(
+        data,
+        ["-i", "pipe:0", "-vn",
+         "-af", f"silencedetect=noise={noise}:d={min_silence}",
+         "-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-q:a", "4",
+         "-f", "mp3", "pipe:1"],
+        timeout,
     )
-    _, stderr = await proc.communicate()
-    if proc.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-        err = stderr.decode("utf-8", errors="replace") if stderr else "unknown"
-        raise RuntimeError(f"Ошибка конвертации аудио (ffmpeg): {err[:300]}")
-    return output_path
+    times = re.findall(r"time=(\d+:\d+:[\d.]+)", log)
+    duration = _parse_time(times[-1]) if times else 0.0
+    starts = [max(0.0, float(value)) for value in re.findall(r"silence_start: (-?[\d.]+)", log)]
+    ends = [float(value) for value in re.findall(r"silence_end: ([\d.]+)", log)]
+    # Пауза в самом конце записи не получает silence_end
+    ends += [duration] * (len(starts) - len(ends))
+    return compact, list(zip(starts, ends)), duration
 
 
-async def convert_audio_for_whisper(audio_path: str) -> str:
+def plan_audio_segments(duration: float, silences: List[Tuple[float, float]],
+                        segment_seconds: float = AUDIO_SEGMENT_SECONDS,
+                        overlap: float = AUDIO_SEGMENT_OVERLAP) -> List[AudioSegment]:
     """
-    Конвертация аудио в формат для Whisper API.
-    Поддерживаемые форматы: mp3, mp4, mpeg, mpga, m4a, wav, webm.
-    Telegram присылает OGG — конвертируем в MP3 через ffmpeg.
+    Разбиение записи на части не длиннее segment_seconds (плюс перекрытие).
+    Граница ставится в середину самой поздней паузы во второй половине части,
+    а если пауз нет — ровно по длине части. Каждая часть заходит на overlap
+    секунд в следующую, чтобы слова на границе не потерялись.
     """
-    ext = os.path.splitext(audio_path)[1].lower()
-    supported = {".mp3", ".mp4", ".mpeg", ".mpga", ".m4a", ".wav", ".webm"}
-    if ext in supported:
-        return audio_path
-    if ext == ".ogg":
-        return await convert_ogg_to_mp3_ffmpeg(audio_path)
-    # Остальные форматы — пробуем через ffmpeg как «любой вход» -> mp3
-    if _ffmpeg_available():
-        out_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3").name
-        proc = await asyncio.create_subprocess_exec(
-            "ffmpeg", "-y", "-i", audio_path, "-acodec", "libmp3lame", "-q:a", "2", out_path,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await proc.communicate()
-        if proc.returncode == 0 and os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-            return out_path
-    raise RuntimeError(
-        "Не удалось конвертировать аудио. Установите ffmpeg: brew install ffmpeg"
+    segments = []
+    start = 0.0
+    while duration - start > segment_seconds:
+        target = start + segment_seconds
+        candidates = [(silence_start + silence_end) / 2 for silence_start, silence_end in silences
+                      if start + segment_seconds / 2 <= (silence_start + silence_end) / 2 <= target]
+        cut = max(candidates) if candidates else target
+        segments.append(AudioSegment(start, min(duration, cut + overlap)))
+        start = cut
+    segments.append(AudioSegment(start, duration))
+    return segments
+
+
+async def cut_audio_segment(compact: bytes, segment: AudioSegment) -> bytes:
+    """Вырезка части из MP3 без перекодирования"""
+    return await transcode_audio(
+        compact, "mp3", ["-c:a", "copy"],
+        input_args=["-ss", f"{segment.start:.3f}", "-t", f"{segment.end - segment.start:.3f}"],
     )
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+def merge_transcripts(texts: List[str], max_overlap_words: int = 30) -> str:
+    """
+    Склейка транскрипций соседних частей: повтор на стыке (конец предыдущей
+    совпадает с началом следующей без учета регистра и пунктуации) убирается
+    """
+    merged: List[str] = []
+    for text in texts:
+        words = text.split()
+        if merged and words:
+            tail = [_normalize_word(word) for word in merged[-max_overlap_words:]]
+            head = [_normalize_word(word) for word in words[:max_overlap_words]]
+            # Самое длинное совпадение; одно слово не считаем — может совпасть случайно
+            for size in range(min(len(tail), len(head)), 1, -1):
+                if tail[-size:] == head[:size]:
+                    words = words[size:]
+                    break
+        merged.extend(words)
+    return " ".join(merged)
@@ -1,63 +1,244 @@
 """
-Утилиты для извлечения текста из документов
+Утилиты для извлечения текста из документов.
+Разбор PDF и DOCX идет в отдельных процессах, чтобы не блокировать event loop;
+страницы PDF извлекаются параллельно, с лимитами на страницы, символы и время.
 """
+import asyncio
+import logging
+import multiprocessing
 import os
-from typing import Optional
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, List, Optional, TypeVar
 
+from config import (
+    DOC_EXTRACT_WORKERS, DOC_MAX_PAGES, DOC_MAX_CHARS, DOC_EXTRACT_TIMEOUT, DOC_PAGES_PER_TASK,
+)
+from utils import document_workers
+from utils.file_utils import MediaSource, read_media
 
-async def extract_text_from_pdf(pdf_path: str) -> str:
-    """Извлечение текста из PDF файла"""
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Пул процессов для разбора документов, создается при первом использовании"""
+    global _process_pool
+    if _process_pool is None:
+        # spawn: дочерние процессы не наследуют потоки и состояние event loop.
+        # Главный модуль (bot.py) они импортируют заново, но он ничего не загружает,
+        # поэтому в процессах пула есть только utils.document_workers
+        _process_pool = ProcessPoolExecutor(
+            max_workers=DOC_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _process_pool
+
+
+def shutdown_extraction_pool():
+    """Остановка пула процессов (при завершении бота)"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def _kill_extraction_pool():
+    """
+    Остановка пула с зависшим разбором. Отмена future не прерывает задачу, которая
+    уже выполняется, поэтому процессы завершаются принудительно; следующий вызов
+    создаст новый пул. Задачи других документов в этом пуле получат BrokenProcessPool
+    и будут повторены в новом пуле
+    """
+    global _process_pool
+    pool = _process_pool
+    if pool is None:
+        return
+    _process_pool = None
+    # У ProcessPoolExecutor нет публичного способа остановить выполняющиеся задачи
+    # Задачи в очереди не отменяются: пул, потерявший процессы, завершит их с BrokenProcessPool
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False)
+    logger.warning("Пул разбора документов перезапущен: разбор не уложился в отведенное время")
+
+
+async def warm_up_extraction_pool():
+    """
+    Запуск всех процессов пула и импорт в них библиотек разбора, чтобы первый
+    документ не ждал запуска процессов
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_process_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, document_workers.import_parsers)
+                           for _ in range(DOC_EXTRACT_WORKERS)))
+
+
+@asynccontextmanager
+async def _document_file(source: MediaSource) -> AsyncIterator[str]:
+    """Путь к файлу документа для процессов пула; байты и буфер записываются во временный файл"""
+    if isinstance(source, str):
+        yield source
+        return
+    data = await read_media(source)
+    path = await asyncio.to_thread(_write_temp_file, data)
+    try:
+        yield path
+    finally:
+        await asyncio.to_thread(os.unlink, path)
+
+
+def _write_temp_file(data: bytes) -> str:
+    with tempfile.NamedTemporaryFile(prefix="doc-", delete=False) as file:
+        file.write(data)
+        return file.name
+
+
+async def _run_in_pool(func: Callable[..., T], *args: Any) -> T:
+    """
+    Задача в пуле процессов. Если пул остановили из-за чужого зависшего разбора,
+    задача один раз повторяется в новом пуле
+    """
+    loop = asyncio.get_running_loop()
     try:
-        import PyPDF2
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text.strip()
+        return await loop.run_in_executor(_get_process_pool(), func, *args)
+    except BrokenProcessPool:
+        _forget_broken_pool()
+        return await loop.run_in_executor(_get_process_pool(), func, *args)
+
+
+def _forget_broken_pool():
+    """Упавший пул больше не принимает задачи — следующий вызов создаст новый"""
+    global _process_pool
+    if _process_pool is not None and getattr(_process_pool, "_broken", False):
+        shutdown_extraction_pool()
+
+
+def _truncate(text: str, max_chars: int, notes: List[str]) -> str:
+    if len(text) > max_chars:
+        notes.append(f"текст обрезан до {max_chars} символов")
+        return text[:max_chars]
+    return text
+
+
+def _with_notes(text: str, notes: List[str]) -> str:
+    """Пометка о неполной обработке, чтобы модель знала, что видит не весь документ"""
+    text = text.strip()
+    if notes:
+        text += f"\n\n[Документ обработан частично: {'; '.join(notes)}]"
+    return text
+
+
+async def extract_text_from_pdf(pdf_source: MediaSource, max_pages: int = DOC_MAX_PAGES,
+                                max_chars: int = DOC_MAX_CHARS,
+                                timeout: float = DOC_EXTRACT_TIMEOUT) -> str:
+    """
+    Извлечение текста из PDF файла.
+    Страницы разбиваются на диапазоны, которые обрабатываются параллельно
+    в пуле процессов; каждый процесс разбирает файл один раз. При превышении
+    лимитов возвращается то, что успели извлечь.
+    """
+    try:
+        async with _document_file(pdf_source) as path:
+            loop = asyncio.get_running_loop()
+            deadline = time.monotonic() + timeout
+            notes: List[str] = []
+
+            page_count = await asyncio.wait_for(_run_in_pool(document_workers.pdf_page_count, path), timeout)
+            pages = min(page_count, max_pages)
+            if page_count > max_pages:
+                notes.append(f"обработано {max_pages} из {page_count} страниц")
+
+            ranges = [(start, min(start + DOC_PAGES_PER_TASK, pages))
+                      for start in range(0, pages, DOC_PAGES_PER_TASK)]
+            futures = [loop.create_task(_run_in_pool(document_workers.extract_pdf_pages,
+                                                     path, start, end, max_chars))
+                       for start, end in ranges]
+            if futures:
+                await asyncio.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+
+            texts = []
+            hung = False
+            for (start, end), future in zip(ranges, futures):
+                if future.done() and future.exception() is None:
+                    texts.append(future.result())
+                    continue
+                if future.done():
+                    logger.warning("PDF: ошибка на страницах %s–%s: %s", start + 1, end, future.exception())
+                else:
+                    hung = True
+                    future.cancel()
+                notes.append(f"страницы {start + 1}–{end} не обработаны")
+            if hung:
+                # Незавершенные задачи продолжили бы занимать процессы пула
+                _kill_extraction_pool()
+            return _with_notes(_truncate("\n".join(texts), max_chars, notes), notes)
+    except asyncio.TimeoutError:
+        _kill_extraction_pool()
+        raise Exception(f"Ошибка при извлечении текста из PDF: превышено время обработки ({timeout} с)")
+    except BrokenProcessPool as e:
+        _forget_broken_pool()
+        raise Exception(f"Ошибка при извлечении текста из PDF: {str(e)}")
     except Exception as e:
         raise Exception(f"Ошибка при извлечении текста из PDF: {str(e)}")
 
 
-async def extract_text_from_docx(docx_path: str) -> str:
+async def extract_text_from_docx(docx_source: MediaSource, max_chars: int = DOC_MAX_CHARS,
+                                 timeout: float = DOC_EXTRACT_TIMEOUT) -> str:
     """Извлечение текста из DOCX файла"""
     try:
-        from docx import Document
-        doc = Document(docx_path)
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        return text.strip()
+        async with _document_file(docx_source) as path:
+            text, truncated = await asyncio.wait_for(
+                _run_in_pool(document_workers.extract_docx_text, path, max_chars), timeout
+            )
+        notes = [f"текст обрезан до {max_chars} символов"] if truncated else []
+        return _with_notes(text[:max_chars], notes)
+    except asyncio.TimeoutError:
+        _kill_extraction_pool()
+        raise Exception(f"Ошибка при извлечении текста из DOCX: превышено время обработки ({timeout} с)")
+    except BrokenProcessPool as e:
+        _forget_broken_pool()
+        raise Exception(f"Ошибка при извлечении текста из DOCX: {str(e)}")
     except Exception as e:
         raise Exception(f"Ошибка при извлечении текста из DOCX: {str(e)}")
 
 
-async def extract_text_from_txt(txt_path: str) -> str:
+async def extract_text_from_txt(txt_source: MediaSource, max_chars: int = DOC_MAX_CHARS) -> str:
     """Извлечение текста из TXT файла"""
     try:
-        import aiofiles
-        async with aiofiles.open(txt_path, 'r', encoding='utf-8') as f:
-            text = await f.read()
-        return text.strip()
+        data = await read_media(txt_source)
+        notes: List[str] = []
+        return _with_notes(_truncate(data.decode('utf-8'), max_chars, notes), notes)
     except Exception as e:
         raise Exception(f"Ошибка при чтении TXT файла: {str(e)}")
 
 
-async def extract_text_from_document(file_path: str) -> Optional[str]:
+async def extract_text_from_document(source: MediaSource, file_name: Optional[str] = None) -> Optional[str]:
     """
     Извлечение текста из документа по типу файла
-    
+
     Args:
-        file_path: Путь к файлу
-    
+        source: Путь к файлу, его байты или буфер
+        file_name: Имя файла для определения типа (по умолчанию — путь source)
+
     Returns:
         Текст документа или None, если формат не поддерживается
     """
-    ext = os.path.splitext(file_path)[1].lower()
-    
+    if file_name is None:
+        file_name = source if isinstance(source, str) else ""
+    ext = os.path.splitext(file_name)[1].lower()
+
     if ext == '.pdf':
-        return await extract_text_from_pdf(file_path)
+        return await extract_text_from_pdf(source)
     elif ext in ['.doc', '.docx']:
-        return await extract_text_from_docx(file_path)
+        return await extract_text_from_docx(source)
     elif ext == '.txt':
-        return await extract_text_from_txt(file_path)
+        return await extract_text_from_txt(source)
     else:
         return None
@@ -0,0 +1,60 @@
+"""
+Разбор документов в процессах пула (см. document_utils).
+Модуль импортируется каждым процессом пула, поэтому при импорте ничего не делает
+и зависит только от стандартной библиотеки; библиотеки разбора загружаются лениво.
+Документ передается путем к файлу: байты не сериализуются в каждую задачу.
+"""
+import os
+from typing import Any, Optional, Tuple
+
+# Последний разобранный PDF процесса: (путь, время изменения, PdfReader).
+# Задачи с соседними диапазонами страниц одного документа не разбирают файл заново
+_pdf_cache: Optional[Tuple[str, int, Any]] = None
+
+
+def import_parsers():
+    import PyPDF2  # noqa: F401
+    import docx  # noqa: F401
+
+
+def _pdf_reader(path: str) -> Any:
+    global _pdf_cache
+    mtime = os.stat(path).st_mtime_ns
+    if _pdf_cache is None or _pdf_cache[:2] != (path, mtime):
+        import PyPDF2
+        # Освобождаем прежний документ до разбора нового
+        _pdf_cache = None
+        _pdf_cache = (path, mtime, PyPDF2.PdfReader(path))
+    return _pdf_cache[2]
+
+
+def pdf_page_count(path: str) -> int:
+    return len(_pdf_reader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, end: int, max_chars: int) -> str:
+    """Текст страниц [start, end) одной строкой, не длиннее max_chars"""
+    reader = _pdf_reader(path)
+    texts = []
+    total = 0
+    for index in range(start, end):
+        page_text = reader.pages[index].extract_text() or ""
+        texts.append(page_text)
+        total += len(page_text)
+        if total >= max_chars:
+            break
+    return "\n".join(texts)
+
+
+def extract_docx_text(path: str, max_chars: int) -> Tuple[str, bool]:
+    """Текст абзацев DOCX и признак того, что он обрезан по лимиту"""
+    from docx import Document
+    doc = Document(path)
+    texts = []
+    total = 0
+    for paragraph in doc.paragraphs:
+        texts.append(paragraph.text)
+        total += len(paragraph.text) + 1
+        if total >= max_chars:
+            return "\n".join(texts), True
+    return "\n".join(texts), False
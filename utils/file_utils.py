@@ -1,32 +1,139 @@
 """
 Утилиты для работы с файлами
 """
+import asyncio
 import base64
 import io
-from PIL import Image
-from typing import Optional, Tuple
+import tempfile
+from typing import BinaryIO, NamedTuple, Optional, Sequence, Tuple, Union
 import aiofiles
 import os
+from config import IMAGE_MAX_EDGE, IMAGE_FORMAT, IMAGE_QUALITY, MEDIA_MEMORY_THRESHOLD
 
+# Источник медиа: путь к файлу, байты или открытый буфер
+MediaSource = Union[str, bytes, BinaryIO]
 
-async def image_to_base64(image_path: str) -> str:
-    """Конвертация изображения в base64 строку"""
-    async with aiofiles.open(image_path, 'rb') as f:
-        image_data = await f.read()
-        return base64.b64encode(image_data).decode('utf-8')
-
-
-def get_image_mime_type(image_path: str) -> str:
-    """Определение MIME типа изображения"""
-    ext = os.path.splitext(image_path)[1].lower()
-    mime_types = {
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.png': 'image/png',
-        '.gif': 'image/gif',
-        '.webp': 'image/webp'
-    }
-    return mime_types.get(ext, 'image/jpeg')
+
+class PreparedImage(NamedTuple):
+    """Изображение, уже подготовленное для vision-запроса"""
+    data: bytes
+    mime_type: str
+
+
+async def download_to_buffer(bot, file_path: str, file_size: Optional[int] = None,
+                             memory_threshold: int = MEDIA_MEMORY_THRESHOLD) -> BinaryIO:
+    """
+    Скачивание файла Telegram в буфер в памяти без записи на диск.
+    Файлы больше memory_threshold автоматически переносятся во временный файл.
+
+    Args:
+        bot: Экземпляр aiogram Bot
+        file_path: Путь к файлу на сервере Telegram
+        file_size: Размер файла, если известен заранее
+
+    Returns:
+        Буфер, установленный на начало; закрыть после использования
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=memory_threshold)
+    if file_size is not None and file_size > memory_threshold:
+        # Заранее известно, что в память не поместится — сразу пишем на диск
+        buffer.rollover()
+    try:
+        await bot.download_file(file_path, destination=buffer)
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
+
+
+def buffer_size(buffer: BinaryIO) -> int:
+    """Размер содержимого буфера, позиция сохраняется"""
+    position = buffer.tell()
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(position)
+    return size
+
+
+async def read_media(source: MediaSource) -> bytes:
+    """Содержимое медиа из файла, байтов или буфера"""
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, str):
+        async with aiofiles.open(source, 'rb') as f:
+            return await f.read()
+    source.seek(0)
+    return source.read()
+
+
+def preprocess_image(image_data: bytes, max_edge: int = IMAGE_MAX_EDGE,
+                     image_format: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY) -> Tuple[bytes, str]:
+    """
+    Подготовка изображения для vision-запроса: поворот по EXIF, уменьшение
+    до max_edge по длинной стороне и перекодирование без метаданных.
+    Синхронная функция — вызывать вне event loop.
+
+    Returns:
+        (байты изображения, MIME тип)
+    """
+    # Pillow импортируется при первом изображении, а не при запуске бота
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(image_data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # У JPEG нет прозрачности — подкладываем белый фон
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        # EXIF и прочие метаданные не передаются при сохранении
+        image.save(output, format=image_format, quality=quality, optimize=True)
+    mime_type = "image/webp" if image_format.upper() == "WEBP" else "image/jpeg"
+    return output.getvalue(), mime_type
+
+
+async def preprocess_image_source(image: MediaSource) -> PreparedImage:
+    """
+    Чтение и предобработка изображения в пуле потоков
+
+    Args:
+        image: Путь к изображению, его байты или буфер
+    """
+    image_data = await read_media(image)
+    loop = asyncio.get_running_loop()
+    processed, mime_type = await loop.run_in_executor(None, preprocess_image, image_data)
+    return PreparedImage(processed, mime_type)
+
+
+async def prepare_image_for_vision(image: Union[MediaSource, PreparedImage]) -> Tuple[str, str]:
+    """
+    Изображение для vision-запроса в base64; уже подготовленное только кодируется
+
+    Args:
+        image: Путь к изображению, его байты, буфер или PreparedImage
+
+    Returns:
+        (base64 строка, MIME тип)
+    """
+    if not isinstance(image, PreparedImage):
+        image = await preprocess_image_source(image)
+    return base64.b64encode(image.data).decode('utf-8'), image.mime_type
+
+
+def choose_photo_size(photo_sizes: Sequence, max_edge: int = IMAGE_MAX_EDGE):
+    """
+    Выбор наименьшего из вариантов фото Telegram, длинная сторона которого
+    не меньше max_edge; если таких нет — самого большого
+    """
+    ordered = sorted(photo_sizes, key=lambda size: max(size.width, size.height))
+    for size in ordered:
+        if max(size.width, size.height) >= max_edge:
+            return size
+    return ordered[-1]
 
 
 async def save_file_from_bytes(file_bytes: bytes, file_path: str):
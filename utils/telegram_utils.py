@@ -0,0 +1,222 @@
+"""
+Утилиты для отправки ответов в Telegram
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from config import STREAM_EDIT_INTERVAL, STREAM_PLACEHOLDER, STREAM_FINAL_EDIT_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Признак того, что ответ еще генерируется
+STREAM_CURSOR = " ▌"
+# Конец ответа, генерация которого оборвалась из-за ошибки
+STREAM_INTERRUPTED_MARK = "\n\n[ответ прерван]"
+# Что увидит пользователь, если модель ничего не ответила (в историю не попадает)
+EMPTY_RESPONSE_MESSAGE = "Не удалось получить ответ. Попробуйте еще раз."
+
+# Где резать длинный текст, по убыванию предпочтения: абзац, строка, предложение, слово
+_SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+class StreamInterruptedError(Exception):
+    """Поток ответа оборвался, когда часть ответа уже была показана; partial — показанный текст"""
+
+    def __init__(self, partial: str, error: BaseException):
+        super().__init__(str(error))
+        self.partial = partial
+
+
+def _split_point(text: str, limit: int) -> int:
+    """
+    Длина начала текста, которое уходит в одно сообщение: по границе абзаца, если
+    она не дальше половины лимита от конца, иначе по строке, предложению или слову
+    """
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for separator in _SPLIT_SEPARATORS:
+        position = window.rfind(separator)
+        if position >= limit // 2:
+            return position + len(separator)
+    return limit
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбиение текста на сообщения не длиннее limit символов"""
+    chunks = []
+    text = text.strip()
+    while text:
+        cut = _split_point(text, limit)
+        chunk = text[:cut].rstrip()
+        if chunk:
+            chunks.append(chunk)
+        text = text[cut:].lstrip()
+    return chunks
+
+
+async def answer_text(message: Message, text: str):
+    """Ответ любой длины: длинный текст уходит несколькими сообщениями по абзацам"""
+    for chunk in split_message(text or "") or [EMPTY_RESPONSE_MESSAGE]:
+        await message.answer(chunk)
+
+
+async def _edit_text(sent: Message, text: str) -> Optional[float]:
+    """
+    Редактирование сообщения с игнорированием «message is not modified».
+    Возвращает паузу в секундах, если Telegram попросил подождать.
+    """
+    try:
+        await sent.edit_text(text)
+    except TelegramRetryAfter as e:
+        return float(e.retry_after)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    return None
+
+
+async def _finish_message(message: Message, sent: Message, text: str,
+                          attempts: int = STREAM_FINAL_EDIT_ATTEMPTS):
+    """
+    Окончательный текст сообщения ответа. Пока Telegram просит подождать,
+    редактирование повторяется после названной паузы; если так и не удалось,
+    текст уходит новым сообщением, а недописанное удаляется
+    """
+    for _ in range(max(1, attempts)):
+        retry_after = await _edit_text(sent, text)
+        if retry_after is None:
+            return
+        await asyncio.sleep(retry_after)
+    logger.warning("Не удалось отредактировать ответ после %s попыток, отправляю новым сообщением", attempts)
+    await message.answer(text)
+    try:
+        await sent.delete()
+    except Exception as e:
+        logger.warning("Не удалось удалить недописанный ответ: %s", e)
+
+
+async def _finish_reply(message: Message, sent_messages: List[Message], tail: str):
+    """Окончательный текст последнего сообщения ответа; не поместившееся — новыми сообщениями"""
+    chunks = split_message(tail)
+    if not chunks:
+        # Остаток ответа пустой — заглушка для продолжения не нужна
+        await sent_messages[-1].delete()
+        return
+    await _finish_message(message, sent_messages[-1], chunks[0])
+    for chunk in chunks[1:]:
+        await message.answer(chunk)
+
+
+async def answer_streaming(message: Message, deltas: AsyncIterator[str],
+                           edit_interval: float = STREAM_EDIT_INTERVAL) -> str:
+    """
+    Ответ с постепенным обновлением: сразу отправляется заглушка, которая
+    редактируется по мере поступления фрагментов, не чаще раза в edit_interval
+    секунд. Чтение потока не ждет редактирований — они идут в отдельной задаче.
+    Когда текст перестает помещаться в сообщение, готовая часть (по границе абзаца)
+    остается в нем, а продолжение идет в новом сообщении, не дожидаясь конца ответа.
+
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        deltas: Поток фрагментов ответа
+        edit_interval: Минимальный интервал между редактированиями, сек
+
+    Returns:
+        Полный текст ответа; пустая строка, если модель ничего не ответила
+        (пользователь видит EMPTY_RESPONSE_MESSAGE)
+
+    Raises:
+        StreamInterruptedError: Поток оборвался после того, как часть ответа была
+            показана; показанная часть остается с пометкой STREAM_INTERRUPTED_MARK
+    """
+    sent_messages = [await message.answer(STREAM_PLACEHOLDER)]
+    parts = []
+    changed = asyncio.Event()
+    finished = False
+    # Начало текста последнего отправленного сообщения в ответе
+    offset = 0
+
+    async def editor():
+        nonlocal offset
+        shown = ""
+        next_edit_at = 0.0
+        limit = TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR)
+        while True:
+            await changed.wait()
+            changed.clear()
+            if finished:
+                return
+            delay = next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if finished:
+                    return
+            text = "".join(parts)[offset:]
+            if len(text) > limit:
+                # Часть, которая уже не изменится, — окончательный текст сообщения
+                cut = _split_point(text, limit)
+                retry_after = await _edit_text(sent_messages[-1], text[:cut].rstrip())
+                if retry_after is None:
+                    sent_messages.append(await message.answer(STREAM_PLACEHOLDER))
+                    offset += cut
+                    shown = ""
+                    # Остаток показываем в новом сообщении, не дожидаясь следующего фрагмента
+                    changed.set()
+                next_edit_at = time.monotonic() + max(edit_interval, retry_after or 0)
+                continue
+            preview = text + STREAM_CURSOR
+            if preview != shown:
+                retry_after = await _edit_text(sent_messages[-1], preview)
+                if retry_after is None:
+                    shown = preview
+                next_edit_at = time.monotonic() + max(edit_interval, retry_after or 0)
+
+    editor_task = asyncio.create_task(editor())
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            changed.set()
+    except BaseException as e:
+        editor_task.cancel()
+        if not parts or not isinstance(e, Exception):
+            # Ничего не успели показать — убираем заглушку, ошибку сообщит обработчик;
+            # отмененный (устаревший) ответ убираем вместе с уже показанной частью
+            for sent in sent_messages:
+                try:
+                    await sent.delete()
+                except Exception:
+                    pass
+            raise
+        # Показанная часть остается без курсора и с пометкой, что ответ оборван
+        await asyncio.gather(editor_task, return_exceptions=True)
+        partial = "".join(parts).rstrip() + STREAM_INTERRUPTED_MARK
+        try:
+            await _finish_reply(message, sent_messages, partial[offset:])
+        except Exception as finish_error:
+            logger.warning("Не удалось завершить прерванный ответ: %s", finish_error)
+        raise StreamInterruptedError(partial, e) from e
+    finally:
+        finished = True
+        changed.set()
+
+    # Дожидаемся окончания текущего редактирования, чтобы финальный текст был последним
+    try:
+        await editor_task
+    except Exception as e:
+        logger.warning("Ошибка промежуточного редактирования ответа: %s", e)
+
+    response = "".join(parts)
+    if not response.strip():
+        await _finish_message(message, sent_messages[-1], EMPTY_RESPONSE_MESSAGE)
+        return ""
+    await _finish_reply(message, sent_messages, response[offset:])
+    return response
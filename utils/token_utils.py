@@ -0,0 +1,67 @@
+"""
+Оценка числа токенов без обращения к API и токенизатору
+"""
+from typing import Dict, List
+
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Оценка токенов одного изображения (высокая детализация, сторона до IMAGE_MAX_EDGE)
+IMAGE_PART_TOKENS = 765
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов в тексте.
+    Латиница и цифры — около 4 символов на токен, кириллица и прочие
+    символы — около 2 символов на токен. Оценка намеренно слегка завышена.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    other_chars = len(text) - ascii_chars
+    return ascii_chars // 4 + other_chars // 2 + 1
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    """Оценка токенов одного сообщения чата, изображения — по фиксированной оценке"""
+    content = message.get("content") or ""
+    images = 0
+    if isinstance(content, list):
+        parts = [part for part in content if isinstance(part, dict)]
+        images = sum(1 for part in parts if part.get("type") == "image_url")
+        content = " ".join(part.get("text", "") for part in parts)
+    return estimate_tokens(content) + images * IMAGE_PART_TOKENS + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_messages_tokens(messages: List[Dict]) -> int:
+    """Оценка токенов списка сообщений чата"""
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def split_text_by_tokens(text: str, chunk_tokens: int) -> List[str]:
+    """
+    Разбиение текста на части не больше chunk_tokens (по оценке) каждая.
+    Границы проходят по строкам; слишком длинная строка режется по символам.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for line in text.split("\n"):
+        line_tokens = estimate_tokens(line) + 1
+        if line_tokens > chunk_tokens:
+            # Сначала закрываем накопленную часть, затем режем строку на куски
+            if current:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            chars_per_chunk = max(1, len(line) * chunk_tokens // line_tokens)
+            chunks.extend(line[i:i + chars_per_chunk] for i in range(0, len(line), chars_per_chunk))
+            continue
+        if current and current_tokens + line_tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
@@ -0,0 +1,70 @@
+"""
+Прогрев бота после запуска, чтобы первый ответ после деплоя не был медленнее
+остальных. До приема обновлений: соединения с БД разбирают схему, окна истории
+недавно писавших пользователей загружаются в кэш, открываются соединения с OpenAI
+и Bot API. В фоне: процессы разбора документов и Pillow (импортируются лениво).
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Dict, Optional
+
+from aiogram import Bot
+
+from config import (
+    WARMUP_TIMEOUT, WARMUP_HISTORY_USERS, WARMUP_OPENAI_CONNECTIONS, WARMUP_EXTRACTION_POOL,
+)
+from database import Database
+from openai_client import OpenAIClient
+from utils.document_utils import warm_up_extraction_pool
+
+logger = logging.getLogger(__name__)
+
+
+async def _timed(name: str, step: Awaitable, timings: Dict[str, float]):
+    """Шаг прогрева: ошибка не мешает запуску, только записывается в лог"""
+    started = time.perf_counter()
+    try:
+        await step
+    except Exception as e:
+        logger.warning(f"Прогрев: шаг {name} не выполнен: {str(e)}")
+    finally:
+        timings[name] = time.perf_counter() - started
+
+
+async def warm_up(db: Database, openai_client: OpenAIClient, bot: Optional[Bot] = None,
+                  timeout: float = WARMUP_TIMEOUT) -> Dict[str, float]:
+    """
+    Прогрев перед приемом обновлений; шаги идут параллельно и не дольше timeout
+
+    Returns:
+        Длительность каждого шага, сек (в том числе прерванного по таймауту)
+    """
+    timings: Dict[str, float] = {}
+    steps = [
+        _timed("database", db.warm_up(WARMUP_HISTORY_USERS), timings),
+        _timed("openai", openai_client.warm_up(WARMUP_OPENAI_CONNECTIONS), timings),
+    ]
+    if bot is not None:
+        steps.append(_timed("telegram", bot.get_me(), timings))
+    try:
+        await asyncio.wait_for(asyncio.gather(*steps), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Прогрев не уложился в {timeout} с, бот запускается без него")
+    logger.info("Прогрев: " + ", ".join(f"{name} {seconds:.2f} с" for name, seconds in timings.items()))
+    return timings
+
+
+def _import_image_libraries():
+    from PIL import Image, ImageOps  # noqa: F401
+
+
+async def warm_up_background():
+    """Фоновый прогрев того, что не нужно большинству сообщений"""
+    timings: Dict[str, float] = {}
+    loop = asyncio.get_running_loop()
+    steps = [_timed("pillow", loop.run_in_executor(None, _import_image_libraries), timings)]
+    if WARMUP_EXTRACTION_POOL:
+        steps.append(_timed("extraction_pool", warm_up_extraction_pool(), timings))
+    await asyncio.gather(*steps)
+    logger.info("Фоновый прогрев: " + ", ".join(f"{name} {seconds:.2f} с" for name, seconds in timings.items()))